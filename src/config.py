@@ -92,8 +92,9 @@ class Config:
     and application constants"""
    
 
-    def __init__(self, baseDir,logger):
+    def __init__(self, baseDir,logger,overlayName=None):
         self.overlayPath=""
+        self.overlayOverride=overlayName# from the command line, takes precedence over config.ini
         self.baseDir=baseDir
         self.parser=None
         self.appLogger=logger
@@ -190,7 +191,12 @@ class Config:
         """Check to see if an overlay is specified in the config.ini"""
         Overlays=self.parser['Overlays']
         self.overlayEnable=Overlays.getboolean('overlayEnable')
-        if self.overlayEnable:
+        if self.overlayOverride:
+            self.overlayEnable=True
+            self.overlayName=self.overlayOverride
+            a,b=self.get_current_overlay(self.overlayName)
+            self.parser.read([a])
+        elif self.overlayEnable:
             self.overlayName=Overlays.get('overlayName')
             a,b=self.get_current_overlay(self.overlayName)
             self.parser.read([a])
@@ -203,7 +209,7 @@ class Config:
                 self.image_path = os.path.join(Path(self.baseDir).parents[0], self.image_path)# one up
             except:
                 pass
-            os.makedirs(self.image_path)# make it in the base dir
+            os.makedirs(self.image_path, exist_ok=True)# make it in the base dir
         
     
     def _get_data_path(self):
@@ -212,7 +218,7 @@ class Config:
                 self.db_path = os.path.join(Path(self.baseDir).parents[0], self.db_path)# one up
             except:
                 pass
-            os.makedirs(self.db_path)# make it in the base dir
+            os.makedirs(self.db_path, exist_ok=True)# make it in the base dir
                 
     def retrieve_settings(self):
         """Get all the settings from the config and overlay files"""
@@ -220,6 +226,16 @@ class Config:
         self.src_is_file=Source.getboolean('file_src',False)
         self.source_file_name=Source.get('source_file_name')
         self.file_loop= Source.getboolean('file_loop', True)
+        self.file_replay_fast= Source.getboolean('file_replay_fast', False) # process a file as fast as possible, every frame, single pass
+        if self.file_replay_fast:
+            self.file_loop = False # looping would just record the same vehicles again
+        self.file_chunk_workers= Source.getint('file_chunk_workers', 0) # >1 splits a file into time ranges processed in parallel
+        self.file_chunk_overlap= Source.getfloat('file_chunk_overlap', 5.0) # seconds each range starts early and runs late
+        self.frame_buffer_slots= Source.getint('frame_buffer_slots', 24) # number of preallocated frames buffered between capture and tracking
+        self.frame_buffer_policy= Source.get('frame_buffer_policy', 'drop_oldest') # block, drop_oldest, drop_newest or latest when the buffer is full
+        self.read_timeout= Source.getfloat('read_timeout', 0.5) # seconds tracking waits for the next frame, 0= poll
+        self.capture_gray_roi= Source.getboolean('capture_gray_roi', False) # camera thread queues only the gray motion area
+        self.evidence_frames= max(5, Source.getint('evidence_frames', 8)) # full frames kept for photos when capture_gray_roi
         Calibration=self.parser['Calibration']
         self.calibrate=Calibration.getboolean('calibrate',False)
         self.cal_obj_mm_R2L=Calibration.getfloat('cal_obj_mm_R2L',4700.0)
@@ -231,7 +247,8 @@ class Config:
         self.motion_win_colour = [int(c) for c in (Calibration.get('motion_win_colour','0,0,255').split(','))]
         self.motion_win_colour.reverse()
         Gui=self.parser['GUI']
-        self.gui_window_on = Gui.getboolean('gui_window', True)  # True= Turn On All desktop GUI openCV windows. False=Don't Show (req'd for SSH) .
+        self.headless = Gui.getboolean('headless', False)  # True= production mode, no GUI windows or drawing at all, stop with SIGTERM
+        self.gui_window_on = Gui.getboolean('gui_window', True) and not self.headless  # True= Turn On All desktop GUI openCV windows. False=Don't Show (req'd for SSH) .
         self.gui_show_camera = Gui.getboolean('gui_show_camera',True) # True=Show the camera on gui windows. False=Don't Show (useful for image_sign)
         self.show_thresh_on = Gui.getboolean('show_thresh_on',False) # Display desktop GUI openCV cropped threshold window. True=Show, False=Don't Show
         self.show_crop_on =  Gui.getboolean('show_crop_on', False)   # Same as show_thresh_on but in color. True=Show, False=Don't Show (Default)
@@ -253,17 +270,57 @@ class Config:
         self.SPEED_MPH = Motion.getboolean('SPEED_MPH', True) # Set Speed Units   kph=False  mph=True
         self.track_counter = Motion.getint('track_counter', 10) # Default= 6 Number of Consecutive Motion Events to trigger speed photo. Adjust to suit.
                        # Suggest single core cpu=4-7 quad core=8-15 but adjust to smooth erratic readings due to contour jumps
-        self.MIN_AREA = Motion.getint('MIN_AREA', 1000)  # Default= 200 Exclude all contours less than or equal to this sq-px Area
+        self.MIN_AREA = Motion.getint('MIN_AREA', 1000)  # Default= 200 Exclude all moving blobs of this many px or fewer
         self.show_out_range = Motion.getboolean('show_out_of_range', False)  # Default= True Show Out of Range Events per x_diff settings below False= Off
         self.x_diff_max = Motion.getint('x_diff_max', 40 ) # Default= 20 Exclude if max px away >= last motion event x position
         self.x_diff_min = Motion.getint('x_diff_min', 1)  # Default= 1 Exclude if min px away <= last event x position
         self.y_diff_max = Motion.getint('y_diff_max', 10)
         #self.x_buf_adjust = Motion.getint('x_buf_adjust',10)  # Default= 10 Divides motion Rect x for L&R Buffer Space to Ensure contours are in
         self.track_timeout = Motion.getfloat('track_timeout', 1) # Default= 0.5 Optional seconds to wait after track End (Avoids dual tracking)
-        #self.event_timeout = Motion.getfloat('event_timeout', 0.3) # Default= 0.3 seconds to wait for next motion event before starting new track
+        self.event_timeout = Motion.getfloat('event_timeout', 0.3) # Default= 0.3 seconds a vehicle being tracked can go unseen before it is lost
+        self.track_confirm = Motion.getint('track_confirm', 3) # matches before a new vehicle is confirmed, until then it is lost as soon as it is missed
+        self.max_live_tracks = Motion.getint('max_live_tracks', 16) # most vehicles held at once, bounds the matching work per frame
         self.max_speed_over = Motion.getfloat('max_speed_over', 8)     # Exclude track if Speed less than or equal to value specified 0=All
                        # Can be useful to exclude pedestrians and/or bikes, Etc or track only fast objects
         self.max_speed_count= Motion.getfloat('max_speed_count', 65)  # dont't count anything over this speed, probably wrong
+        self.speed_outlier_sigma = Motion.getfloat('speed_outlier_sigma', 3.0) # reject a speed this many standard deviations from the track average, 0= off
+        self.speed_outlier_min = Motion.getfloat('speed_outlier_min', 5.0) # but only if it is at least this far from the average
+        self.motion_gate = Motion.getboolean('motion_gate', False) # True= skip the contour pipeline for frames with nothing moving
+        self.motion_gate_decimate = Motion.getint('motion_gate_decimate', 4) # the gate compares frames shrunk by this factor
+        self.motion_gate_threshold = Motion.getint('motion_gate_threshold', 20) # grey level change that counts as a changed pixel
+        self.motion_gate_noise_factor = Motion.getfloat('motion_gate_noise_factor', 3.0) # changed pixels must exceed this times the learnt noise
+        self.motion_gate_min_pixels = Motion.getint('motion_gate_min_pixels', 4) # and at least this many (shrunk) changed pixels
+        self.adaptive_roi = Motion.getboolean('adaptive_roi', False) # True= while vehicles are tracked only search around them
+        self.roi_padding = Motion.getint('roi_padding', 16) # adaptive_roi, px around where each vehicle could be
+        self.roi_full_scan_interval = Motion.getfloat('roi_full_scan_interval', 0.25) # adaptive_roi, seconds between searches of the whole area for new vehicles
+        self.roi_entry_width = Motion.getint('roi_entry_width', 32) # adaptive_roi, px at each end of the area always searched for vehicles coming into view
+        self.detector = Motion.get('detector', 'canny') # canny, running_average or mog2 motion detection front end
+        self.detector_dilate = Motion.getint('detector_dilate', 2) # dilate iterations joining up the blobs, running_average and mog2
+        self.canny_low = Motion.getint('canny_low', 100) # canny hysteresis thresholds
+        self.canny_high = Motion.getint('canny_high', 200)
+        self.running_average_alpha = Motion.getfloat('running_average_alpha', 0.02) # how quickly the background follows the scene
+        self.running_average_threshold = Motion.getint('running_average_threshold', 25) # grey level difference from the background that is motion
+        self.mog2_history = Motion.getint('mog2_history', 300) # frames in the MOG2 background model
+        self.mog2_var_threshold = Motion.getfloat('mog2_var_threshold', 16) # MOG2 distance threshold, higher is less sensitive
+        self.mog2_learning_rate = Motion.getfloat('mog2_learning_rate', -1) # -1= automatic from the history
+        self.projection_threshold = Motion.getint('projection_threshold', 20) # grey level change for a pixel to count as moving
+        self.projection_min_pixels = Motion.getint('projection_min_pixels', 3) # moving pixels for a column to count as moving
+        self.projection_max_gap = Motion.getint('projection_max_gap', 20) # join runs of moving columns closer than this, split lanes at gaps of rows this tall
+        self.projection_min_width = Motion.getint('projection_min_width', 10) # narrowest joined run that can be a vehicle
+        self.speed_engine = Motion.get('speed_engine', 'edges') # edges= speed from the contour edge positions, phase= sub-pixel phase correlation, fit= line fitted to the edge positions
+        self.phase_min_response = Motion.getfloat('phase_min_response', 0.3) # weaker phase correlation peaks are not trusted
+        self.phase_track_counter = Motion.getint('phase_track_counter', 3) # phase measurements needed to complete a track
+        self.fit_robust = Motion.getboolean('fit_robust', True) # fit, down weight the positions far from the line
+        self.fit_min_points = Motion.getint('fit_min_points', 4) # fit, positions needed before a track can complete early
+        self.fit_target_moe = Motion.getfloat('fit_target_moe', 1.0) # fit, complete the track once the margin of error is this small
+        self.assignment = Motion.get('assignment', 'greedy') # greedy or hungarian (needs scipy) matching of blobs to vehicles
+        self.predictor = Motion.get('predictor', 'last') # last= blobs are matched to the last centroid, kalman= to a Kalman prediction
+        self.kalman_gate_sigma = Motion.getfloat('kalman_gate_sigma', 3.0) # kalman, match blobs within this many standard deviations of the prediction
+        self.kalman_min_gate = Motion.getfloat('kalman_min_gate', 8.0) # kalman, but never closer than this many px
+        self.kalman_measurement_sigma = Motion.getfloat('kalman_measurement_sigma', 3.0) # kalman, px a blob centroid wanders from the vehicle
+        self.kalman_accel_sigma = Motion.getfloat('kalman_accel_sigma', 300.0) # kalman, px/sec^2 the velocity can change by
+        self.kalman_speed_sigma = Motion.getfloat('kalman_speed_sigma', 500.0) # kalman, px/sec uncertainty of a new vehicle's velocity
+        self.concurrent_tracking = Motion.getboolean('concurrent_tracking', True) # True= keep tracking other vehicles after a track ends
         self.x_left =  Motion.getint('x_left',220)  # uncomment and change values to override auto calculate
         self.x_right = Motion.getint('x_right', 430)# uncomment and change values to override auto calculate
 
@@ -279,6 +336,9 @@ class Config:
         self.WEBCAM_HEIGHT = Webcam.getint('WEBCAM_HEIGHT', 480)    # Default= 240 USB Webcam Image height ignored for RTSP cam
         self.WEBCAM_HFLIP = Webcam.getboolean('WEBCAM_HFLIP', False) # Default= False USB Webcam flip image horizontally
         self.WEBCAM_VFLIP = Webcam.getboolean('WEBCAM_VFLIP', False) # Default= False USB Webcam flip image vertically
+        self.WEBCAM_EVIDENCE_SRC = Webcam.get('WEBCAM_EVIDENCE_SRC', "") # optional high resolution stream speed photos are taken from
+        self.WEBCAM_EVIDENCE_FRAMES = Webcam.getint('WEBCAM_EVIDENCE_FRAMES', 30) # evidence frames kept to look up by time
+        self.WEBCAM_EVIDENCE_TOLERANCE = Webcam.getfloat('WEBCAM_EVIDENCE_TOLERANCE', 0.5) # seconds, else the motion frame is saved
         PiCamera= self.parser['PiCamera']
 
         self.CAMERA_WIDTH = PiCamera.getint('CAMERA_WIDTH', 320)     # Image stream width for opencv motion scanning Default=320
@@ -287,6 +347,7 @@ class Config:
         self.CAMERA_ROTATION = PiCamera.getint('CAMERA_ROTATION',0)  # Rotate camera image valid values are 0, 90, 180, 270
         self.CAMERA_VFLIP = PiCamera.getboolean('CAMERA_VFLIP', True)    # Flip the camera image vertically if required
         self.CAMERA_HFLIP = PiCamera.getboolean('CAMERA_HFLIP', True)    # Flip the camera image horizontally if required
+        self.CAMERA_LUMA_ONLY = PiCamera.getboolean('CAMERA_LUMA_ONLY', False)  # capture yuv and use the Y plane for motion, colour only for photos
         Image= self.parser['Image']
         self.image_path = Image.get('image_path', 'media/image')   # folder name to store images
         self.image_prefix = Image.get('image_prefix', "speed_")     # image name prefix
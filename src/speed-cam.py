@@ -52,21 +52,34 @@ import logging
 import logging.config
 import logging.handlers
 import sqlite3
+import threading
 from threading import Thread
+from collections import Counter
 import subprocess
 
 import numpy as np
 from array import array
 import json
-import PySimpleGUI as sg
+import signal
+import argparse
+import functools
+try:# only needed for the GUI mask dialog, may not be installed on a headless box
+    import PySimpleGUI as sg
+except ImportError:
+    sg = None
 #import defaults
 import speed_file_utils
-import queue
 from speed_constants import Speed_Colours as colours, Speed_Errors as errors, Speed_Constants as constants
-from statistics import mean, pstdev
-import math
 import copy
 from speed_sql_db import SpeedDB
+from speed_frame_buffer import FrameRingBuffer, TimestampedFrameStore
+from speed_tracking import ASSIGNMENT_METHODS, PREDICTORS, DIRECTIONS, DIRECTION_NAMES, L2R, R2L, UNKNOWN, RunningStats, TrackBuffer
+from speed_tracking import TENTATIVE, CONFIRMED, FINISHED, LOST, aged_state, confirmed_state
+from speed_tracking import KalmanPredictor, assign, cost_matrix, fit_track, kalman_gate, linear_sum_assignment, overlaps, trail_box
+from speed_motion import SPEED_ENGINES, AdaptiveRoi, ContourWorkspace, MotionGate, PhaseCorrelator, NO_BLOBS, create_detector, select_blobs
+from speed_batch import SpeedRecord, plan_chunks, merge_chunk_records, remove_record_images
+from speed_batch import find_batch_files, file_signature, load_checkpoint, save_checkpoint, is_finished
+import multiprocessing
 from os import path
 
 """
@@ -83,8 +96,16 @@ try:
     appLogger=logging.getLogger('appLogger')
 except Exception as e:
     pass
+# command line options, parsed before the settings as they can choose the overlay
+arg_parser = argparse.ArgumentParser(description="Motion track moving objects and calculate speed")
+arg_parser.add_argument('--overlay', help="overlay ini to use instead of overlayName in config.ini")
+arg_parser.add_argument('--batch', help="reprocess a directory or glob of recorded video files, then exit")
+arg_parser.add_argument('--workers', type=int, default=0, help="processes for --batch, default is the number of cpus")
+arg_parser.add_argument('--checkpoint', help="--batch progress file so an interrupted batch resumes,"
+                        " default is <DB_DIR>/<overlay>_batch.json")
+args, _ = arg_parser.parse_known_args()
 # import user settings and program settings
-cfg=Config(baseDir,appLogger)
+cfg=Config(baseDir,appLogger,overlayName=args.overlay)
 
 # fix rounding problems with picamera resolution
 camera_width = (cfg.CAMERA_WIDTH + 31) // 32 * 32
@@ -200,6 +221,12 @@ if webcam:
         webcam_flipped = True
 
 quote = '"'  # Used for creating quote delimited log file of speed data
+stop_requested = threading.Event()  # set by a signal handler to end tracking cleanly
+
+def request_stop(signum, frame):
+    """Signal handler, ask the tracking loop to finish"""
+    overlayLogger.info("Received signal %i, stopping", signum)
+    stop_requested.set()
             
 class SpeedCam(object):
     def __init__(self):
@@ -222,42 +249,93 @@ class SpeedCam(object):
             self.speed_conv_R2L = self.px_to_kph_R2L 
     
     
+#------------------------------------------------------------------------------
+class PiFrameOutput(object):
+    """File-like picamera output that writes each captured frame straight into a ring buffer slot,
+    instead of PiRGBArray allocating a new array for every frame.
+    shape is the layout of a frame in the slot, (h, w, 3) for bgr or (h*3/2, w) for yuv (I420)"""
+    def __init__(self, frame_buffer, shape):
+        self.frame_buffer = frame_buffer
+        self.frame_buffer.allocate(shape)
+        self.camera = None
+        self.frame_timestamp = 0
+        self._idx = None
+        self._flat = None
+        self._discard = np.empty(int(np.prod(shape)), dtype=np.uint8)# sink for frames dropped by the buffer policy
+        self._pos = 0
+        self._skipping = False
+
+    def write(self, data):
+        if self._skipping:# the rest of a frame the tracker doesn't want
+            return len(data)
+        if self._flat is None:# start of a new frame
+            if self.frame_buffer.skip_frame(self.camera.timestamp/1E6):
+                self._skipping = True
+                return len(data)
+            self._idx, slot = self.frame_buffer.get_write_slot()
+            self._flat = slot.reshape(-1) if self._idx is not None else self._discard
+            self._pos = 0
+        count = min(len(data), self._flat.size - self._pos)
+        self._flat[self._pos:self._pos + count] = np.frombuffer(data, dtype=np.uint8, count=count)
+        self._pos += count
+        return len(data)
+
+    def flush(self):
+        """called by picamera at the end of each capture"""
+        if self._idx is not None:
+            self.frame_timestamp = self.camera.timestamp/1E6# convert to seconds for compatibility
+            self.frame_buffer.commit(self._idx, self.frame_timestamp)
+        self._idx = None
+        self._flat = None
+        self._skipping = False
+
+    def close(self):
+        if self._idx is not None:
+            self.frame_buffer.cancel(self._idx)
+        self._idx = None
+        self._flat = None
+
+
 #------------------------------------------------------------------------------
 class PiVideoStream:
     def __init__(self, resolution=(camera_width, camera_height),
                  framerate=cfg.CAMERA_FRAMERATE, rotation=0,
                  hflip=cfg.CAMERA_HFLIP, vflip=cfg.CAMERA_VFLIP,
-                 saveStream=False,isFile=False, isLoop =True):
-       
-        self.isFile=isFile
-        if not self.isFile:
-            """ initialize the camera and stream """
-            try:
-                self.camera = PiCamera()
-            except:
-                overlayLogger.error("PiCamera Already in Use by Another Process")
-                overlayLogger.error("%s %s Exiting Due to Error", progName, progVer)
-                sys.exit(1)
-            self.camera.resolution = resolution
-            self.camera.rotation = rotation
-            self.camera.framerate = framerate
-            self.camera.hflip = hflip
-            self.camera.vflip = vflip
-            self.camera.framerate=20
-            self.camera.iso=100
-            self.camera.exposure_mode='antishake'# change this for your camera situation
-            # options: off,auto,night,nightpreview,backlight,spotlight,sports,snow,beach,very long,fixedfps,antishake
-            self.fps=self.camera.framerate
-            self.rawCapture = PiRGBArray(self.camera, size=resolution)
-            self.stream = self.camera.capture_continuous(self.rawCapture,
-                                                        format="bgr",
-                                                        use_video_port=True)
+                 saveStream=False, policy=None, luma_only=cfg.CAMERA_LUMA_ONLY):
+        """ luma_only captures yuv, the Y plane is used for motion and colour is only made for a speed photo.
+        Recordings are read with WebcamVideoStream, this is only for the Pi camera"""
+        self.luma_only=luma_only
+        self.height=resolution[1]
+        self.roi=None# (x_left, x_right, y_upper, y_lower) of the Y plane returned by read() when luma_only
+        self._yuv=None# (frame, timestamp) last read when luma_only
+        """ initialize the camera and stream """
+        try:
+            self.camera = PiCamera()
+        except:
+            overlayLogger.error("PiCamera Already in Use by Another Process")
+            overlayLogger.error("%s %s Exiting Due to Error", progName, progVer)
+            sys.exit(1)
+        self.camera.resolution = resolution
+        self.camera.rotation = rotation
+        self.camera.framerate = framerate
+        self.camera.hflip = hflip
+        self.camera.vflip = vflip
+        self.camera.framerate=20
+        self.camera.iso=100
+        self.camera.exposure_mode='antishake'# change this for your camera situation
+        # options: off,auto,night,nightpreview,backlight,spotlight,sports,snow,beach,very long,fixedfps,antishake
+        self.fps=self.camera.framerate
+        # frames are written by the camera straight into preallocated ring buffer slots
+        self.frame_buffer = FrameRingBuffer(cfg.frame_buffer_slots, policy or cfg.frame_buffer_policy)
+        if luma_only:# I420, the full size Y plane followed by the quarter size U and V planes
+            self.rawCapture = PiFrameOutput(self.frame_buffer, (resolution[1] * 3 // 2, resolution[0]))
         else:
-            self.fps= self.cam_stream.get(cv2.CAP_PROP_FPS)
-            self.grabbed=True# fake this
-            self.stream_start_time=os.path.getctime(self.src)
-            self.isLoop=isLoop
-            """
+            self.rawCapture = PiFrameOutput(self.frame_buffer, (resolution[1], resolution[0], 3))
+        self.rawCapture.camera = self.camera
+        self.stream = self.camera.capture_continuous(self.rawCapture,
+                                                    format="yuv" if luma_only else "bgr",
+                                                    use_video_port=True)
+        """
         initialize the frame and the variable used to indicate
         if the thread should be stopped
         """
@@ -274,8 +352,6 @@ class PiVideoStream:
 
     def start(self):
         """ start the thread to read frames from the video stream """
-        self.q=queue.Queue(48)# create a queue buffer to smooth out processing blips
-
         self.thread = Thread(target=self.update, args=())
         self.thread.daemon = True
         self.thread.start()
@@ -285,13 +361,8 @@ class PiVideoStream:
         """ keep looping infinitely until the thread is stopped """
         self.fps_start_time=time.time()
         for f in self.stream:
-            # grab the frame from the stream and clear the stream in
-            # preparation for the next frame
-            self.frame = f.array
-            self.frame_timestamp=f.camera.timestamp/1E6# convert to seconds for compatibility
-            self.q.put((self.frame,self.frame_timestamp))
-  
-            self.rawCapture.truncate(0)
+            # the frame and timestamp have already been committed to the ring buffer by the output
+            self.frame_timestamp=self.rawCapture.frame_timestamp
 
             # if the thread indicator variable is set, stop the thread
             # and resource camera resources
@@ -303,36 +374,64 @@ class PiVideoStream:
             fps=self.get_latest_fps()
             
 
-    def read(self):
-        """ return the frame most recently read """
-        #buffering the frame reads in the queue allows a smoother replay if resources are limited.
-        frame= None
-        if not self.q.empty():
-            #print("Queue", self.q.qsize())
-            frame=self.q.get()
-        return frame
-        #return self.frame,self.frame_timestamp
+    def read(self, timeout=None):
+        """ return the oldest buffered frame and timestamp
+        The frame is a ring buffer slot that belongs to the caller until the next read, so don't keep it.
+        With a timeout, wait up to that many seconds for a frame (or a stop) instead of returning None at once.
+        """
+        #buffering the frame reads allows a smoother replay if resources are limited.
+        frame = self.frame_buffer.borrow(timeout)
+        if frame is None or not self.luma_only:
+            return frame
+        self._yuv = frame# kept for get_full_frame
+        luma = frame[0][:self.height]# the Y plane is already the gray image
+        if self.roi is not None:
+            x_left, x_right, y_upper, y_lower = self.roi
+            luma = luma[y_upper:y_lower, x_left:x_right]
+        return luma, frame[1]
+
+    def get_evidence_frame(self, timestamp):
+        """ the pi camera has no separate evidence stream"""
+        return None
+
+    def set_roi(self, rect):
+        """ set the motion tracking area (x_left, x_right, y_upper, y_lower).
+        When luma_only, read() returns just this area of the Y plane, otherwise the tracker crops full frames"""
+        if self.luma_only:
+            self.roi = tuple(int(v) for v in rect)
+
+    def get_full_frame(self, timestamp):
+        """ return the colour frame for the Y plane last read, converted from yuv only now it is needed"""
+        if self._yuv is None or self._yuv[1] != timestamp:
+            return None
+        return cv2.cvtColor(self._yuv[0], cv2.COLOR_YUV2BGR_I420)
 
     def stop(self):
         """ indicate that the thread should be stopped """
         self.stopped = True
+        self.frame_buffer.close()
         if self.thread is not None:
             self.thread.join()
 
+    def log_buffer_stats(self):
+        stats=self.frame_buffer.stats()
+        overlayLogger.debug("Frame buffer %s %i/%i slots in use (high water %i), %i of %i frames dropped, %i skipped",
+                            stats['policy'], stats['occupancy'], stats['slots'], stats['high_water'],
+                            stats['dropped'], stats['written']+stats['dropped'], stats['skipped'])
+
+    def request_skip(self, frames=None, until=None):
+        """ skip frames without decoding them, see FrameRingBuffer.request_skip"""
+        self.frame_buffer.request_skip(frames, until)
+
     def get_latest_fps(self):
         """Calculate fps for skip delay"""
         
         if self.frame_count >= 30:
             duration = float(time.time() - self.fps_start_time)
-            if self.isFile:
-                self.fps= self.cam_stream.get(cv2.CAP_PROP_FPS)
-            else:
-               self.fps = float(self.frame_count / duration)
+            self.fps = float(self.frame_count / duration)
             if cfg.log_fps ==True:
-                if self.isFile:
-                    overlayLogger.debug("File reports %.2f fps", self.fps)
-                else:    
-                    overlayLogger.debug("Reading at %.2f fps over last %i frames", self.fps, self.frame_count)
+                overlayLogger.debug("Reading at %.2f fps over last %i frames", self.fps, self.frame_count)
+                self.log_buffer_stats()
 
             self.frame_count = 0
             self.fps_start_time = time.time()# reset time for next count
@@ -345,10 +444,17 @@ class PiVideoStream:
 #------------------------------------------------------------------------------
 class WebcamVideoStream:
     def __init__(self, CAM_SRC=cfg.WEBCAM_SRC, CAM_WIDTH=cfg.WEBCAM_WIDTH,
-                 CAM_HEIGHT=cfg.WEBCAM_HEIGHT,saveStream=False,isFile=False, isLoop =True):
+                 CAM_HEIGHT=cfg.WEBCAM_HEIGHT,saveStream=False,isFile=False, isLoop =True, policy=None,
+                 start_time=None, end_time=None, gray_roi=cfg.capture_gray_roi,
+                 evidence_src=None, evidence_only=False):
         """
         initialize the video camera stream and read the first frame
         from the stream
+        policy is the frame buffer overflow policy, a file is never dropped so it blocks by default
+        start_time/end_time (seconds) play only part of a file
+        gray_roi, once set_roi() is called only the gray crop is queued and full frames are kept in a small store
+        evidence_src, a second (higher resolution) stream of the same camera that speed photos are taken from
+        evidence_only, this is that stream, frames are only kept in a short store to be looked up by timestamp
         """
         self.vs_thread = None
         self.saveStream=saveStream# for calibration use
@@ -356,11 +462,29 @@ class WebcamVideoStream:
         self.src = CAM_SRC
         self.cam_stream = cv2.VideoCapture(self.src)
         self.stream_start_time= time.time()
+        # each stream's position counts from its own start, one with an evidence stream is stamped from the
+        # same clock as that, when it is grabbed, so their frames can be matched by time
+        self.wall_clock=evidence_only
         self.frame_count=0
+        if policy is None:
+            policy = 'block' if isFile else cfg.frame_buffer_policy
+        self.gray_roi=gray_roi and not evidence_only
+        self.evidence_only=evidence_only
+        self.evidence=None
+        self.roi=None# (x_left, x_right, y_upper, y_lower) cropped by this thread when gray_roi
+        self.full_frames=None
+        slots=cfg.frame_buffer_slots
+        if evidence_only:# never read, the frames only go in the store
+            self.full_frames=TimestampedFrameStore(cfg.WEBCAM_EVIDENCE_FRAMES)
+        elif self.gray_roi:# the tracker must not get further behind than the full frames kept for it
+            self.full_frames=TimestampedFrameStore(cfg.evidence_frames)
+            slots=min(slots, cfg.evidence_frames-2)
+        self.frame_buffer = FrameRingBuffer(slots, policy)# preallocated slots the frames are decoded into
         
         if not isFile:
-            self.cam_stream.set(3, CAM_WIDTH)
-            self.cam_stream.set(4, CAM_HEIGHT)
+            if CAM_WIDTH and CAM_HEIGHT:
+                self.cam_stream.set(3, CAM_WIDTH)
+                self.cam_stream.set(4, CAM_HEIGHT)
             (self.grabbed, self.frame) = self.cam_stream.read()
             if self.grabbed :# the camera may not be connected
                 #self.fps=self.__get_initial_fps(self.cam_stream)
@@ -370,20 +494,35 @@ class WebcamVideoStream:
             self.grabbed=True# fake this
             self.stream_start_time=os.path.getctime(self.src)
             self.isLoop=isLoop
+        self.end_time=end_time
+        if isFile and start_time:
+            self.cam_stream.set(cv2.CAP_PROP_POS_MSEC, start_time*1000)
         if saveStream:
             savefilename= cfg.overlayName+"_calibrate.mp4"
             fourccCode = cv2.VideoWriter_fourcc(*'mp4v')# for avi use XDIV codec
             self.vw=self._open_writer(fourcc=fourccCode,strfilename=savefilename)
+        if evidence_src and not isFile and self.grabbed:
+            if str(evidence_src).isdigit():# usb camera number
+                evidence_src = int(evidence_src)
+            self.evidence = WebcamVideoStream(CAM_SRC=evidence_src, CAM_WIDTH=None, CAM_HEIGHT=None,
+                                              evidence_only=True)
+            if not self.evidence.grabbed:
+                overlayLogger.warn("Evidence stream %s Not Connecting, speed photos will be from the motion stream",
+                                   evidence_src)
+                self.evidence = None
+            else:
+                self.wall_clock = True
             
 
     def start(self):
         """ start the thread to read frames from the video stream """
-        self.q=queue.Queue(24)# create a queue buffer to smooth out processing blips
         self.stopped = False # used to indicate that the thread should  be stopped 
     
         self.vs_thread = Thread(target=self.update, args=())
         self.vs_thread.daemon = True
         self.vs_thread.start()
+        if self.evidence is not None:
+            self.evidence.start()
         return self
 
     def update(self):
@@ -395,56 +534,160 @@ class WebcamVideoStream:
             #if self.stopped:
                 #self.cam_stream.release()
                 #return
-            # otherwise, read the next frame from the stream
-            (self.grabbed, self.frame) = self.cam_stream.read()
+            # otherwise, grab the next frame. Decoding is the expensive part so it waits until we know the frame is wanted
+            idx = None
+            self.grabbed = self.cam_stream.grab()
+            if self.grabbed:
+                frame_time = self.cam_stream.get(cv2.CAP_PROP_POS_MSEC)/1000# convert to seconds for compatibility
+                if self.end_time is not None:# only playing part of the file
+                    self.grabbed = frame_time <= self.end_time
+                timestamp = time.time() if self.wall_clock else self.stream_start_time+frame_time
+            if self.grabbed and self.evidence_only:# decode into the store, nothing is queued for tracking
+                full_idx, full_slot = self.full_frames.get_write_slot()
+                (self.grabbed, self.frame) = self.cam_stream.retrieve(image=full_slot)
+                if self.grabbed:
+                    if self.frame is not full_slot:
+                        self.full_frames.store(full_idx, self.frame)
+                    self.full_frames.commit(full_idx, timestamp)
+                    fps=self.get_latest_fps()
+                    continue
+            if self.grabbed:
+                if self.frame_buffer.skip_frame(timestamp):# the tracker doesn't want it
+                    fps=self.get_latest_fps()
+                    continue
+                idx, slot = self.frame_buffer.get_write_slot()
+                if idx is None:# the buffer policy drops this frame, or we are stopping
+                    if self.stopped:
+                        break
+                    fps=self.get_latest_fps()
+                    continue
+                roi=self.roi
+                if roi is None:# decode straight into the free buffer slot
+                    (self.grabbed, self.frame) = self.cam_stream.retrieve(image=slot)
+                else:# decode into the full frame store, only the gray crop goes in the buffer slot
+                    # keeping the full frames of those the tracker hasn't finished with
+                    full_idx, full_slot = self.full_frames.get_write_slot(self.frame_buffer.held_timestamps())
+                    (self.grabbed, self.frame) = self.cam_stream.retrieve(image=full_slot)
             #check for valid frames
             if not self.grabbed:
+                if idx is not None:
+                    self.frame_buffer.cancel(idx)
                 if self.isFile:
                     self.cam_stream.release()
                     if self.isLoop:
                         self.cam_stream = cv2.VideoCapture(self.src)# loop to beginning
+                    else: # end of the recording
+                        self.stopped = True
                     #self.cam_stream.set(cv2.CAP_PROP_POS_FRAMES,0)
                 else: # no live frames received, then safely exit
                     self.stopped = True #maybe camera has failed
-            else: # add the frame and timestamp (since stream start) to a queue
-                self.q.put((self.frame,(self.stream_start_time+(self.cam_stream.get(cv2.CAP_PROP_POS_MSEC)/1000))))# convert to seconds for compatibility
-                if self.saveStream:
+            else: # add the frame and its timestamp to the buffer
+                if roi is None:
+                    if self.frame is not slot:# first frame or the stream size has changed
+                        self.frame = self.frame_buffer.store(idx, self.frame)
+                else:
+                    if self.frame is not full_slot:
+                        self.frame = self.full_frames.store(full_idx, self.frame)
+                    if webcam_flipped:# before cropping, the field of view is in flipped co-ordinates
+                        self._flip(self.frame)
+                    self._crop_gray(self.frame, roi, idx, slot)
+                if self.saveStream:# before the commit, the tracker may draw on the frame once it has it
                     self._write(self.frame)
+                if roi is not None:
+                    self.full_frames.commit(full_idx, timestamp)
+                self.frame_buffer.commit(idx, timestamp)
                 #frame_count=self.get_latest_fps(frame_count)
                 fps=self.get_latest_fps()
                 
         self.cam_stream.release()    #release resources
+        self.frame_buffer.close()# wake the reader, there will be no more frames
 
-    def read(self):
-        """ return the frame from the buffering queue
+    def read(self, timeout=None):
+        """ return the oldest (frame, timestamp) from the ring buffer
+        The frame is a ring buffer slot that belongs to the caller until the next read, so don't keep it.
+        With a timeout, wait up to that many seconds for a frame (or a stop) instead of returning None at once.
         Although you can flip the frame, it takes resources so its better to invert the camera.            
         """
-        #buffering the frame reads in the queue allows a smoother replay if resources are limited.
-        frame= None
-        if not self.q.empty():
-            #print("Queue", self.q.qsize())
-            frame=self.q.get()
-            if webcam_flipped:
-                if (cfg.WEBCAM_HFLIP and cfg.WEBCAM_VFLIP):
-                    frame = cv2.flip(frame, -1)
-                elif cfg.WEBCAM_HFLIP:
-                    frame = cv2.flip(frame, 1)
-                elif cfg.WEBCAM_VFLIP:
-                    frame = cv2.flip(frame, 0)
+        #buffering the frame reads allows a smoother replay if resources are limited.
+        frame = self.frame_buffer.borrow(timeout)
+        if frame is not None and webcam_flipped and frame[0].ndim == 3:# gray crops were flipped before cropping
+            self._flip(frame[0])
         return frame
+
+    def _flip(self, image):
+        """ flip in place"""
+        if (cfg.WEBCAM_HFLIP and cfg.WEBCAM_VFLIP):
+            cv2.flip(image, -1, dst=image)
+        elif cfg.WEBCAM_HFLIP:
+            cv2.flip(image, 1, dst=image)
+        elif cfg.WEBCAM_VFLIP:
+            cv2.flip(image, 0, dst=image)
+
+    def _crop_gray(self, image, roi, idx, slot):
+        """ convert the motion tracking area of a full frame to gray in the buffer slot"""
+        x_left, x_right, y_upper, y_lower = roi
+        image_crop = image[y_upper:y_lower, x_left:x_right]
+        if slot is not None and slot.shape == image_crop.shape[:2]:
+            cv2.cvtColor(image_crop, cv2.COLOR_BGR2GRAY, dst=slot)
+        else:# first frame or the field of view has changed
+            self.frame_buffer.store(idx, cv2.cvtColor(image_crop, cv2.COLOR_BGR2GRAY))
+
+    def set_roi(self, rect):
+        """ set the motion tracking area (x_left, x_right, y_upper, y_lower).
+        With gray_roi, from now on only the gray crop of this area is queued"""
+        if self.gray_roi:
+            self.roi = tuple(int(v) for v in rect)
+            self.frame_buffer.discard_queued()# cropped to the old area, if any
+
+    def get_full_frame(self, timestamp):
+        """ return a copy of the full colour frame nearest to timestamp when only gray crops are queued"""
+        image, found = self.full_frames.find(timestamp)
+        if image is not None and abs(found - timestamp) > 1E-3:
+            overlayLogger.debug("Full frame for %.3f not kept, using %.3f", timestamp, found)
+        return image
+
+    def get_evidence_frame(self, timestamp):
+        """ return a copy of the evidence stream frame nearest to timestamp,
+        or None if there is no evidence stream or nothing close enough"""
+        if self.evidence is None:
+            return None
+        image, found = self.evidence.full_frames.find(timestamp, cfg.WEBCAM_EVIDENCE_TOLERANCE)
+        if image is None:
+            overlayLogger.warn("No evidence frame within %.2f s of %.3f", cfg.WEBCAM_EVIDENCE_TOLERANCE, timestamp)
+        elif webcam_flipped:# only the frames actually used are flipped
+            self._flip(image)
+        return image
         
     def stop(self):
         """ indicate that the thread should be stopped """
         self.stopped = True
+        self.frame_buffer.close()# in case the thread is blocked waiting for a free slot
         if self.saveStream:
             self._close_writer()
         # wait until stream resources are released (producer thread might be still grabbing frame)
         if self.vs_thread is not None:
             self.vs_thread.join(2.0)  # properly handle thread exit
+        if self.evidence is not None:
+            self.evidence.stop()
 
     def isOpened(self):
         return self.cam_stream.isOpened()
 
+    def log_buffer_stats(self):
+        stats=self.frame_buffer.stats()
+        overlayLogger.debug("Frame buffer %s %i/%i slots in use (high water %i), %i of %i frames dropped, %i skipped",
+                            stats['policy'], stats['occupancy'], stats['slots'], stats['high_water'],
+                            stats['dropped'], stats['written']+stats['dropped'], stats['skipped'])
+        for (name, stream) in (("Full frame", self), ("Evidence frame", self.evidence)):
+            if stream is not None and stream.full_frames is not None:
+                stats=stream.full_frames.stats()
+                overlayLogger.debug("%s store %i slots, %i of %i lookups missed, oldest frame kept %i times",
+                                    name, stats['slots'], stats['misses'], stats['lookups'], stats['kept'])
+
+    def request_skip(self, frames=None, until=None):
+        """ skip frames without decoding them, see FrameRingBuffer.request_skip"""
+        self.frame_buffer.request_skip(frames, until)
+
     def __get_initial_fps(self,cam):
         """Provides an estimate of the actual frame rate being received"""
         # Start time
@@ -484,6 +727,7 @@ class WebcamVideoStream:
                     overlayLogger.debug("File reports %.2f fps", self.fps)
                 else:    
                     overlayLogger.debug("Reading at %.2f fps over last %i frames", self.fps, self.frame_count)
+                self.log_buffer_stats()
 
             self.frame_count = 0
             self.fps_start_time = time.time()# reset time for next count
@@ -587,9 +831,14 @@ def init_settings():
               % (cfg.max_speed_over, rc.speed_units))
         #print("                  If  event_timeout > %.2f seconds Start New Track"
          #     % (cfg.event_timeout))
-        print("                  track_timeout=%.2f sec wait after Track Ends"
-              " (avoid retrack of same object)"
-              % (cfg.track_timeout))
+        if cfg.concurrent_tracking:
+            print("                  track_timeout=%.2f sec a tracked object is ignored after it was last seen"
+                  " (avoid retrack of same object)"
+                  % (cfg.track_timeout))
+        else:
+            print("                  track_timeout=%.2f sec wait after Track Ends"
+                  " (avoid retrack of same object)"
+                  % (cfg.track_timeout))
         print("Speed Photo ..... Size=%ix%i px  image_bigger=%.1f"
               "  rotation=%i  VFlip=%s  HFlip=%s "
               % (image_width, image_height, cfg.image_bigger,
@@ -651,7 +900,8 @@ def logging_notifications():
 
         if cfg.gui_window_on:
             appLogger.info("To quit,press q on GUI window or ctrl-c in this terminal")
-            
+        elif cfg.headless:
+            appLogger.info("Headless, to quit send SIGTERM (eg systemctl stop) or press ctrl-c")
         else:
             appLogger.info("To quit,press ctrl-c in this terminal ")
     else:
@@ -665,76 +915,82 @@ def logging_notifications():
 class Vehicle(object):
     """Creates object to hold separate vehicle properties"""
     def __init__(self,x,y,w,h,centroid, dir,found_area,frame):
-        self.track_list=[] # list of tracking co-ordinates etc. 
-        self.track_record=self.TrackRecord(x,y,w,h,centroid,dir,found_area,frame )
-        self.cur_track_x = x
-        self.cur_track_y = y
-        self.prev_track_x=x
-        self.prev_track_y=y
-        
+        self.track=TrackBuffer() # the tracking co-ordinates etc, a row per frame
         self.track_w = w  # movement width of object contour
         self.track_h = h  # movement height of object contour
         self.biggest_area = found_area
-        self.cur_track_time = frame[1]
-        self.speed_list=[]
+        self.speed_stats=RunningStats(cfg.speed_outlier_sigma, cfg.speed_outlier_min)# the speed samples of the track
         self.travel_direction=None
-        self._add_tracking_record(self.track_record)
-        self.active=True
+        self._add_tracking_record(x,y,w,h,centroid,dir,found_area,frame)
+        self.centroid=centroid# where it was last matched to a blob
+        self.last_seen=frame[1]# time it was last matched to a blob
+        self.box=(x,y,w,h)# the blob it was last matched to
+        self.predictor=None# where the centroid is expected next, for the kalman predictor
+        if cfg.predictor == 'kalman':
+            self.predictor=KalmanPredictor(frame[1], centroid[0], centroid[1], cfg.kalman_measurement_sigma,
+                                           cfg.kalman_accel_sigma, cfg.kalman_speed_sigma)
+        self.first_event = True   # Start a New Motion Track
+        self.start_pos_x = 0
+        self.end_pos_x = 0
+        self.prev_pos_x = 0
+        self.prev_start_time=0
+        self.track_start_time=0
+        self.fit_start=0# first row of the track for the fit speed engine
+        self.state=TENTATIVE
         self.FinalSpeed=0
         self.StdDev=0
         self.MoE=0
           
-    def _add_tracking_record(self,track ):
-        
-        self.track_list.append(track)
-        if len(self.track_list)>1:
-            self.track_list[-1].prev_track_x=self.track_list[-2].cur_track_x#hold the old values
-            self.track_list[-1].prev_track_y= self.track_list[-2].cur_track_y
-        self.cur_track_x= track.cur_track_x
-        self.cur_track_y= track.cur_track_y
-        self.cur_track_time= track.track_time
-        
-    def _remove_tracking_record(self,pos):
-        try:
-            self.track_list.pop(pos)
-        except:
-            pass
-        
+    def _add_tracking_record(self,x,y,w,h,centroid,dir,found_area,frame):
+        if x==0:# there is a state when direction is unknown, but is actually left to right
+            x=x+w #in this mode we want to track the rh edge of the contour, so add the width to the x pos. 
+        #N.B. this state can also occur when very large objects track r2l, so the x position reaches zero. 
+        #But this is rare and we just have to suck it up.It will invalidate the track position.
+        self.track.append(x, y, w, h, centroid[0], centroid[1], found_area, frame[1], DIRECTIONS.get(dir, UNKNOWN))
+
     def clear_tracking_list(self):
         
-        self.track_list.clear()
-
-    def _get_tracking_record(self,pos):
-        return self.track_list[pos]
-
-    class TrackRecord(object):
-        def __init__(self,x,y,w,h,centroid,dir,found_area,frame):
-            if x==0:# there is a state when direction is unknown, but is actually left to right
-                x=x+w #in this mode we want to track the rh edge of the contour, so add the width to the x pos. 
-            #N.B. this state can also occur when very large objects track r2l, so the x position reaches zero. 
-            #But this is rare and we just have to suck it up.It will invalidate the track position.
-            self.cur_track_x = x
-            self.cur_track_y = y
-            self.prev_track_x=x
-            self.prev_track_y=y
-            self.track_w = w  # movement width of object contour
-            self.track_h = h  # movement height of object contour
-            self.centroid=centroid
-            self.biggest_area = found_area
-            self.track_time = frame[1]
-            self.direction=dir
+        self.track.clear()
+
+    @property
+    def active(self):
+        """ still being measured"""
+        return self.state in (TENTATIVE, CONFIRMED)
+
+    # the latest row of the track, as plain python values so they can go straight into the speed records
+    @property
+    def cur_track_x(self):
+        return int(self.track['x'][-1])
+
+    @property
+    def cur_track_y(self):
+        return int(self.track['y'][-1])
+
+    @property
+    def prev_track_x(self):
+        return int(self.track['x'][-2 if len(self.track) > 1 else -1])
+
+    @property
+    def cur_track_time(self):
+        return float(self.track['t'][-1])
+
+    @property
+    def direction(self):
+        return DIRECTION_NAMES[int(self.track['dir'][-1])]
+
+    @property
+    def cur_track_size(self):
+        """area of the bounding box of the latest blob"""
+        return int(self.track['w'][-1]) * int(self.track['h'][-1])
             
 #------------------------------------------------------------------------------
 class SpeedTrack(object):
     #TODO this class is too big and needs breaking down
-    def __init__(self,isFile, rect,image_path):
+    def __init__(self,isFile, rect,image_path, record_sink=None):
         self.is_file_src=isFile
+        self.record_sink=record_sink # if a list, speed records are collected in it instead of being written
         self.ave_speed = 0.0
         self.frame_count = 0
-        self.first_event = True   # Start a New Motion Track
-        self.vehicle_start_pos_x = 0
-        self.vehicle_end_pos_x = 0
-        self.vehicle_prev_pos_x = 0
         #self.travel_direction = None
         self.event_timer = None
         self.last_frame_seen=0
@@ -743,12 +999,47 @@ class SpeedTrack(object):
         self.speed_path = image_path
         self.font = cv2.FONT_HERSHEY_SIMPLEX
         self.lastSpaceCheck = datetime.datetime.now()
-        self.prev_start_time=0
-        self.track_start_time=0
         self.fps_time = time.time()
+        self.cpu_time = time.process_time()
         self.speed_db=None
         self.vehicles=[] # to hold a list of vehicles being tracked
-        self.skip_frames=0# used to prevent dual tracking
+        self.skip_until=0# frames before this timestamp are skipped, used to prevent dual tracking
+        self.blackout_until=0# with concurrent_tracking, when the skip would have ended
+        self.blackout_saves=0# vehicles tracked that the skip after the last track would have missed
+        self.track_counts=Counter()# vehicles created, confirmed, finished, lost, evicted (once finished), refused, and blobs that are pieces of or trailing another
+        self.peak_live_tracks=0
+        self._full_image=None# (timestamp, image) full frame looked up for a gray crop
+        self.workspace=None# gray frames the contour pipeline works on, sized to the tracking area
+        self.detector=create_detector(cfg)# motion detection front end of the contour pipeline
+        overlayLogger.info("Motion detector %s (%s)", self.detector.name, self.detector.cost)
+        if cfg.speed_engine not in SPEED_ENGINES:
+            raise ValueError("Unknown speed engine %s, use one of %s" % (cfg.speed_engine, ', '.join(SPEED_ENGINES)))
+        self.phase=None# measures the speed from the sub-pixel shift between frames rather than the contour edges
+        if cfg.speed_engine == 'phase':
+            self.phase=PhaseCorrelator(cfg.phase_min_response)
+        self.fit_speed = cfg.speed_engine == 'fit'# the speed is the slope of a line fitted to the whole track
+        self.gray_frames=(None, 0, None, 0)# (previous gray crop, its time, current gray crop, its time)
+        self.assignment=cfg.assignment# how blobs are matched to the vehicles
+        if self.assignment not in ASSIGNMENT_METHODS:
+            raise ValueError("Unknown assignment %s, use one of %s" % (self.assignment, ', '.join(ASSIGNMENT_METHODS)))
+        if cfg.predictor not in PREDICTORS:
+            raise ValueError("Unknown predictor %s, use one of %s" % (cfg.predictor, ', '.join(PREDICTORS)))
+        if self.assignment == 'hungarian' and linear_sum_assignment is None:
+            overlayLogger.warning("hungarian assignment needs scipy, which is not installed. Using greedy")
+            self.assignment = 'greedy'
+        self.motion_gate=None# cheap check that skips the contour pipeline when nothing is moving
+        if cfg.motion_gate:
+            self.motion_gate=MotionGate(cfg.motion_gate_decimate, cfg.motion_gate_threshold,
+                                        cfg.motion_gate_noise_factor, cfg.motion_gate_min_pixels,
+                                        max_pixels=cfg.MIN_AREA / cfg.motion_gate_decimate**2)
+        self.adaptive_roi=None# searches just around the tracked vehicles while there are any
+        if cfg.adaptive_roi:
+            if self.detector.windowed:
+                self.adaptive_roi=AdaptiveRoi(cfg.roi_padding, cfg.roi_full_scan_interval, cfg.MIN_AREA,
+                                              cfg.roi_entry_width)
+            else:
+                overlayLogger.warning("The %s detector models the whole background, adaptive_roi needs canny or projection. Searching the whole area",
+                                      self.detector.name)
         self.FoV_x_left=rect[0]# the coordinates of the field of view mask
         self.FoV_x_right=rect[1]
         self.FoV_y_upper=rect[2]
@@ -770,7 +1061,7 @@ class SpeedTrack(object):
         """ Main speed tracking processing function """
         # Initialize prev_image used for taking speed image photo
         if cfg.log_data_to_DB:
-            self.speed_db=SpeedDB( db_path)
+            self.speed_db=SpeedDB(db_path, cfg)
         logging_notifications()
         rd=FoVDrawer("jeff")
         mask_rect=rd.load_mask()
@@ -779,6 +1070,7 @@ class SpeedTrack(object):
             self.FoV_x_right= mask_rect[0]+mask_rect[2]
             self.FoV_y_upper = mask_rect[1]
             self.FoV_y_lower=mask_rect[1]+mask_rect[3]
+        vs.set_roi((self.FoV_x_left, self.FoV_x_right, self.FoV_y_upper, self.FoV_y_lower))# the camera thread may crop it
                 
         # Warn user of performance hit if webcam image flipped
         if (webcam and webcam_flipped):
@@ -787,9 +1079,10 @@ class SpeedTrack(object):
             overlayLogger.warn("If necessary physically flip camera and")
             overlayLogger.warn("Set config.py WEBCAM_HFLIP and WEBCAM_VFLIP to False")
         mainwin='Movement (q Quits)'
-        cv2.namedWindow(mainwin)# create a window to hold the main image
-        #(x,y,w,h)=cv2.getWindowImageRect(mainwin)
-        cv2.moveWindow(mainwin, 150,150)
+        if cfg.gui_window_on:# no HighGUI at all when headless, there may be no X server
+            cv2.namedWindow(mainwin)# create a window to hold the main image
+            #(x,y,w,h)=cv2.getWindowImageRect(mainwin)
+            cv2.moveWindow(mainwin, 150,150)
         #self.contourwin="Contours"
         #cv2.namedWindow(self.contourwin)
         #cv2.moveWindow(self.contourwin, xwin-400,ywin)
@@ -802,110 +1095,37 @@ class SpeedTrack(object):
             #image_sign_view = cv2.resize(image_sign_bg, (image_sign_resize))
             #image_sign_view_time = time.time()
         veh=None
+        self.replay_start_time = time.time()
         
         while still_scanning:  # process camera thread images and calculate speed
             #if we need to wait for eg vehicles to clear after counting, this reduces dual counting
                 
-            frame=vs.read()# Read frame data from video steam thread instance
+            frame=vs.read(cfg.read_timeout)# Wait for frame data from video steam thread instance
             if frame is not None:
-                image2 = frame[0].copy() # extract image from tuple and copy to prevent overwrite during processing
+                self.frame_count += 1
+                image = frame[0] # extract image from tuple, the buffer slot is ours until the next read so no copy needed
+                # only the gray crop may have been queued, the full frame is looked up if it's displayed.
+                # The display is drawn on a copy, the full frame is kept clean for the speed photos
+                image2 = self._full_frame(frame).copy() if cfg.gui_window_on else image
                 
-                #process the frame for contours within the cropped area
-                if self.skip_frames == 0:    
-                    grayimage1, contours = self.speed_get_contours(image2, grayimage1)
-                    # if contours found, find the one with biggest area
-                    # the assumption is that the vehicle is the largest object in the frame
-                    if contours:
-                        total_contours = len(contours)
-                        orphan_contours=[]
-                        contour_count=0
-                        valid_contours=0
-                        for contour in contours:
-                            contour_count+=1
-                            valid_contour = False
-                            
-                            # get area of contour
-                            if self.validate_contour(contour) ==errors.ERROR_SUCCESS:
-                                valid_contour=True
-                                valid_contours+=1
-                                    
-                            if valid_contour :
-                                found_area = cv2.contourArea(contour)
-                                (x, y, w, h) = cv2.boundingRect(contour)
-                                centroid = self.get_centroid(x, y, w, h)
-                                # now find closest track match in existing vehicles ( if any)
-                                if len(self.vehicles) > 0 :
-                                
-                                    for veh in self.vehicles:
-                                        ret=self._check_centroid_dist(veh, centroid)# is this valid and belonging to this vehicle?
-
-                                        if ret == errors.ERROR_X_SHIFT_TOO_LARGE or ret== errors.ERROR_Y_SHIFT_TOO_LARGE:
-                                            try:
-                                                for cont in orphan_contours:
-                                                    if contour ==cont:#avoid duplicates
-                                                        continue
-                                                    else:
-                                                        orphan_contours.append(contour)#add to a temp list
-                                            except Exception as e: 
-                                                overlayLogger.error("contour error",e)
-                                                continue
-                                            #break
-                                        if ret== errors.ERROR_SUCCESS:
-                                            try:
-                                                if len(orphan_contours) >0:
-                                                    cont=orphan_contours.pop(-1)# found contour match so  remove entry    
-                                                dir=self._get_direction(veh,centroid)
-                                                isSameDir= self._check_direction(veh,centroid)
-                                                if isSameDir:# its the same way so add another record
-                                                    if veh.active:
-                                                        if dir=="L2R":
-                                                            x=x+w
-                                                            if x>=self.FoV_x_right-self.FoV_x_left:# the width of the cropped area
-                                                                continue #hit the end so don't add
-                                                        else:
-                                                            if x<=0:# assume the start of cropped area x is 0
-                                                                continue
-                                                        veh._add_tracking_record(Vehicle.TrackRecord(x,y,w,h,centroid,dir,found_area,frame))
-                                                    break # found it so we can skip other vehicles
-                                            except Exception as e:
-                                                continue    
-                                        if ret== errors.ERROR_X_SHIFT_TOO_SMALL:
-                                            continue # the contour is identical            
-                                else: # the first one
-                                    dir=None
-                                    veh=Vehicle(x,y,w,h,centroid,dir,found_area,frame)#assign id to vehicle
-                                    dir=self._get_direction(veh,centroid)
-                                    if dir=="L2R":# we want the rh side of the contour to be tracked
-                                        veh.track_list[-1].cur_track_x=x+w
-                                    veh.track_list[-1].direction=dir
-                                    self.last_frame_seen = frame[1]
-                                    self.first_event = True
-                                    self.vehicles.append(veh)
-                                            
-                                self.process_motion_events(veh,total_contours,frame)
-
-                                if cfg.gui_window_on:
-                                    # show small circle at contour xy if required
-                                    if SHOW_CIRCLE:
-                                        cv2.circle(image2,
-                                                (int(veh.cur_track_x + self.FoV_x_left * cfg.window_bigger),
-                                                int(veh.cur_track_y + self.FoV_y_upper * cfg.window_bigger)),
-                                                CIRCLE_SIZE, colours.cvGreen, LINE_THICKNESS)
-                                    if SHOW_RECTANGLE:
-                                        # otherwise a rectangle around most recent contour
-                                        cv2.rectangle(image2,
-                                                    (int(self.FoV_x_left + veh.cur_track_x),
-                                                    int(self.FoV_y_upper + veh.cur_track_y)),
-                                                    (int(self.FoV_x_left + veh.cur_track_x + veh.track_w),
-                                                    int(self.FoV_y_upper + veh.cur_track_y + veh.track_h)),
-                                                    colours.cvRed, LINE_THICKNESS)
-                        if len(orphan_contours) >0:#new vehicle?
-                                    self.vehicles.append(Vehicle(x,y,w,h,centroid,None,found_area,frame))#
-                                    orphan_contours.pop(-1)# remove last entry    
-                        if valid_contours==0:
-                            self.vehicles.clear()
-                else:#skip frames
-                    self.skip_frames-=1 # this will be caught at zero
+                #process the frame for moving blobs within the cropped area
+                if frame[1] >= self.skip_until:
+                    previous=(grayimage1, self.gray_frames[3])
+                    grayimage1, blobs = self.speed_get_blobs(image, grayimage1, frame[1])
+                    self.gray_frames=previous + (grayimage1, frame[1])
+                    total_contours = len(blobs.area)
+                    valid = self.valid_blobs(blobs) if total_contours else NO_BLOBS
+                    if len(valid.area):
+                        if cfg.gui_window_on:# only worth drawing if someone is watching
+                            for (x, y, w, h) in zip(valid.x.tolist(), valid.y.tolist(), valid.w.tolist(), valid.h.tolist()):
+                                cv2.rectangle(image2, (self.FoV_x_left + x, self.FoV_y_upper + y),
+                                              (self.FoV_x_left + x + w, self.FoV_y_upper + y + h), colours.cvGreen, 3)
+                        self.track_blobs(valid, total_contours, frame, image2)
+                    else:
+                        self._evict_vehicles(frame[1])# no blobs, but a vehicle may only be missing for a frame
+                        if self.motion_gate is not None:# what the gate saw was noise
+                            self.motion_gate.no_motion()
+                #else skip the frame, only seen here if the GUI needs it or it was queued before the skip was requested
                 if cfg.gui_window_on:
                     #cv2.imshow('Difference Image',difference image)
                     image2 = self.speed_image_add_lines(image2, colours.cvRed)
@@ -913,24 +1133,39 @@ class SpeedTrack(object):
                     image_view = cv2.resize(image2, (image_width, image_height))
                     if cfg.gui_show_camera:
                         cv2.imshow(mainwin, image_view)
-                    if cfg.show_thresh_on:
-                        cv2.imshow('Threshold', differenceimage)
+                    if cfg.show_thresh_on and self.detector.view is not None:
+                        cv2.imshow('Threshold', self.detector.view)
                     if cfg.show_crop_on:
                         image_crop = image2[self.FoV_y_upper:self.FoV_y_lower, self.FoV_x_left:self.FoV_x_right]
                         cv2.imshow('Crop Area', image_crop)
-                    
-                else:
-                    self.vehicles.clear()# no contours so no vehicles
             else:
                 if vs.stopped:
+                    if self.is_file_src:
+                        duration = time.time() - self.replay_start_time
+                        overlayLogger.info("Processed %i frames of %s in %.1f s (%.1f fps)", self.frame_count,
+                                           cfg.source_file_name, duration, self.frame_count / max(duration, 1E-6))
+                        self._log_motion_gate()
+                        self._log_adaptive_roi()
+                        self._log_blackout_saves()
+                        self._log_track_counts()
                     return -1   # the source may have stopped.
-            key= cv2.waitKey(1)
+            if stop_requested.is_set():# stopped by a signal eg systemd stop, there are no keys when headless
+                overlayLogger.info("End Motion Tracking ......")
+                still_scanning = False
+                vs.stop()
+                break
+            key = -1
+            if cfg.gui_window_on:# no window, no keys
+                key= cv2.waitKey(1)
             
             if key == ord('m'):# invoke the mask drawer
                 (x1,y1,w1,h1)=cv2.selectROI("Select",image2,False)
                 cv2.destroyWindow('Select')
                 if w1*h1 ==0:# nothing selected
                     continue
+                if sg is None:
+                    overlayLogger.warn("PySimpleGUI is not installed, cannot confirm saving the mask")
+                    continue
                 rd=FoVDrawer("jeff")
                 msg="Do you want to save this mask?"
                 title = "Please confirm"
@@ -946,6 +1181,7 @@ class SpeedTrack(object):
                     self.FoV_x_right=x1+w1
                     self.FoV_y_lower =y1+h1
                     self.FoV_y_upper=y1
+                    vs.set_roi((self.FoV_x_left, self.FoV_x_right, self.FoV_y_upper, self.FoV_y_lower))
                     grayimage1=self.get_init_image()
                 
                
@@ -956,20 +1192,65 @@ class SpeedTrack(object):
                 vs.stop()
                 
                 break
-            if self.is_file_src:
+            if cfg.log_fps:
+                self._log_cpu_load()
+            if self.is_file_src and not cfg.file_replay_fast:# replay at the recorded rate, timing comes from the file anyway
                 time.sleep(1.0 / vs.fps)
 
         raise KeyboardInterrupt()
     
-    def speed_image_add_lines(self,image, color):
-        cv2.line(image, (self.FoV_x_left, self.FoV_y_upper),
-                (self.FoV_x_right, self.FoV_y_upper), color, 1)
-        cv2.line(image, (self.FoV_x_left, self.FoV_y_lower),
-                (self.FoV_x_right, self.FoV_y_lower), color, 1)
-        cv2.line(image, (self.FoV_x_left, self.FoV_y_upper),
-                (self.FoV_x_left, self.FoV_y_lower), color, 1)
-        cv2.line(image, (self.FoV_x_right, self.FoV_y_upper),
-                (self.FoV_x_right, self.FoV_y_lower), color, 1)
+    def _log_cpu_load(self, interval=30):
+        """Periodically log the CPU used by the whole process (capture and tracking threads) as % of one core"""
+        duration = time.time() - self.fps_time
+        if duration >= interval:
+            cpu_load = (time.process_time() - self.cpu_time) / duration * 100
+            overlayLogger.debug("CPU load %.1f%% of one core over last %.0f s", cpu_load, duration)
+            self._log_motion_gate()
+            self._log_adaptive_roi()
+            self._log_blackout_saves()
+            self._log_track_counts()
+            self.fps_time = time.time()
+            self.cpu_time = time.process_time()
+
+    def _log_motion_gate(self):
+        if self.motion_gate is not None:
+            stats = self.motion_gate.stats()
+            overlayLogger.info("Motion gate skipped %i frames, %i passed, %i while tracking (noise floor %.1f px, limit %.1f px)",
+                               stats['gated'], stats['passed'], stats['bypassed'], stats['noise_floor'], stats['limit'])
+
+    def _log_adaptive_roi(self):
+        if self.adaptive_roi is not None:
+            stats = self.adaptive_roi.stats()
+            overlayLogger.info("Adaptive ROI searched %i frames in windows, %i in full (%i rescans of cut blobs), %.0f%% of the pixels",
+                               stats['windowed'], stats['full_scans'], stats['rescans'], stats['searched'] * 100)
+
+    def _log_blackout_saves(self):
+        if cfg.concurrent_tracking and cfg.track_timeout > 0:
+            overlayLogger.info("Concurrent tracking, %i vehicles tracked that the %.2f s skip after a track would have missed",
+                               self.blackout_saves, cfg.track_timeout)
+
+    def _log_track_counts(self):
+        overlayLogger.info("Tracks %i live, %i held (peak %i), %i created, %i confirmed, %i finished, %i lost, %i refused,"
+                           " %i blobs pieces of another, %i trailing another",
+                           sum(veh.active for veh in self.vehicles), len(self.vehicles), self.peak_live_tracks,
+                           self.track_counts['created'], self.track_counts[CONFIRMED], self.track_counts[FINISHED],
+                           self.track_counts[LOST], self.track_counts['refused'], self.track_counts['pieces'],
+                           self.track_counts['trailing'])
+
+    def speed_image_add_lines(self,image, color, scale=(1.0, 1.0)):
+        """ draw the motion tracking area, scale (x, y) is for an image bigger than the motion stream"""
+        x_left = int(self.FoV_x_left * scale[0])
+        x_right = int(self.FoV_x_right * scale[0])
+        y_upper = int(self.FoV_y_upper * scale[1])
+        y_lower = int(self.FoV_y_lower * scale[1])
+        cv2.line(image, (x_left, y_upper),
+                (x_right, y_upper), color, 1)
+        cv2.line(image, (x_left, y_lower),
+                (x_right, y_lower), color, 1)
+        cv2.line(image, (x_left, y_upper),
+                (x_left, y_lower), color, 1)
+        cv2.line(image, (x_right, y_upper),
+                (x_right, y_lower), color, 1)
         return image
 
     def create_cal_lines(self,cal_image):
@@ -1033,14 +1314,29 @@ class SpeedTrack(object):
         return cal_image
 
 
+    def _full_frame(self, frame):
+        """ full colour image for a (image, timestamp) frame.
+        If the camera thread only queued the gray crop, the full frame is looked up once, when first needed"""
+        if frame[0].ndim == 3:
+            return frame[0]
+        if self._full_image is None or self._full_image[0] != frame[1]:
+            image = vs.get_full_frame(frame[1])
+            if image is None:# not kept, show what we have
+                image = cv2.cvtColor(frame[0], cv2.COLOR_GRAY2BGR)
+            self._full_image = (frame[1], image)
+        return self._full_image[1]
+
     def get_init_image(self):
         try:
-            frame=vs.read() #get frame and timestamp fro videostream thread
+            frame=vs.read(5.0) #get frame and timestamp fro videostream thread, allow for it starting up
             image2 = frame[0]  # extract image info from tuple
-            col_processed_img=image2.copy()
+            if image2.ndim == 2:# already cropped and converted by the camera thread
+                grayimage1 = self._workspace(image2.shape).grays[0]
+                np.copyto(grayimage1, image2)# the buffer slot is reused after the next read
+                return grayimage1
         
             # initialise crop image to motion tracking area only
-            #cv2.imshow("diff",col_processed_img) #debug
+            #cv2.imshow("diff",image2) #debug
             image_crop = image2[self.FoV_y_upper:self.FoV_y_lower, self.FoV_x_left:self.FoV_x_right]
             #cv2.imshow("Cropped", image_crop)#debug
         except Exception as ex:
@@ -1049,27 +1345,33 @@ class SpeedTrack(object):
             overlayLogger.warn("Restarting Camera.  One Moment Please ...")
             time.sleep(4)
             return None
-        grayimage1 = cv2.cvtColor(image_crop, cv2.COLOR_BGR2GRAY)
-        return grayimage1
+        return cv2.cvtColor(image_crop, cv2.COLOR_BGR2GRAY, dst=self._workspace(image_crop.shape).grays[0])
+
+    def _workspace(self, shape):
+        """ the contour pipeline buffers for a gray crop this shape, only rebuilt when the tracking area changes"""
+        if self.workspace is None or not self.workspace.fits(shape):
+            self.workspace = ContourWorkspace(shape)
+            self.detector.allocate(self.workspace.shape)
+        return self.workspace
         
 
-    def is_valid_vector(self,veh,vector):
-        #deal with the first entry case
-        if veh.track_list[-1].vector==None:
-            return True
-        pass
-    
-    def validate_contour(self,contour):
-        if not self._check_area(contour) :
-            return errors.ERROR_AREA_TOO_SMALL  
-        #if not self._check_x_bounds(contour):
-            #return errors.ERROR_OUT_OF_RANGE  
-     
-        return errors.ERROR_SUCCESS                                            
+    def valid_blobs(self, blobs):
+        """ the blobs that could be vehicles, filtered with masks over the whole set rather than one by one"""
+        # filters the blobs to avoid small objects
+        blobs = select_blobs(blobs, blobs.area > cfg.MIN_AREA)
+        if len(blobs.area) < 2:
+            return blobs
+        # drop a blob whose bounding box is inside that of a bigger blob, eg a window of the vehicle
+        x_right = blobs.x + blobs.w
+        y_lower = blobs.y + blobs.h
+        inside = ((blobs.x[:, None] >= blobs.x) & (x_right[:, None] <= x_right)
+                  & (blobs.y[:, None] >= blobs.y) & (y_lower[:, None] <= y_lower)
+                  & (blobs.area[:, None] < blobs.area))
+        return select_blobs(blobs, ~inside.any(axis=1))
 
     def _get_direction(self,veh:Vehicle,centroid):
         x_pos,ypos=centroid
-        x_pos_old=veh.track_list[-len(veh.track_list)].centroid[0]
+        x_pos_old=veh.track['cx'][0]
                 #this is the first time
         if x_pos>x_pos_old:# check the xpos
             travel_direction="L2R"
@@ -1084,35 +1386,6 @@ class SpeedTrack(object):
         y1 = h // 2
         return(x+x1, y+y1)
     
-    def _check_area(self,contour):
-        biggest_area = cfg.MIN_AREA
-        found_area = cv2.contourArea(contour)
-        if found_area > biggest_area: #filters the contour to avoid small objects 
-            return True
-        return False    
-
-    def _check_x_bounds(self,contour):
-        # x,y is top left of rect
-        (x, y, w, h) = cv2.boundingRect(contour)
-        # check if object contour is completely within crop area
-        # the whole object does not have to be visible to be counted, but
-        #large vehicles may fill the crop area
-        if (x > 1 and (x + w) < (self.FoV_x_left+1 )):
-            return True
-        return False    
-
-    def _check_centroid_dist(self,veh : Vehicle,centroid):
-        if veh==None:
-            return errors.ERROR_OUT_OF_RANGE
-        if abs(centroid[0]-veh.track_list[-1].centroid[0]) < constants.X_DIFF_MIN:
-            return errors.ERROR_X_SHIFT_TOO_SMALL
-        if abs(centroid[0]-veh.track_list[-1].centroid[0]) > constants.X_DIFF_MAX:
-            return errors.ERROR_X_SHIFT_TOO_LARGE
-        if abs(centroid[1]-veh.track_list[-1].centroid[1]) > constants.Y_DIFF_MAX:
-            return errors.ERROR_Y_SHIFT_TOO_LARGE
-        return errors.ERROR_SUCCESS
-        
-    
     def _check_x_dist(self,veh,chk_x):
         if veh==None:
             return errors.ERROR_OUT_OF_RANGE
@@ -1124,93 +1397,294 @@ class SpeedTrack(object):
      
     def process_motion_events(self,veh,total_contours,frame):
         #TODO: lots of redundant/unused code in the vehicle class to get rid of. 
-        if self.first_event:   # This is a first valid motion event
-            self.first_event = False  # Only one first track event
-            self.track_start_time = veh.cur_track_time # Record track start time
-            self.prev_start_time = veh.cur_track_time
-            self.vehicle_start_pos_x = veh.cur_track_x
-            self.vehicle_prev_pos_x = veh.prev_track_x
-            self.vehicle_end_pos_x = veh.cur_track_x
+        if veh.first_event:   # This is a first valid motion event
+            veh.first_event = False  # Only one first track event
+            veh.track_start_time = veh.cur_track_time # Record track start time
+            veh.prev_start_time = veh.cur_track_time
+            veh.start_pos_x = veh.cur_track_x
+            veh.prev_pos_x = veh.prev_track_x
+            veh.end_pos_x = veh.cur_track_x
+            veh.fit_start = len(veh.track)-1
             overlayLogger.debug("New detection at xy(%i,%i), starting new track 1/%i",
                         veh.cur_track_x, veh.cur_track_y, cfg.track_counter )
             
-            veh.speed_list = []
+            veh.speed_stats.reset()
         else:
-            self.vehicle_prev_pos_x = self.vehicle_end_pos_x
-            self.vehicle_end_pos_x = veh.cur_track_x
+            veh.prev_pos_x = veh.end_pos_x
+            veh.end_pos_x = veh.cur_track_x
          
-            self.track_start_time = veh.cur_track_time # Record track start time
+            veh.track_start_time = veh.cur_track_time # Record track start time
             # check if movement is within acceptable distance range of last event
-            if self.check_movement_range(self.prev_start_time, veh, total_contours,frame)==True:
-                self.prev_start_time = veh.cur_track_time # hold the current time for next round
+            if self.check_movement_range(veh.prev_start_time, veh, total_contours,frame)==True:
+                veh.prev_start_time = veh.cur_track_time # hold the current time for next round
                 
-    def _check_direction(self,vehic:Vehicle,centroid):
-        if len(vehic.track_list)<=1:
-            return True
-        x_pos,ypos=centroid
-        x_pos_old=vehic.track_list[-1].centroid[0]
-        old_dir=vehic.track_list[-1].direction
-                #this is the first time
-        if x_pos>x_pos_old:# check the xpos
-            travel_direction="L2R"
+    def _phase_px_per_sec(self, veh):
+        """ speed in px/sec of the vehicle's region between the previous and current gray crops, by phase correlation.
+        None if there is no previous crop or the shift is unreliable or the wrong way"""
+        previous, prev_time, current, cur_time = self.gray_frames
+        if previous is None or not self.workspace.owns(previous) or cur_time <= prev_time:
+            return None
+        (cx, cy, w, h) = (int(veh.track[field][-1]) for field in ('cx', 'cy', 'w', 'h'))
+        rect = (cx - w // 2, cy - h // 2, w, h)
+        if rect[0] <= 0 or rect[0] + rect[2] >= current.shape[1]:# partly out of view, the shift would be short
+            return None
+        shift = self.phase.shift(previous, current, rect)
+        if shift is None or (shift[0] > 0) != (veh.direction == "L2R"):
+            return None
+        return float(abs(shift[0]) / (cur_time - prev_time))
+
+    def _track_fit(self, veh):
+        """ line fitted to the tracked edge positions since the track started, None if too few.
+        Rows from before the direction was known track the other edge, so they are left out"""
+        rows = veh.track.records[veh.fit_start:]
+        rows = rows[rows['dir'] == DIRECTIONS.get(veh.direction, UNKNOWN)]
+        return fit_track(rows['t'], rows['x'], cfg.fit_robust)
+
+    def track_blobs(self, blobs, total_contours, frame, image2):
+        """ match the blobs to the vehicles being tracked, extend their tracks and start new vehicles from the rest"""
+        # centroids as get_centroid, the centre of the bounding box
+        blob_x = blobs.x + blobs.w // 2
+        blob_y = blobs.y + blobs.h // 2
+        rows = cols = np.empty(0, dtype=np.intp)
+        if self.vehicles:
+            last_x = np.array([veh.centroid[0] for veh in self.vehicles])
+            directions = np.array([veh.track['dir'][-1] for veh in self.vehicles])
+            if cfg.predictor == 'kalman':# gate around where each vehicle should be now
+                (pred_x, pred_y, sigma_x, sigma_y) = (np.array(values) for values in
+                                                      zip(*[veh.predictor.predict(frame[1]) for veh in self.vehicles]))
+                # once the velocity is known the gate keeps the direction, a blob can wobble back a px as it comes into view
+                directions[[veh.predictor.updates >= 2 for veh in self.vehicles]] = UNKNOWN
+                # each pair gated by the bigger of the blob and the vehicle's last blob, either could be a piece
+                (half_w, half_h) = (np.maximum(np.array([veh.box[field] for veh in self.vehicles])[:, np.newaxis],
+                                               size[np.newaxis, :]) / 2 for (field, size) in ((2, blobs.w), (3, blobs.h)))
+                cost = cost_matrix(pred_x, pred_y, directions, blob_x, blob_y,
+                                   kalman_gate(sigma_x[:, np.newaxis], half_w, cfg.kalman_gate_sigma,
+                                               cfg.kalman_min_gate, constants.X_DIFF_MAX),
+                                   kalman_gate(sigma_y[:, np.newaxis], half_h, cfg.kalman_gate_sigma,
+                                               cfg.kalman_min_gate, constants.Y_DIFF_MAX),
+                                   last_x)
+            else:
+                cost = cost_matrix(last_x, np.array([veh.centroid[1] for veh in self.vehicles]), directions,
+                                   blob_x, blob_y, constants.X_DIFF_MAX, constants.Y_DIFF_MAX)
+            rows, cols = assign(cost, self.assignment)
+        matched = np.zeros(len(blobs.area), dtype=bool)
+        matched[cols] = True
+        if cfg.concurrent_tracking:
+            finished = [veh for veh in self.vehicles if not veh.active]
+            if finished and not matched.all():# the left over pieces of a finished vehicle aren't new vehicles
+                boxes = np.array([veh.box for veh in finished]).T
+                hits = overlaps(blobs.x, blobs.y, blobs.w, blobs.h, *boxes) & ~matched[:, np.newaxis]
+                for idx in np.flatnonzero(hits.any(axis=0)).tolist():
+                    finished[idx].last_seen = frame[1]# still in view
+                matched |= hits.any(axis=1)
+        pieces = self._piece_blobs(blobs, matched, frame[1])
+        # plain ints, the numpy ones would end up in the speed records
+        for row, col in zip(rows.tolist(), cols.tolist()):
+            self._extend_track(self.vehicles[row], *(int(field[col]) for field in blobs),
+                               total_contours=total_contours, frame=frame, image2=image2)
+        trailing = self._trailing_blobs(blobs, matched | pieces)
+        self.track_counts['trailing'] += int(trailing.sum())
+        self.track_counts['pieces'] += int(pieces.sum())
+        for col in np.flatnonzero(~(matched | pieces | trailing)).tolist():# in blob order, so it is repeatable
+            if len(self.vehicles) >= cfg.max_live_tracks and not self._make_room():
+                self.track_counts['refused'] += 1
+                continue
+            (x, y, w, h, found_area) = (int(field[col]) for field in blobs)
+            centroid = self.get_centroid(x, y, w, h)
+            veh=Vehicle(x,y,w,h,centroid,None,found_area,frame)#assign id to vehicle
+            self.last_frame_seen = frame[1]
+            self.vehicles.append(veh)
+            self.track_counts['created'] += 1
+            self.process_motion_events(veh,total_contours,frame)
+        self._evict_vehicles(frame[1])
+        self.peak_live_tracks = max(self.peak_live_tracks, len(self.vehicles))
+
+    def _trailing_blobs(self, blobs, matched):
+        """ mask of the unmatched blobs that are more of a confirmed or finished vehicle, those behind it within about
+        a vehicle length (the calibration object is usually one). eg canny finds the front and rear of a plain
+        vehicle as separate blobs, the rear isn't another vehicle"""
+        trailing = np.zeros(len(blobs.area), dtype=bool)
+        leading = [veh for veh in self.vehicles if veh.state in (CONFIRMED, FINISHED)]
+        if not leading or matched.all():
+            return trailing
+        length = {L2R: cfg.cal_obj_px_L2R, R2L: cfg.cal_obj_px_R2L}
+        boxes = np.array([trail_box(veh.box, int(veh.track['dir'][-1]), length.get(int(veh.track['dir'][-1]), 0))
+                          for veh in leading]).T
+        return overlaps(blobs.x, blobs.y, blobs.w, blobs.h, *boxes).any(axis=1) & ~matched
+
+    def _piece_blobs(self, blobs, matched, now):
+        """ mask of the unmatched blobs that overlap where a vehicle being measured is expected, its last blob moved
+        there. When a vehicle's blob splits, one piece is matched to it and the rest are more of it, not new vehicles"""
+        pieces = np.zeros(len(blobs.area), dtype=bool)
+        live = [idx for (idx, veh) in enumerate(self.vehicles) if veh.active]
+        if not live or matched.all():
+            return pieces
+        boxes = np.array(self._expected_boxes(now, gated=False))[live].T
+        return overlaps(blobs.x, blobs.y, blobs.w, blobs.h, *boxes).any(axis=1) & ~matched
+
+    def _expected_boxes(self, now, gated=True):
+        """ (x, y, w, h) where the blob of each vehicle held could be at time now, the last blob moved to anywhere
+        track_blobs would match it, or with gated False just to where it is expected.
+        The finished vehicles are followed too, until they are forgotten"""
+        boxes = []
+        for veh in self.vehicles:
+            (x, y, w, h) = veh.box
+            if veh.predictor is not None:
+                (cx, cy, sigma_x, sigma_y) = veh.predictor.predict(now)
+                gate_x = kalman_gate(sigma_x, w / 2, cfg.kalman_gate_sigma, cfg.kalman_min_gate, constants.X_DIFF_MAX)
+                gate_y = kalman_gate(sigma_y, h / 2, cfg.kalman_gate_sigma, cfg.kalman_min_gate, constants.Y_DIFF_MAX)
+            else:
+                (cx, cy) = veh.centroid
+                (gate_x, gate_y) = (constants.X_DIFF_MAX, constants.Y_DIFF_MAX)
+            if not gated:
+                (gate_x, gate_y) = (0, 0)
+            boxes.append((cx - w / 2 - gate_x, cy - h / 2 - gate_y, w + 2 * gate_x, h + 2 * gate_y))
+        return boxes
+
+    def _evict_vehicles(self, now):
+        """ drop the vehicles that have gone, by how long since each was last seen"""
+        kept = []
+        for veh in self.vehicles:
+            state = aged_state(veh.state, now - veh.last_seen, cfg.event_timeout, cfg.track_timeout)
+            if state == LOST:
+                veh.state = LOST
+                self.track_counts[LOST] += 1
+            elif state is None:
+                self.track_counts['evicted'] += 1
+            else:
+                kept.append(veh)
+        self.vehicles = kept
+
+    def _make_room(self):
+        """ drop the vehicle that matters least to make room for a new one, a finished then a tentative one
+        seen longest ago. False if all are confirmed"""
+        for state in (FINISHED, TENTATIVE):
+            candidates = [veh for veh in self.vehicles if veh.state == state]
+            if candidates:
+                veh = min(candidates, key=lambda veh: veh.last_seen)
+                self.vehicles.remove(veh)
+                self.track_counts['evicted' if state == FINISHED else LOST] += 1
+                return True
+        return False
+
+    def _extend_track(self, veh, x, y, w, h, found_area, total_contours, frame, image2):
+        """ add the blob matched to a vehicle to its track"""
+        centroid = self.get_centroid(x, y, w, h)
+        veh.last_seen = frame[1]
+        veh.box = (x, y, w, h)
+        if veh.predictor is not None:
+            veh.predictor.update(frame[1], centroid[0], centroid[1])
+        if abs(centroid[0]-veh.centroid[0]) < constants.X_DIFF_MIN:
+            return # the blob is identical
+        if not veh.active:# the track is finished, just follow it so it isn't taken for a new vehicle
+            veh.centroid = centroid
+            return
+        dir=self._get_direction(veh,centroid)
+        if dir=="L2R":
+            x=x+w
+            if x>=self.FoV_x_right-self.FoV_x_left:# the width of the cropped area
+                return #hit the end so don't add
         else:
-            travel_direction="R2L"
-         #check for valid direction same as last
-        if travel_direction != old_dir:
-            return False
-        return True
-                        
+            if x<=0:# assume the start of cropped area x is 0
+                return
+        veh._add_tracking_record(x,y,w,h,centroid,dir,found_area,frame)
+        state = confirmed_state(veh.state, len(veh.track), cfg.track_confirm)
+        if state != veh.state:# just confirmed
+            veh.state = state
+            self.track_counts[state] += 1
+        veh.centroid = centroid
+        self.process_motion_events(veh,total_contours,frame)
+
+        if cfg.gui_window_on:
+            # show small circle at blob xy if required
+            if SHOW_CIRCLE:
+                cv2.circle(image2,
+                        (int(veh.cur_track_x + self.FoV_x_left * cfg.window_bigger),
+                        int(veh.cur_track_y + self.FoV_y_upper * cfg.window_bigger)),
+                        CIRCLE_SIZE, colours.cvGreen, LINE_THICKNESS)
+            if SHOW_RECTANGLE:
+                # otherwise a rectangle around most recent blob
+                cv2.rectangle(image2,
+                            (int(self.FoV_x_left + veh.cur_track_x),
+                            int(self.FoV_y_upper + veh.cur_track_y)),
+                            (int(self.FoV_x_left + veh.cur_track_x + veh.track_w),
+                            int(self.FoV_y_upper + veh.cur_track_y + veh.track_h)),
+                            colours.cvRed, LINE_THICKNESS)
+
     def check_movement_range(self, prev_start_time, veh :Vehicle, total_contours,frame):
         """ check if movement is within acceptable distance range of last track"""
-        image2=frame[0]
         if veh.active==True:
-            track_count = len(veh.track_list)
+            track_count = len(veh.track)
             cur_ave_speed=0
-            track_diff=abs(veh.track_list[-1].cur_track_x - veh.track_list[-1].prev_track_x)
+            fit=None
+            track_diff=abs(veh.cur_track_x - veh.prev_track_x)
             if track_diff > cfg.x_diff_min and track_diff <= cfg.x_diff_max:
                 cur_track_dist = track_diff
                 whole_vehicle=True
                 if veh.cur_track_time==prev_start_time:
                     return False
                 try:
-                    if  veh.track_list[-1].direction=="L2R":
-                        cur_ave_speed = float((abs(cur_track_dist /float(abs(veh.cur_track_time - prev_start_time)))) * rc.speed_conv_L2R)
+                    if  veh.direction=="L2R":
+                        speed_conv = rc.speed_conv_L2R
+                        cur_ave_speed = float((abs(cur_track_dist /float(abs(veh.cur_track_time - prev_start_time)))) * speed_conv)
                         cal_obj_px = cfg.cal_obj_px_L2R
                         cal_obj_mm = cfg.cal_obj_mm_L2R
-                        if veh.track_list[-1].cur_track_x==0:# there is still vehicle in view at the boundary
+                        if veh.cur_track_x==0:# there is still vehicle in view at the boundary
                             whole_vehicle=False
-                    elif  veh.track_list[-1].direction=="R2L":
-                        cur_ave_speed = float((abs(cur_track_dist /float(abs(veh.cur_track_time - prev_start_time)))) * rc.speed_conv_R2L)
+                    elif  veh.direction=="R2L":
+                        speed_conv = rc.speed_conv_R2L
+                        cur_ave_speed = float((abs(cur_track_dist /float(abs(veh.cur_track_time - prev_start_time)))) * speed_conv)
                         cal_obj_px = cfg.cal_obj_px_R2L
                         cal_obj_mm = cfg.cal_obj_mm_R2L
-                        if (veh.track_list[-1].cur_track_x + veh.track_list[-1].track_w)==(self.FoV_x_right-self.FoV_x_left):# the width of the FoV
+                        if (veh.cur_track_x + int(veh.track['w'][-1]))==(self.FoV_x_right-self.FoV_x_left):# the width of the FoV
                             whole_vehicle=False                   
                     else:
                         return False
                 except Exception as e:
                     overlayLogger.error(veh)
                     return False
-                veh.speed_list.append(cur_ave_speed)
-                ave_speed = np.mean(veh.speed_list)
+                if self.phase is not None:# the sub-pixel shift since the last frame rather than the edge positions
+                    px_per_sec=self._phase_px_per_sec(veh)
+                    if px_per_sec is None:
+                        return False
+                    cur_ave_speed = px_per_sec * speed_conv
+                if not veh.speed_stats.add(cur_ave_speed):
+                    overlayLogger.debug("Rejected %.1f %s, too far from the average %.1f %s of the track",
+                                        cur_ave_speed, rc.speed_units, veh.speed_stats.mean, rc.speed_units)
+                ave_speed = veh.speed_stats.mean
                 prev_start_time = veh.cur_track_time
                 #self.event_timer = frame[1]
                             
-                if track_count > cfg.track_counter and whole_vehicle==True:# ideally, we would like the whole vehicle to be in frame
+                if self.phase is not None:# each phase measurement is more precise, so fewer are needed
+                    track_done = veh.speed_stats.count >= cfg.phase_track_counter
+                elif self.fit_speed:# done once the fitted speed is known well enough
+                    fit = self._track_fit(veh)
+                    track_done = track_count > cfg.track_counter or (fit is not None and fit.points >= cfg.fit_min_points
+                                                                     and fit.moe * speed_conv <= cfg.fit_target_moe)
+                else:
+                    track_done = track_count > cfg.track_counter
+                if track_done and whole_vehicle==True:# ideally, we would like the whole vehicle to be in frame
                     #to complete the measurement and give an accurate size.
 
 
-                    tot_track_dist = abs(veh.cur_track_x - self.vehicle_start_pos_x)
-                    tot_track_time = abs(veh.cur_track_time-veh.track_list[0].track_time)
-                    # the first tracked speed can be wrong, so discard it
-                    veh.speed_list.pop(0)
-                    if len(veh.speed_list)>0:
-                        ave_speed = mean(veh.speed_list)
-                        #variance = pvariance(veh.speed_list,ave_speed)
-                        veh.StdDev= pstdev(veh.speed_list)
-                        veh.MoE=(veh.StdDev/math.sqrt(len(veh.speed_list)))*1.96 # mph, z=1.96 for 95% confidence
+                    tot_track_dist = abs(veh.cur_track_x - veh.start_pos_x)
+                    tot_track_time = abs(veh.cur_track_time-float(veh.track['t'][0]))
+                    # the first tracked edge speed can be wrong, so discard it
+                    if self.phase is None:
+                        veh.speed_stats.discard_first()
+                    if veh.speed_stats.count>0:
+                        ave_speed = veh.speed_stats.mean
+                        veh.StdDev= veh.speed_stats.stddev
+                        veh.MoE=veh.speed_stats.moe # mph, z=1.96 for 95% confidence
+                        if fit is not None:# the slope over the whole track rather than the average of the frame to frame speeds
+                            ave_speed = abs(fit.slope) * speed_conv
+                            veh.StdDev = fit.slope_se * speed_conv
+                            veh.MoE = fit.moe * speed_conv
+                            overlayLogger.debug("Fitted %.1f px/s over %i positions, residual %.2f px",
+                                                fit.slope, fit.points, fit.residual)
                         veh.FinalSpeed=ave_speed
-                        veh.track_w=veh.track_list[-1].track_w #make the vehicle size the last size measurements detected
-                        veh.track_h=veh.track_list[-1].track_h
+                        veh.track_w=int(veh.track['w'][-1]) #make the vehicle size the last size measurements detected
+                        veh.track_h=int(veh.track['h'][-1])
                     # Track length exceeded so take process speed photo
                         if cfg.max_speed_count > ave_speed > cfg.max_speed_over :
                         # uncomment for debug
@@ -1219,24 +1693,25 @@ class SpeedTrack(object):
                                         track_count, cfg.track_counter,
                                         veh.cur_track_x, veh.cur_track_y,
                                         ave_speed, rc.speed_units,
-                                        abs(veh.cur_track_x - self.vehicle_prev_pos_x),
+                                        abs(veh.cur_track_x - veh.prev_pos_x),
                                         cfg.x_diff_max,
-                                        veh.track_list[-1].track_h*veh.track_list[-1].track_w,
-                                        veh.track_list[-1].direction)
+                                        veh.cur_track_size,
+                                        veh.direction)
                     
                             overlayLogger.info("Tracking complete- %s Ave %.1f %s,StdDev %.2f, Tracked %i px in %.2f s,size,%i",
-                                    veh.track_list[-1].direction,
+                                    veh.direction,
                                     veh.FinalSpeed, rc.speed_units,
                                     veh.MoE,
                                     tot_track_dist,
                                     tot_track_time,
                                     veh.track_w*veh.track_h
                                     )    
-                            overlayLogger.debug(veh.speed_list)
+                            overlayLogger.debug("%i speeds averaged, %i rejected", veh.speed_stats.count, veh.speed_stats.rejected)
+                            image2=self._full_frame(frame)
                             (fullfilename,partfilename)=self.save_speed_image(image2,ave_speed,veh,frame[1])
-                            self.write_speed_record(veh, partfilename,ave_speed, cal_obj_mm, cal_obj_px,frame[1])
+                            self.write_speed_record(veh, partfilename,ave_speed, cal_obj_mm, cal_obj_px,frame[1],fullfilename)
                         if cfg.gui_window_on:
-                            image2=self._show_screen_speed(veh,image2)
+                            image2=self._show_screen_speed(veh,self._full_frame(frame))
                         if cfg.spaceTimerHrs > 0:
                             self.lastSpaceCheck = sfu.freeDiskSpaceCheck(self.lastSpaceCheck)
                         # Manage a maximum number of files and delete oldest if required.
@@ -1257,12 +1732,19 @@ class SpeedTrack(object):
                                     veh.biggest_area)
                     overlayLogger.debug(horiz_line)
                     # Optional Wait to avoid multiple recording of same object
-                    if cfg.track_timeout > 0:
-                        self.skip_frames=int(cfg.track_timeout*vs.fps)
+                    if cfg.concurrent_tracking:# only this vehicle is ignored, it is followed until it leaves
+                        if veh.track['t'][0] < self.blackout_until:
+                            self.blackout_saves += 1# it was already in view while the frames would have been skipped
+                        self.blackout_until=frame[1]+cfg.track_timeout
+                    elif cfg.track_timeout > 0:# the only time frames are skipped, concurrent tracking needs them all
+                        self.skip_until=frame[1]+cfg.track_timeout
+                        if not cfg.gui_window_on:# nothing to display so the frames needn't even be decoded
+                            vs.request_skip(until=self.skip_until)
                         overlayLogger.debug("skipping %i frames for %0.2f Sec (to avoid tracking same vehicle)",
-                                     self.skip_frames,cfg.track_timeout)
+                                     int(cfg.track_timeout*vs.fps),cfg.track_timeout)
                     # Track Ended so Reset 
-                    veh.active=False
+                    veh.state=FINISHED
+                    self.track_counts[FINISHED] += 1
                     
                 else: #still counting
                     #cv2.imshow('added', image2)
@@ -1271,11 +1753,11 @@ class SpeedTrack(object):
                                         track_count, cfg.track_counter,
                                         veh.cur_track_x, veh.cur_track_y,
                                         ave_speed, rc.speed_units,
-                                        abs(veh.cur_track_x - self.vehicle_prev_pos_x),
+                                        abs(veh.cur_track_x - veh.prev_pos_x),
                                         cfg.x_diff_max,
-                                        veh.track_list[-1].track_h*veh.track_list[-1].track_w,
-                                        veh.track_list[-1].direction)
-                    self.vehicle_end_pos_x = veh.cur_track_x
+                                        veh.cur_track_size,
+                                        veh.direction)
+                    veh.end_pos_x = veh.cur_track_x
             # Movement was not within range parameters
             else:
                 if cfg.show_out_range:
@@ -1283,12 +1765,12 @@ class SpeedTrack(object):
                     # allowed so ignore 
                     #cv2.imshow('Out of Range', image2)
                     
-                    if abs(veh.cur_track_x - self.vehicle_prev_pos_x) >= cfg.x_diff_max:
+                    if abs(veh.cur_track_x - veh.prev_pos_x) >= cfg.x_diff_max:
                         overlayLogger.debug(" Excess movement - %i/%i xy(%i,%i) Max D=%i>=%ipx"
                                     " C=%i %ix%i=%i sqpx %s",
                                     track_count+1, cfg.track_counter,
                                     veh.cur_track_x, veh.cur_track_y,
-                                    abs(veh.cur_track_x - self.vehicle_prev_pos_x),
+                                    abs(veh.cur_track_x - veh.prev_pos_x),
                                     cfg.x_diff_max,
                                     total_contours,
                                     veh.track_w, veh.track_h, veh.biggest_area,
@@ -1297,7 +1779,7 @@ class SpeedTrack(object):
                         if track_count > cfg.track_counter / 2:
                             pass
                         else:
-                            self.first_event = True    # Too Far Away so restart Track
+                            veh.first_event = True    # Too Far Away so restart Track
                     # Did not move much so ignore
                     # and wait for next valid movement.
                     else:
@@ -1305,14 +1787,14 @@ class SpeedTrack(object):
                                     " C=%i %ix%i=%i sqpx %s",
                                     track_count, cfg.track_counter,
                                     veh.cur_track_x, veh.cur_track_y,
-                                    abs(veh.cur_track_x - self.vehicle_end_pos_x),
+                                    abs(veh.cur_track_x - veh.end_pos_x),
                                     cfg.x_diff_min,
                                     total_contours,
                                     veh.track_w, veh.track_h, veh.biggest_area,
                                     veh.travel_direction)
                         # Restart Track if first event otherwise continue
                         if track_count == 0:
-                            self.first_event = True
+                            veh.first_event = True
         return True
 
     def _show_screen_speed(self,veh  :Vehicle, image):
@@ -1325,7 +1807,7 @@ class SpeedTrack(object):
         cv2.imshow("Speed",speedimage)
         return speedimage
     
-    def write_speed_record(self,veh,filename, ave_speed,cal_obj_mm, cal_obj_px,timestamp):
+    def write_speed_record(self,veh,filename, ave_speed,cal_obj_mm, cal_obj_px,timestamp,image_file=None):
 
         log_time = datetime.datetime.fromtimestamp(timestamp)
         log_idx = ("%04d%02d%02d-%02d%02d%02d%d" %
@@ -1351,17 +1833,13 @@ class SpeedTrack(object):
             camera = "WebCam"
         else:
             camera = "PiCam"
-        if cfg.overlayEnable:
-            overlay_name = cfg.overlayName
-        else:
-            overlay_name = "Default"
         # create the speed data list ready for db insert
         speed_data = (log_idx,
                                 log_timestamp,
                                 camera,
                                 round(ave_speed, 2), rc.speed_units, filename,
                                 image_width, image_height, cfg.image_bigger,
-                                veh.track_list[-1].direction, overlay_name,
+                                veh.direction, self.detector.name,
                                 veh.cur_track_x, veh.cur_track_y,
                                 veh.track_w, veh.track_h, m_area,
                                 self.FoV_x_left, self.FoV_x_right,
@@ -1370,46 +1848,51 @@ class SpeedTrack(object):
                                 cfg.MIN_AREA, cfg.track_counter,
                                 cal_obj_px, cal_obj_mm, '', cfg.CAM_LOCATION)
 
-        # Insert speed_data into sqlite3 database table
-        # Note cam_location and status may not be in proper order unless speed table is recreated.
-        if cfg.log_data_to_DB:# this is not tested
-            sql_cmd = '''insert into {} values {}'''.format(cfg.DB_TABLE, speed_data)
-            self.speed_db.db_add_record(sql_cmd)
-            
-        # Format and Save Data to CSV Log File
-        if cfg.log_data_to_CSV:
-            log_csv_time = ("%s%04d-%02d-%02d %02d:%02d:%02d.%d%s"
-                            % (quote,
-                            log_time.year,
-                            log_time.month,
-                            log_time.day,
-                            log_time.hour,
-                            log_time.minute,
-                            log_time.second,
-                            log_time.microsecond/100000,
-                            quote))
-            log_csv_text = ("%s,%.1f,%s%s%s,%.1f,%s%s%s,%i,%s%s%s,%s%s%s"
-                            % (log_csv_time,
-                            ave_speed,
-                            quote,
-                            rc.speed_units,
-                            quote,
-                            veh.StdDev,
-                            quote,
-                            filename,
-                            quote,
-                            veh.track_w * veh.track_h,
-                            quote,
-                            veh.track_list[-1].direction,
-                            quote,
-                            quote,
-                            cfg.CAM_LOCATION,
-                            quote))
-            self.save_to_csv(log_csv_text)
+        # Format Data for the CSV Log File
+        log_csv_time = ("%s%04d-%02d-%02d %02d:%02d:%02d.%d%s"
+                        % (quote,
+                        log_time.year,
+                        log_time.month,
+                        log_time.day,
+                        log_time.hour,
+                        log_time.minute,
+                        log_time.second,
+                        log_time.microsecond/100000,
+                        quote))
+        log_csv_text = ("%s,%.1f,%s%s%s,%.1f,%s%s%s,%i,%s%s%s,%s%s%s"
+                        % (log_csv_time,
+                        ave_speed,
+                        quote,
+                        rc.speed_units,
+                        quote,
+                        veh.StdDev,
+                        quote,
+                        filename,
+                        quote,
+                        veh.track_w * veh.track_h,
+                        quote,
+                        veh.direction,
+                        quote,
+                        quote,
+                        cfg.CAM_LOCATION,
+                        quote))
+        record = SpeedRecord(timestamp, veh.direction, ave_speed, image_file, speed_data, log_csv_text)
+        if self.record_sink is not None:# held back for merging, eg by a chunk worker
+            self.record_sink.append(record)
+        else:
+            output_speed_record(record, self.speed_db)
         
     def save_speed_image(self,image2,ave_speed, veh,frame_timestamp):
-        """ Resize and process previous image before saving to disk"""
+        """ Resize and process previous image before saving to disk
+        If there is an evidence stream, its frame nearest frame_timestamp is saved instead at its own size"""
         prev_image = image2
+        evidence = None
+        scale = (1.0, 1.0)# evidence pixels per motion stream pixel
+        if not cfg.calibrate:# calibration marks are in motion stream pixels
+            evidence = vs.get_evidence_frame(frame_timestamp)
+        if evidence is not None:
+            scale = (evidence.shape[1] / image2.shape[1], evidence.shape[0] / image2.shape[0])
+            prev_image = evidence
         # Create a calibration image file name
         # There are no subdirectories to deal with
         if cfg.calibrate:
@@ -1435,24 +1918,29 @@ class SpeedTrack(object):
                 fullfilename,filename = self._set_image_file_name(self.speed_path, cfg.image_prefix,frame_timestamp)
                 partfilename= os.path.join(tail,filename)
         # Add motion rectangle to image if required
-        if cfg.image_show_motion_area:
-            prev_image = self.speed_image_add_lines(prev_image, colours.cvRed)
+        if cfg.image_show_motion_area:# on a copy, another vehicle may be saved from the same frame
+            prev_image = self.speed_image_add_lines(prev_image.copy(), colours.cvRed, scale)
             # show centre of motion if required
             if SHOW_CIRCLE:
                 cv2.circle(prev_image,
-                        (veh.cur_track_x + self.FoV_x_left, veh.cur_track_y + y_upper),
+                        (int((veh.cur_track_x + self.FoV_x_left) * scale[0]), int((veh.cur_track_y + y_upper) * scale[1])),
                         CIRCLE_SIZE,
                         colours.cvGreen, LINE_THICKNESS)
             if SHOW_RECTANGLE:
                 cv2.rectangle(prev_image,
-                            (int(veh.cur_track_x + self.FoV_x_left),
-                            int(veh.cur_track_y + y_upper)),
-                            (int(veh.cur_track_x + self.FoV_x_left + veh.track_w),
-                            int(veh.cur_track_y + y_upper + veh.track_h)),
+                            (int((veh.cur_track_x + self.FoV_x_left) * scale[0]),
+                            int((veh.cur_track_y + y_upper) * scale[1])),
+                            (int((veh.cur_track_x + self.FoV_x_left + veh.track_w) * scale[0]),
+                            int((veh.cur_track_y + y_upper + veh.track_h) * scale[1])),
                             colours.cvGreen, LINE_THICKNESS)
-        big_image = cv2.resize(prev_image,
-                            (image_width,
-                                image_height))
+        if evidence is None:
+            big_image = cv2.resize(prev_image,
+                                (image_width,
+                                    image_height))
+            text_y = self.text_y
+        else:# already sharp, no need to enlarge it
+            big_image = prev_image
+            text_y = big_image.shape[0] - 50 if cfg.image_text_bottom else self.text_y
         if image_sign_on:
             image_sign_view_time = time.time()
             image_sign_bg = np.zeros((image_sign_resize[0], image_sign_resize[1], 4))
@@ -1473,14 +1961,14 @@ class SpeedTrack(object):
                         % (ave_speed,
                             rc.speed_units,
                             tag))# was filename
-            text_x = int((image_width / 2) -
+            text_x = int((big_image.shape[1] / 2) -
                         (len(image_text) *
                         cfg.image_font_size / 3))
             if text_x < 2:
                 text_x = 2
             cv2.putText(big_image,
                         image_text,
-                        (text_x, self.text_y),
+                        (text_x, text_y),
                         self.font,
                         cfg.image_font_scale,
                         cfg.image_font_color,
@@ -1491,7 +1979,7 @@ class SpeedTrack(object):
         # otherwise if png, bmp, gif, etc normal image write will occur
         if cfg.image_format.lower() == ".jpg" or cfg.image_format.lower() == ".jpeg":
             cv2.imwrite(fullfilename, big_image, [int(cv2.IMWRITE_JPEG_QUALITY), cfg.image_jpeg_quality,
-                                            int(cv2.IMWRITE_JPEG_OPTIMIZE), cfg.image_jpeg_optimize])
+                                            int(cv2.IMWRITE_JPEG_OPTIMIZE), int(cfg.image_jpeg_optimize)])
         else:
             cv2.imwrite(fullfilename, big_image)
         
@@ -1532,12 +2020,16 @@ class SpeedTrack(object):
 		#dilation=cv2.dilate(fgmask, self.kernel1, iterations=4)
         return dilation
 
-    def speed_get_contours(self,image, grayimage1):
+    def speed_get_blobs(self,image, grayimage1, timestamp=0):
         """
         Read Camera image and crop and process
-        with opencv to detect motion contours.
+        with opencv to detect moving blobs.
         Added timeout in case camera has a problem.
         """
+        if image.ndim == 2:# already cropped and converted to gray by the camera thread
+            grayimage2 = self._workspace(image.shape).next_gray(grayimage1)
+            np.copyto(grayimage2, image)# the buffer slot is reused after the next read
+            return self._diff_blobs(grayimage2, grayimage1, timestamp)
         image_ok = False
         start_time = time.time()
         timeout = 60 # seconds to wait if camera communications is lost.
@@ -1557,75 +2049,61 @@ class SpeedTrack(object):
                     image_ok = False
 
         # Convert to gray scale, for image comparison
-        grayimage2 = cv2.cvtColor(image_crop, cv2.COLOR_BGR2GRAY)
+        grayimage2 = cv2.cvtColor(image_crop, cv2.COLOR_BGR2GRAY,
+                                  dst=self._workspace(image_crop.shape).next_gray(grayimage1))
         #cv2.imshow('image2', image_crop)
-        # Get differences between the two greyed images
-        global differenceimage
-        differenceimage = cv2.absdiff(grayimage1, grayimage2)
-        # you can play around with different filtering etc, so all sorts of commented out stuff here
-        #clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-        #differenceimage=clahe.apply(differenceimage)
-        #cv2.imshow('Diff', differenceimage)
-        #differenceimage = self.filter_mask(differenceimage)
-        # Find Canny edges
-        edged = cv2.Canny(differenceimage, 100, 200)
-        
-        #edged=cv2.equalizeHist(edged)
-        #edged = self.filter_mask(edged)
-        
-        #  Blur difference image to enhance motion vectors
-        #differenceimage = cv2.blur(edged, (BLUR_SIZE, BLUR_SIZE))
-        # Get threshold of blurred difference image
-        # based on THRESHOLD_SENSITIVITY variable
-        #retval, thresholdimage = cv2.threshold(differenceimage,
-        #                                    THRESHOLD_SENSITIVITY,
-        #                                    255, cv2.THRESH_BINARY)
-        #thresholdimage = cv2.adaptiveThreshold(edged,
-        # use THRESH_BINARY_INV to use a black background, stops picking up border as contour
-        edged = cv2.adaptiveThreshold(edged,
-                                              255,
-                                              cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                              cv2.THRESH_BINARY_INV,11,2)
-        #cv2.imshow('edged', edged)
-        try:
-            # opencv 2 syntax default
-            contours, hierarchy = cv2.findContours(edged,
-            #contours, hierarchy = cv2.findContours(thresholdimage,
-                                                cv2.RETR_EXTERNAL,
-                                                cv2.CHAIN_APPROX_SIMPLE)
-        except ValueError:
-            # opencv 3 syntax
-            thresholdimage, contours, hierarchy = cv2.findContours(edged,
-                                                                cv2.RETR_EXTERNAL,
-                                                                cv2.CHAIN_APPROX_SIMPLE)
-        #cv2.imshow('threshold', thresholdimage)
-        # Update grayimage1 to grayimage2 ready for next image2
+        return self._diff_blobs(grayimage2, grayimage1, timestamp)
+
+    def _diff_blobs(self, grayimage2, grayimage1, timestamp=0):
+        """ find the moving blobs between the previous and this gray crop of the tracking area"""
+        if grayimage1 is None or not self.workspace.owns(grayimage1):# the field of view has changed, start again from this frame
+            return grayimage2, NO_BLOBS
+        if self.motion_gate is not None and not self.motion_gate.check(grayimage2, force=len(self.vehicles) > 0):
+            return grayimage2, NO_BLOBS# nothing moving, no need for the blobs
+        # the detector writes into its own preallocated buffers, so no images are allocated per frame
+        if self.adaptive_roi is not None:
+            blobs = self.adaptive_roi.blobs(self.detector, grayimage2, grayimage1, self._expected_boxes(timestamp), timestamp)
+        else:
+            blobs = self.detector.blobs(grayimage2, grayimage1)
+        # Update grayimage1 to grayimage2 ready for next image2, its buffer takes the next frame
         grayimage1 = grayimage2
-        cv2.drawContours(image_crop, contours, contourIdx=-1, color=(0, 255, 0), thickness=3)
-        image_view = cv2.resize(image_crop, (int(image_width/2), int(image_height/2)))
+        #image_view = cv2.resize(image_crop, (int(image_width/2), int(image_height/2)))
         #cv2.imshow(self.contourwin, image_view)
         #cv2.imshow('contour', grayimage1)
     
-        return grayimage1, contours
+        return grayimage1, blobs
     
-    def save_to_csv(self,data_to_append):
-        """ Store date to a comma separated value file """
-        data_file_path = os.path.join(baseDir, cfg.db_path, cfg.overlayName+".csv")
-        if not os.path.exists(data_file_path):
-            open(data_file_path, 'w').close()
-            f = open(data_file_path, 'a+')
-            #TODO if needed, the header needs formatting and aligning with the csv data rows.
-            header_text = ('"YYYY-MM-DD HH:MM:SS ","Speed","UoM","MoE",'
-                           '"         Speed Photo Path               ","Area","Dir","Tag"' +"\n")
-            f.write( header_text )
-            f.close()
-            overlayLogger.info("Created new data csv file %s", data_file_path)
-        filecontents = data_to_append + "\n"
+
+#--------------------------------------------------------------------------------------------------
+def output_speed_record(record, speed_db=None):
+    """ Write a SpeedRecord to the sqlite3 database table and/or CSV file as configured"""
+    # Insert speed_data into sqlite3 database table
+    # Note cam_location and status may not be in proper order unless speed table is recreated.
+    if cfg.log_data_to_DB and speed_db is not None:# this is not tested
+        sql_cmd = '''insert into {} values {}'''.format(cfg.DB_TABLE, record.speed_data)
+        speed_db.db_add_record(sql_cmd)
+    # Save Data to CSV Log File
+    if cfg.log_data_to_CSV:
+        save_to_csv(record.csv_text)
+
+def save_to_csv(data_to_append):
+    """ Store date to a comma separated value file """
+    data_file_path = os.path.join(baseDir, cfg.db_path, cfg.overlayName+".csv")
+    if not os.path.exists(data_file_path):
+        open(data_file_path, 'w').close()
         f = open(data_file_path, 'a+')
-        f.write(filecontents)
+        #TODO if needed, the header needs formatting and aligning with the csv data rows.
+        header_text = ('"YYYY-MM-DD HH:MM:SS ","Speed","UoM","MoE",'
+                       '"         Speed Photo Path               ","Area","Dir","Tag"' +"\n")
+        f.write( header_text )
         f.close()
-        overlayLogger.info("CSV - added speed data to %s", data_file_path)
-        return
+        overlayLogger.info("Created new data csv file %s", data_file_path)
+    filecontents = data_to_append + "\n"
+    f = open(data_file_path, 'a+')
+    f.write(filecontents)
+    f.close()
+    overlayLogger.info("CSV - added speed data to %s", data_file_path)
+    return
 
 #--------------------------------------------------------------------------------------------------
 class FoVDrawer(object):
@@ -1684,7 +2162,8 @@ def _start(WebcamTries):
             vs = WebcamVideoStream(saveStream=saveToFile,
                                     CAM_SRC = cfg.WEBCAM_SRC,
                                     CAM_WIDTH = cfg.WEBCAM_WIDTH,
-                                    CAM_HEIGHT = cfg.WEBCAM_HEIGHT)
+                                    CAM_HEIGHT = cfg.WEBCAM_HEIGHT,
+                                    evidence_src = cfg.WEBCAM_EVIDENCE_SRC)
             
         if vs.grabbed:
             vs.start()
@@ -1713,8 +2192,162 @@ def _start(WebcamTries):
 
     
    
+#------------------------------------------------------------------------------------------
+def get_file_info(src):
+    """ Return frame width, height and duration in seconds of a video file, or None if it can't be read"""
+    cam_stream = cv2.VideoCapture(src)
+    grabbed, frame = cam_stream.read()
+    fps = cam_stream.get(cv2.CAP_PROP_FPS)
+    frames = cam_stream.get(cv2.CAP_PROP_FRAME_COUNT)
+    cam_stream.release()
+    if not grabbed:
+        return None
+    duration = frames / fps if fps > 0 else 0.0
+    return frame.shape[1], frame.shape[0], duration
+
+def init_worker():
+    """ Worker processes must die on SIGTERM, not inherit the main process's stop request handler"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+
+def process_file_range(src, start_time, end_time, rect, image_size, speed_image_path):
+    """ Worker process entry. Track part of a recording headless and as fast as possible,
+    returning (records, complete), the speed records rather than writing them so the chunks can be merged.
+    complete is False if tracking was interrupted, the records are then for only part of the range"""
+    global vs, rc, sfu, image_width, image_height, image_path, y_upper
+    cfg.headless = True
+    cfg.gui_window_on = False
+    cfg.file_replay_fast = True
+    cfg.file_loop = False
+    rc = SpeedCam()
+    sfu = speed_file_utils.SpeedFileUtils(cfg)
+    image_width, image_height = image_size
+    image_path = speed_image_path
+    y_upper = rect[2]
+    records = []
+    vs = WebcamVideoStream(CAM_SRC=src, isFile=True, isLoop=False, start_time=start_time, end_time=end_time)
+    vs.start()
+    complete = False
+    try:
+        SpeedTrack(True, rect, image_path, record_sink=records)
+        complete = True# the stream ran to the end of the range
+    except KeyboardInterrupt:# stopped by a signal
+        pass
+    finally:
+        vs.stop()
+    return records, complete
+
+def process_file_chunks(src, workers, overlap):
+    """ Split a recording into time ranges each tracked by its own process,
+    then merge the speed records dropping any vehicle counted by two chunks"""
+    global image_width, image_height
+    info = get_file_info(src)
+    if info is None:
+        overlayLogger.error("Cannot read video file %s", src)
+        return []
+    img_width, img_height, duration = info
+    image_width = int(img_width * cfg.image_bigger)
+    image_height = int(img_height * cfg.image_bigger)
+    init_settings()
+    rect = (cfg.x_left, cfg.x_right, cfg.y_upper, cfg.y_lower)
+    chunks = plan_chunks(duration, workers, overlap)
+    overlayLogger.info("Processing %s (%.1f s) in %i chunks with %i s overlap",
+                       src, duration, len(chunks), overlap)
+    start = time.time()
+    pool = multiprocessing.Pool(min(workers, len(chunks)), initializer=init_worker)
+    results = pool.starmap(process_file_range,
+                           [(src, chunk.run_start, chunk.run_end, rect,
+                             (image_width, image_height), image_path) for chunk in chunks])
+    pool.close()
+    pool.join()
+    chunk_records = [records for (records, _) in results]
+    if not all(complete for (_, complete) in results):# a truncated chunk would lose the vehicles after it stopped
+        remove_record_images([record for records in chunk_records for record in records], [])
+        overlayLogger.error("Interrupted before all of %s was processed, no speed records written", src)
+        return []
+    kept, dropped = merge_chunk_records(chunks, chunk_records, os.path.getctime(src),
+                                        max(cfg.track_timeout, 1.0))
+    remove_record_images(dropped, kept)
+    speed_db = SpeedDB(db_path, cfg) if cfg.log_data_to_DB else None
+    for record in kept:
+        output_speed_record(record, speed_db)
+    overlayLogger.info("Finished %s in %.1f s, %i speed records, %i dropped from chunk overlaps",
+                       src, time.time() - start, len(kept), len(dropped))
+    return kept
+
+def process_batch_file(src, speed_image_path):
+    """ Worker process entry for a batch. Track a whole recording, returns (src, records, error)"""
+    info = get_file_info(src)
+    if info is None:
+        return src, [], "Cannot read video file"
+    img_width, img_height, _ = info
+    image_size = (int(img_width * cfg.image_bigger), int(img_height * cfg.image_bigger))
+    rect = (cfg.x_left, cfg.x_right, cfg.y_upper, cfg.y_lower)
+    try:
+        records, complete = process_file_range(src, 0, None, rect, image_size, speed_image_path)
+    except Exception as e:
+        return src, [], repr(e)
+    if not complete:# not checkpointed, so a rerun does the whole file again
+        remove_record_images(records, [])
+        return src, [], "Interrupted before the end of the file"
+    return src, records, None
+
+def process_batch(pattern, workers, checkpoint_path):
+    """ Process a directory or glob of recordings a file per worker process.
+    The speed records of each file are written to the CSV/DB as the file finishes
+    and the file is added to the checkpoint, so a rerun skips it. A file interrupted part way is neither"""
+    global image_width, image_height
+    files = find_batch_files(pattern)
+    if not files:
+        overlayLogger.error("No video files found for %s", pattern)
+        return
+    finished = load_checkpoint(checkpoint_path)
+    todo = [src for src in files if not is_finished(finished, src)]
+    overlayLogger.info("Batch %s: %i files, %i already done per %s",
+                       pattern, len(files), len(files) - len(todo), checkpoint_path)
+    if not todo:
+        return
+    info = get_file_info(todo[0])# settings display only, each worker sizes its own images
+    if info is not None:
+        image_width = int(info[0] * cfg.image_bigger)
+        image_height = int(info[1] * cfg.image_bigger)
+    init_settings()
+    speed_db = SpeedDB(db_path, cfg) if cfg.log_data_to_DB else None
+    start = time.time()
+    total_records = 0
+    failed = 0
+    pool = multiprocessing.Pool(min(workers, len(todo)), initializer=init_worker)
+    try:
+        for src, records, error in pool.imap_unordered(functools.partial(process_batch_file,
+                                                                         speed_image_path=image_path), todo):
+            if error:
+                overlayLogger.error("Failed %s - %s", src, error)
+                failed += 1
+            else:
+                for record in sorted(records, key=lambda record: record.timestamp):
+                    output_speed_record(record, speed_db)
+                finished[src] = {'signature': file_signature(src), 'records': len(records),
+                                 'processed': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+                save_checkpoint(checkpoint_path, finished)
+                total_records += len(records)
+                overlayLogger.info("Finished %s, %i speed records", src, len(records))
+            if stop_requested.is_set():
+                overlayLogger.info("Batch stopped, rerun to resume from %s", checkpoint_path)
+                break
+    except KeyboardInterrupt:
+        overlayLogger.info("Batch interrupted, rerun to resume from %s", checkpoint_path)
+    finally:
+        pool.terminate()
+        pool.join()
+    overlayLogger.info("Batch done in %.1f s, %i files, %i failed, %i speed records",
+                       time.time() - start, len(todo), failed, total_records)
+
 #------------------------------------------------------------------------------------------
 if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, request_stop)
+    if hasattr(signal, 'SIGHUP'):# not on windows
+        signal.signal(signal.SIGHUP, request_stop)
     rc=SpeedCam()
     readFromFile=cfg.src_is_file # gets the source images from a previously recorded file
     saveToFile=cfg.calibrate # saves a video of the camera to a video file
@@ -1724,6 +2357,13 @@ if __name__ == '__main__':
     y_upper=cfg.y_upper
     sfu=speed_file_utils.SpeedFileUtils(cfg)
     WebCamTryMax=3
+    if args.batch:# reprocess a set of recordings then exit
+        checkpoint_path = args.checkpoint or os.path.join(baseDir, cfg.db_path, cfg.overlayName + "_batch.json")
+        process_batch(args.batch, args.workers or multiprocessing.cpu_count(), checkpoint_path)
+        sys.exit()
+    if readFromFile and cfg.file_chunk_workers > 1:# split a long recording across processes
+        process_file_chunks(cfg.source_file_name, cfg.file_chunk_workers, cfg.file_chunk_overlap)
+        sys.exit()
     try:
         WebcamTries = 0
         while True:
@@ -1741,7 +2381,8 @@ if __name__ == '__main__':
                     vs = WebcamVideoStream(saveStream=saveToFile,
                                            CAM_SRC = cfg.WEBCAM_SRC,
                                            CAM_WIDTH = cfg.WEBCAM_WIDTH,
-                                           CAM_HEIGHT = cfg.WEBCAM_HEIGHT)
+                                           CAM_HEIGHT = cfg.WEBCAM_HEIGHT,
+                                           evidence_src = cfg.WEBCAM_EVIDENCE_SRC)
                     
                 if vs.grabbed:
                     vs.start()
@@ -1776,7 +2417,7 @@ if __name__ == '__main__':
                 vs.stop()
                 #continue
                 raise ValueError( 'No frame found')
-            img_height, img_width, _ = test_img[0].shape
+            img_height, img_width = test_img[0].shape[:2]# may be a gray Y plane
             # Set width of trigger point image to save
             image_width = int(img_width * cfg.image_bigger)
             # Set height of trigger point image to save
@@ -1816,6 +2457,10 @@ if __name__ == '__main__':
             init_settings()  # Show variable settings
             rect=(x_left,x_right,y_upper,y_lower)
             ret=SpeedTrack(readFromFile,rect,image_path)
+            if readFromFile and not cfg.file_loop:# a single pass through the recording, so all done
+                vs.stop()
+                appLogger.info("%s %s Finished %s", progName, progVer, cfg.source_file_name)
+                break
             if ret==-1:
                 WebcamTries=0
                 overlayLogger.info("Camera restarting")
@@ -0,0 +1,124 @@
+"""
+Offline processing helpers for recorded video files.
+
+A long recording can be split into time ranges (chunks) that are tracked by separate
+worker processes. Each worker starts a little before its range (the overlap) so vehicles
+already in view are picked up, and runs a little past its end so vehicles crossing the
+boundary are finished. A chunk only keeps the speed records that complete within its own
+range and any vehicle that was still tracked twice across a boundary is dropped when merging,
+a record from the next chunk soon after, in the same direction and at much the same speed.
+
+A batch of recordings (a directory or glob) is processed a whole file per worker. A JSON
+checkpoint records each finished file so an interrupted batch can be resumed.
+"""
+import glob
+import json
+import os
+from collections import namedtuple
+
+VIDEO_EXTENSIONS = ('.avi', '.mp4', '.mkv', '.mov', '.h264', '.mjpeg')
+
+# A speed record as produced by SpeedTrack, held back rather than written so it can be merged.
+# timestamp is the frame time the track completed, speed_data/csv_text are ready for the DB/CSV file
+SpeedRecord = namedtuple('SpeedRecord', 'timestamp direction speed image_file speed_data csv_text')
+
+# start/end is the range the chunk owns (seconds from the start of the file),
+# run_start/run_end is what is actually processed including the overlaps
+Chunk = namedtuple('Chunk', 'start end run_start run_end')
+
+
+def plan_chunks(duration, workers, overlap):
+    """Split a recording of duration seconds into up to workers chunks.
+    Chunks are kept at least twice the overlap long, otherwise most of the work is overlap."""
+    count = max(1, min(int(workers), int(duration // max(2 * overlap, 1.0))))
+    length = duration / count
+    chunks = []
+    for i in range(count):
+        start = i * length
+        end = (i + 1) * length
+        chunks.append(Chunk(start=start if i > 0 else float('-inf'),
+                            end=end if i < count - 1 else float('inf'),
+                            run_start=max(0.0, start - overlap),
+                            run_end=None if i == count - 1 else end + overlap))
+    return chunks
+
+
+def merge_chunk_records(chunks, chunk_records, base_time, dedupe_window, speed_tolerance=0.05):
+    """Merge the records from each chunk into one time ordered list.
+    base_time is the timestamp of the start of the file. A record is the same vehicle as one kept from
+    another chunk if it is within dedupe_window seconds of it, in the same direction and its speed is
+    within speed_tolerance (a fraction) of it, a close follower is a different vehicle.
+    Returns (kept, dropped) lists of SpeedRecord."""
+    owned = []
+    dropped = []
+    for idx, (chunk, records) in enumerate(zip(chunks, chunk_records)):
+        for record in records:
+            if chunk.start <= record.timestamp - base_time < chunk.end:
+                owned.append((record.timestamp, idx, record))
+            else:
+                dropped.append(record)# another chunk owns this time
+    owned.sort(key=lambda item: (item[0], item[1]))
+    kept = []
+    recent = []# (timestamp, chunk, record) kept within dedupe_window
+    for timestamp, idx, record in owned:
+        recent = [item for item in recent if timestamp - item[0] < dedupe_window]
+        if any(prev_idx != idx and prev.direction == record.direction
+               and abs(record.speed - prev.speed) <= speed_tolerance * max(abs(prev.speed), abs(record.speed))
+               for (_, prev_idx, prev) in recent):
+            dropped.append(record)# same vehicle tracked either side of a chunk boundary
+            continue
+        kept.append(record)
+        recent.append((timestamp, idx, record))
+    return kept, dropped
+
+
+def remove_record_images(dropped, kept):
+    """Delete speed images saved for records that were dropped, unless a kept record uses the same file"""
+    in_use = set(record.image_file for record in kept)
+    for record in dropped:
+        if record.image_file and record.image_file not in in_use and os.path.exists(record.image_file):
+            try:
+                os.remove(record.image_file)
+            except OSError:
+                pass
+
+
+def find_batch_files(pattern):
+    """Return the sorted video files in a directory, or matching a glob pattern"""
+    if os.path.isdir(pattern):
+        files = [os.path.join(pattern, name) for name in os.listdir(pattern)
+                 if name.lower().endswith(VIDEO_EXTENSIONS)]
+    else:
+        files = glob.glob(pattern)
+    return sorted(os.path.abspath(name) for name in files if os.path.isfile(name))
+
+
+def file_signature(filename):
+    """Size and modified time, so a file replaced since it was processed is done again"""
+    stat = os.stat(filename)
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+def load_checkpoint(path):
+    """Return the {file: entry} dict of files already finished, empty if there is no usable checkpoint"""
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f).get('finished', {})
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+
+def save_checkpoint(path, finished):
+    """Write the checkpoint to a temporary file and rename it over the old one,
+    so an interruption never leaves a half written checkpoint"""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({'finished': finished}, f, indent=4)
+    os.replace(temp_path, path)
+
+
+def is_finished(finished, filename):
+    entry = finished.get(filename)
+    return entry is not None and entry.get('signature') == file_signature(filename)
@@ -0,0 +1,266 @@
+"""
+Frame buffering between the video stream capture threads and the speed tracker.
+
+The capture thread decodes straight into one of a fixed number of preallocated
+frame slots and the tracker borrows the oldest filled slot, so no frame is
+allocated or copied on its way through the pipeline.
+
+What happens when the tracker falls behind and the ring is full is set by the overflow policy:
+    block        the capture thread waits for a free slot (nothing is lost, the source may stall)
+    drop_oldest  the oldest queued frame is overwritten
+    drop_newest  the new frame is discarded
+    latest       only the newest frame is kept, older queued frames are discarded
+
+The capture thread can instead queue only the gray crop of the motion tracking area. The full
+frames then go to a TimestampedFrameStore and are only copied out when they are needed,
+eg for a speed photo or the GUI.
+
+The tracker can also ask for frames to be skipped (eg while waiting after a completed track, which
+it only does without concurrent_tracking or the GUI), the capture thread then checks skip_frame()
+before decoding so unwanted frames cost almost nothing.
+"""
+import threading
+from collections import deque
+
+import numpy as np
+
+BUFFER_POLICIES = ('block', 'drop_oldest', 'drop_newest', 'latest')
+
+
+class FrameRingBuffer(object):
+    """Fixed size ring of preallocated frame slots with their timestamps.
+    The producer (capture thread) takes a slot, fills it and commits it with a timestamp.
+    The consumer (tracker) borrows the oldest committed slot and keeps it until the next borrow,
+    so the frame can be worked on in place without copying."""
+
+    def __init__(self, slots=24, policy='drop_oldest'):
+        if policy not in BUFFER_POLICIES:
+            raise ValueError("Unknown frame buffer policy %s, use one of %s" % (policy, ', '.join(BUFFER_POLICIES)))
+        self.policy = policy
+        self.num_slots = max(3, int(slots))  # one being written, one borrowed and at least one queued
+        self.frames = None  # (slots, h, w[, c]) array, allocated from the first frame
+        self.timestamps = np.zeros(self.num_slots, dtype=np.float64)
+        self._cond = threading.Condition()
+        self._free = deque(range(self.num_slots))
+        self._ready = deque()  # committed slots, oldest first
+        self._borrowed = None
+        self._closed = False
+        self.frames_written = 0
+        self.overwrites = 0  # queued frames overwritten because the tracker fell behind
+        self.dropped = 0  # all frames lost to the overflow policy, including overwrites
+        self.high_water = 0  # most frames ever waiting for the tracker
+        self.skip_count = 0  # frames still to be skipped by the capture thread
+        self.skip_until = 0.0  # frames timestamped before this are skipped
+        self.skipped = 0  # frames not decoded or discarded unread because the tracker asked
+
+    def allocate(self, shape, dtype=np.uint8, writing=None):
+        """(Re)allocate the slots for a frame size. Frames already queued are discarded."""
+        with self._cond:
+            self.frames = np.empty((self.num_slots,) + tuple(shape), dtype=dtype)
+            self._free = deque(i for i in range(self.num_slots) if i not in (self._borrowed, writing))
+            self._ready.clear()
+
+    def get_write_slot(self):
+        """Return (index, slot array) for the capture thread to decode into.
+        The slot array is None until the buffer has been allocated.
+        When the ring is full the policy decides, the index is None if the new frame is to be dropped
+        (or the buffer was closed while blocked), in which case the caller should just discard it."""
+        with self._cond:
+            if not self._free:
+                if self.policy == 'block':
+                    while not self._free and not self._closed:
+                        self._cond.wait(0.5)
+                    if self._closed:
+                        return None, None
+                elif self.policy == 'drop_newest':
+                    self.dropped += 1
+                    return None, None
+                else:
+                    self._free.append(self._ready.popleft())
+                    self.overwrites += 1
+                    self.dropped += 1
+            idx = self._free.popleft()
+            slot = None if self.frames is None else self.frames[idx]
+            return idx, slot
+
+    def store(self, idx, frame):
+        """Copy a frame that was not decoded in place into a slot,
+        allocating the ring on the first frame or when the frame size changes."""
+        if self.frames is None or self.frames.shape[1:] != frame.shape or self.frames.dtype != frame.dtype:
+            self.allocate(frame.shape, frame.dtype, writing=idx)
+        np.copyto(self.frames[idx], frame)
+        return self.frames[idx]
+
+    def commit(self, idx, timestamp):
+        """Queue a filled slot for the tracker"""
+        with self._cond:
+            self.timestamps[idx] = timestamp
+            if self.policy == 'latest':# anything still waiting is now stale
+                self.dropped += len(self._ready)
+                self._free.extend(self._ready)
+                self._ready.clear()
+            self._ready.append(idx)
+            self.frames_written += 1
+            self.high_water = max(self.high_water, len(self._ready))
+            self._cond.notify_all()
+
+    def cancel(self, idx):
+        """Give back a slot that was not filled eg the grab failed"""
+        with self._cond:
+            self._free.append(idx)
+            self._cond.notify_all()
+
+    def borrow(self, timeout=None):
+        """Return (frame, timestamp) for the oldest queued slot or None if empty.
+        With a timeout (seconds), wait for a frame to be committed or the buffer to be closed
+        rather than returning straight away, so the caller doesn't need to poll.
+        The slot belongs to the caller until the next borrow() or release()."""
+        with self._cond:
+            self._release()
+            if not self._ready and timeout and not self._closed:
+                self._cond.wait_for(lambda: self._ready or self._closed, timeout)
+            if not self._ready:
+                return None
+            idx = self._ready.popleft()
+            self._borrowed = idx
+            return self.frames[idx], self.timestamps[idx]
+
+    def release(self):
+        """Hand the borrowed slot back to the capture thread"""
+        with self._cond:
+            self._release()
+
+    def _release(self):
+        if self._borrowed is not None:
+            self._free.append(self._borrowed)
+            self._borrowed = None
+            self._cond.notify_all()# a blocked capture thread can have the slot
+
+    def close(self):
+        """Wake up a capture thread blocked waiting for a slot or a reader waiting for a frame,
+        eg when the stream is stopped"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def discard_queued(self):
+        """Drop the frames waiting for the tracker, eg they were cropped to an old field of view"""
+        with self._cond:
+            self._free.extend(self._ready)
+            self._ready.clear()
+            self._cond.notify_all()
+
+    def request_skip(self, frames=None, until=None):
+        """Ask for frames to be skipped rather than decoded and queued.
+        frames is a count of frames not yet captured, until a timestamp (seconds) before which
+        every frame is skipped, including any already queued that are discarded now."""
+        with self._cond:
+            if frames:
+                self.skip_count = max(self.skip_count, int(frames))
+            if until:
+                self.skip_until = max(self.skip_until, until)
+                while self._ready and self.timestamps[self._ready[0]] < self.skip_until:
+                    self._free.append(self._ready.popleft())
+                    self.skipped += 1
+                self._cond.notify_all()
+
+    def skip_frame(self, timestamp):
+        """Called by the capture thread before decoding a frame, True if the frame isn't wanted"""
+        with self._cond:
+            if self.skip_count > 0:
+                self.skip_count -= 1
+            elif timestamp >= self.skip_until:
+                return False
+            self.skipped += 1
+            return True
+
+    def held_timestamps(self):
+        """Timestamps of the frames queued for the tracker and the one it has borrowed"""
+        with self._cond:
+            held = list(self._ready)
+            if self._borrowed is not None:
+                held.append(self._borrowed)
+            return self.timestamps[held]
+
+    def occupancy(self):
+        """Number of frames waiting for the tracker"""
+        return len(self._ready)
+
+    def empty(self):
+        return len(self._ready) == 0
+
+    def stats(self):
+        return {'policy': self.policy,
+                'slots': self.num_slots,
+                'occupancy': len(self._ready),
+                'high_water': self.high_water,
+                'written': self.frames_written,
+                'overwrites': self.overwrites,
+                'dropped': self.dropped,
+                'skipped': self.skipped}
+
+
+class TimestampedFrameStore(object):
+    """Small ring of full frames kept alongside a FrameRingBuffer that only queues a processed
+    (eg cropped gray) version of each frame. The full frame nearest a timestamp is copied out on demand,
+    so it is only materialised if it turns out to be needed. Each new frame overwrites the oldest,
+    other than those the tracker still has to look up, so a stall can't lose the frame for a speed photo."""
+
+    def __init__(self, slots=8):
+        self.num_slots = max(2, int(slots))
+        self.frames = None  # (slots, h, w, c) array, allocated from the first frame
+        self.timestamps = np.full(self.num_slots, np.nan)  # nan marks an empty slot or one being written
+        self._lock = threading.Lock()
+        self._next = 0
+        self.lookups = 0
+        self.misses = 0  # lookups that found nothing (within tolerance)
+        self.kept = 0  # times the oldest frame was passed over as it was still held
+
+    def get_write_slot(self, held=()):
+        """Return (index, slot array) for the next frame, the slot is None until allocated.
+        The frames timestamped in held, eg FrameRingBuffer.held_timestamps(), are not overwritten
+        unless every slot is held. A lookup can't return the slot until it is committed."""
+        with self._lock:
+            idx = self._next
+            if len(held):
+                in_use = np.isin(self.timestamps, held)
+                while in_use[idx] and not in_use.all():
+                    idx = (idx + 1) % self.num_slots
+                    self.kept += 1
+            self._next = (idx + 1) % self.num_slots
+            self.timestamps[idx] = np.nan
+            return idx, None if self.frames is None else self.frames[idx]
+
+    def store(self, idx, frame):
+        """Copy a frame that was not decoded in place into a slot, (re)allocating for a new frame size"""
+        if self.frames is None or self.frames.shape[1:] != frame.shape or self.frames.dtype != frame.dtype:
+            with self._lock:
+                self.frames = np.empty((self.num_slots,) + frame.shape, dtype=frame.dtype)
+                self.timestamps.fill(np.nan)
+        np.copyto(self.frames[idx], frame)
+        return self.frames[idx]
+
+    def commit(self, idx, timestamp):
+        with self._lock:
+            self.timestamps[idx] = timestamp
+
+    def find(self, timestamp, tolerance=None):
+        """Return (copy of the frame, its timestamp) nearest to timestamp,
+        or (None, None) if there is none (within tolerance seconds)"""
+        with self._lock:
+            self.lookups += 1
+            diffs = np.abs(self.timestamps - timestamp)
+            if self.frames is None or np.isnan(diffs).all():
+                self.misses += 1
+                return None, None
+            idx = int(np.nanargmin(diffs))
+            if tolerance is not None and diffs[idx] > tolerance:
+                self.misses += 1
+                return None, None
+            return self.frames[idx].copy(), float(self.timestamps[idx])
+
+    def stats(self):
+        return {'slots': self.num_slots,
+                'lookups': self.lookups,
+                'misses': self.misses,
+                'kept': self.kept}
@@ -0,0 +1,509 @@
+"""
+Motion detection helpers for the speed tracker.
+
+MotionGate is a cheap test run on each gray crop of the tracking area before the full
+contour pipeline (a detector then the blob search). On a quiet road most frames have
+nothing moving, so those frames can skip straight to the bookkeeping.
+
+The detectors are the front ends of the contour pipeline, each turns the gray crop into a
+binary mask of what is moving. The moving objects are then found as connected blobs, returned
+as Blobs, a set of arrays with one entry per blob, so they can be filtered without a Python loop.
+The detectors are selected by name with the [Motion] detector setting:
+    canny            difference with the previous frame, Canny edges and an adaptive threshold.
+                     Copes with changing light but is the most work per frame.
+    running_average  difference with a running average background, threshold and dilate.
+                     The cheapest, for sites with stable lighting.
+    mog2             OpenCV's MOG2 Gaussian mixture background model, open and dilate.
+                     Copes with swaying trees and the like, at more cost than the running average.
+    projection       thresholded frame difference collapsed to a count of changed pixels per column,
+                     vehicles are found from their leading and trailing edges in that 1-D profile
+                     rather than by a 2-D blob search. For traffic crossing a thin horizontal band,
+                     lanes are told apart by the rows without change between them.
+
+PhaseCorrelator is an alternative to measuring speed from the contour edge positions, it measures
+how far the moving region shifted between consecutive gray crops to a fraction of a pixel.
+
+ContourWorkspace holds the gray frames the pipeline works on and each detector preallocates
+the buffers it writes into, so a frame is processed without allocating any new images.
+
+AdaptiveRoi limits the contour pipeline to windows around where the tracked vehicles are expected,
+scanning the whole crop only every so often (or when nothing is tracked) to pick up new vehicles.
+Only the detectors that compare consecutive frames can be windowed, the background models need every pixel.
+"""
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+SPEED_ENGINES = ('edges', 'phase', 'fit')
+
+# Moving blobs, each field an array with one entry per blob. x, y, w, h is the bounding box
+# in the gray crop and area the number of moving pixels (for projection the bounding box area)
+Blobs = namedtuple('Blobs', 'x y w h area')
+NO_BLOBS = Blobs(*[np.empty(0, dtype=np.intp)] * 5)
+
+
+def select_blobs(blobs, keep):
+    """Return the blobs picked by keep, a boolean mask or index array"""
+    return Blobs(*(field[keep] for field in blobs))
+
+
+def padded_runs(padded, max_gap, min_width):
+    """Return (starts, ends) of the runs of ones in padded, a 0/1 int8 array with a 0 at either end,
+    as indexes into the unpadded array with the ends one past the last one. Runs less than max_gap apart
+    are joined, then the runs less than min_width long dropped"""
+    edges = np.diff(padded)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    joined = np.flatnonzero(starts[1:] - ends[:-1] >= max_gap)
+    starts = starts[np.concatenate(([0], joined + 1))] if len(starts) else starts
+    ends = ends[np.concatenate((joined, [len(ends) - 1]))] if len(ends) else ends
+    wide = ends - starts >= min_width
+    return starts[wide], ends[wide]
+
+
+def window(image, rect):
+    """The part of image inside rect (x, y, w, h), a view not a copy. The whole image if rect is None"""
+    if rect is None:
+        return image
+    (x, y, w, h) = rect
+    return image[y:y + h, x:x + w]
+
+
+class MotionGate(object):
+    """Decide whether a frame is worth running the contour pipeline on.
+    Consecutive frames are shrunk by decimate, differenced and the pixels changing by more
+    than pixel_threshold are counted. A frame passes the gate if that count is above
+    min_pixels and noise_factor times the noise floor, the count usually seen with nothing moving.
+    The noise floor is an exponential moving average learnt from frames with no motion.
+    If the noise is so bad that the limit is over max_pixels (about what the smallest vehicle
+    would change), the gate can't tell and lets everything through until the noise drops."""
+
+    def __init__(self, decimate=4, pixel_threshold=20, noise_factor=3.0, min_pixels=4, max_pixels=None,
+                 learn_rate=0.05):
+        self.decimate = max(1, int(decimate))
+        self.pixel_threshold = pixel_threshold
+        self.noise_factor = noise_factor
+        self.min_pixels = min_pixels
+        self.max_pixels = max_pixels
+        self.learn_rate = learn_rate
+        self.noise_floor = 0.0
+        self.last_changed = 0
+        self._passed_last = False
+        self._prev = None
+        self._cur = None
+        self._diff = None
+        self.gated = 0  # frames that skipped the contour pipeline
+        self.passed = 0  # frames that went through it because something changed
+        self.bypassed = 0  # frames that went through it regardless, eg a vehicle is being tracked
+
+    def check(self, gray, force=False):
+        """Return True if the gray frame should go through the contour pipeline.
+        With force the answer is always True, but the frame is still kept for the next check."""
+        height, width = gray.shape[:2]
+        size = (max(1, width // self.decimate), max(1, height // self.decimate))
+        primed = self._cur is not None and self._cur.shape == (size[1], size[0])
+        if not primed:# first frame or the crop has changed
+            self._cur = np.empty((size[1], size[0]), dtype=np.uint8)
+            self._prev = np.empty_like(self._cur)
+            self._diff = np.empty_like(self._cur)
+        self._prev, self._cur = self._cur, self._prev
+        cv2.resize(gray, size, dst=self._cur, interpolation=cv2.INTER_NEAREST)
+        self._passed_last = False
+        if force or not primed:
+            self.bypassed += 1
+            return True
+        cv2.absdiff(self._prev, self._cur, dst=self._diff)
+        cv2.threshold(self._diff, self.pixel_threshold, 255, cv2.THRESH_BINARY, dst=self._diff)
+        self.last_changed = cv2.countNonZero(self._diff)
+        limit = self.limit()
+        if self.last_changed <= limit and (self.max_pixels is None or limit < self.max_pixels):
+            self.gated += 1
+            self._learn(self.last_changed)
+            return False
+        self.passed += 1
+        self._passed_last = True
+        return True
+
+    def limit(self):
+        """Changed pixel count a frame must exceed to pass the gate"""
+        return max(self.min_pixels, self.noise_floor * self.noise_factor)
+
+    def no_motion(self):
+        """Tell the gate the frame it last passed had no motion contours after all, so the change was noise.
+        This lets the noise floor rise, eg in the rain."""
+        if self._passed_last:
+            self._learn(self.last_changed)
+            self._passed_last = False
+
+    def _learn(self, changed):
+        self.noise_floor += self.learn_rate * (changed - self.noise_floor)
+
+    def stats(self):
+        return {'gated': self.gated,
+                'passed': self.passed,
+                'bypassed': self.bypassed,
+                'noise_floor': self.noise_floor,
+                'limit': self.limit()}
+
+
+class ContourWorkspace(object):
+    """Preallocated gray frames for the contour pipeline, the shape of the gray crop of the tracking area.
+    One holds the previous frame while the current frame is written into the other, their roles swap
+    every frame. Rebuild the workspace when the crop changes size."""
+
+    def __init__(self, shape):
+        self.shape = tuple(shape[:2])
+        self.grays = (np.zeros(self.shape, dtype=np.uint8), np.zeros(self.shape, dtype=np.uint8))
+
+    def fits(self, shape):
+        return self.shape == tuple(shape[:2])
+
+    def owns(self, gray):
+        return gray is self.grays[0] or gray is self.grays[1]
+
+    def next_gray(self, previous):
+        """The gray buffer to write the current frame into, the one not holding the previous frame"""
+        return self.grays[1] if previous is self.grays[0] else self.grays[0]
+
+
+class AdaptiveRoi(object):
+    """Search only padded windows of the gray crop around where the tracked vehicles are expected.
+    The whole crop is searched when nothing is being tracked and every full_scan_interval seconds, so
+    new vehicles are still found, and again if a blob of more than min_area px reaches the edge of its
+    window (other than at the edge of the crop) as the vehicle may go on outside it.
+    Vehicles come into view at the left or right of the crop, so entry_width px at each end are always
+    searched too. A vehicle coming in soon reaches the inside edge of its entry window and is then found
+    by a search of the whole crop, rather than waiting for the next full scan.
+    Windows overlapping across the crop are merged, so no blob is found twice. If the windows would cover
+    more than max_fraction of the crop it is quicker to search the lot."""
+
+    def __init__(self, padding=16, full_scan_interval=0.25, min_area=0, entry_width=0, max_fraction=0.75):
+        self.padding = padding
+        self.full_scan_interval = full_scan_interval
+        self.entry_width = entry_width
+        self.min_area = min_area
+        self.max_fraction = max_fraction
+        self.next_full_scan = 0.0
+        self.full_scans = 0  # frames the whole crop was searched
+        self.windowed = 0  # frames only the windows were searched
+        self.rescans = 0  # windowed frames searched again in full because a blob reached a window edge
+        self.pixels = 0  # crop pixels searched, to compare with
+        self.crop_pixels = 0  # the pixels of every crop
+
+    def windows(self, boxes, shape, now):
+        """Return the (x, y, w, h) windows of a crop this shape around boxes, rows of x, y, w, h (any number type),
+        padded and clipped to the crop. None if the whole crop is to be searched"""
+        if not len(boxes) or now >= self.next_full_scan:
+            return None
+        height, width = shape[:2]
+        boxes = np.asarray(boxes, dtype=np.float64)
+        left = np.clip(np.floor(boxes[:, 0] - self.padding), 0, width).astype(int)
+        right = np.clip(np.ceil(boxes[:, 0] + boxes[:, 2] + self.padding), 0, width).astype(int)
+        top = np.clip(np.floor(boxes[:, 1] - self.padding), 0, height).astype(int)
+        bottom = np.clip(np.ceil(boxes[:, 1] + boxes[:, 3] + self.padding), 0, height).astype(int)
+        (left, right, top, bottom) = (left.tolist(), right.tolist(), top.tolist(), bottom.tolist())
+        if self.entry_width > 0:
+            entry = min(int(self.entry_width), width)
+            left += [0, width - entry]
+            right += [entry, width]
+            top += [0, 0]
+            bottom += [height, height]
+        merged = []  # [left, right, top, bottom], in x order and not overlapping in x
+        for i in sorted(range(len(left)), key=left.__getitem__):
+            if right[i] <= left[i] or bottom[i] <= top[i]:# wholly outside the crop
+                continue
+            if merged and left[i] < merged[-1][1]:
+                last = merged[-1]
+                merged[-1] = [last[0], max(last[1], right[i]), min(last[2], top[i]), max(last[3], bottom[i])]
+            else:
+                merged.append([left[i], right[i], top[i], bottom[i]])
+        rects = [(l, t, r - l, b - t) for (l, r, t, b) in merged]
+        if not rects or sum(w * h for (x, y, w, h) in rects) > self.max_fraction * width * height:
+            return None
+        return rects
+
+    def blobs(self, detector, gray, previous, boxes, now):
+        """Return the detector's Blobs for gray, from just the windows around boxes if it can be windowed"""
+        self.crop_pixels += gray.size
+        rects = self.windows(boxes, gray.shape, now) if detector.windowed else None
+        if rects is not None:
+            found = [detector.blobs(gray, previous, rect) for rect in rects]
+            blobs = Blobs(*(np.concatenate(field) for field in zip(*found)))
+            self.pixels += sum(w * h for (x, y, w, h) in rects)
+            if not self._cut(blobs, rects, gray.shape):
+                self.windowed += 1
+                return blobs
+            self.rescans += 1
+        self.full_scans += 1
+        self.pixels += gray.size
+        self.next_full_scan = now + self.full_scan_interval
+        return detector.blobs(gray, previous)
+
+    def _cut(self, blobs, rects, shape):
+        """True if a big enough blob reaches the edge of its window inside the crop"""
+        height, width = shape[:2]
+        big = blobs.area > self.min_area
+        right = blobs.x + blobs.w
+        lower = blobs.y + blobs.h
+        for (x, y, w, h) in rects:
+            inside = big & (blobs.x >= x) & (blobs.x < x + w)  # the windows don't overlap in x
+            edge = (((blobs.x == x) & (x > 0)) | ((right == x + w) & (x + w < width))
+                    | ((blobs.y == y) & (y > 0)) | ((lower == y + h) & (y + h < height)))
+            if (inside & edge).any():
+                return True
+        return False
+
+    def stats(self):
+        return {'full_scans': self.full_scans,
+                'windowed': self.windowed,
+                'rescans': self.rescans,
+                'searched': self.pixels / max(self.crop_pixels, 1)}
+
+
+class MotionDetector(object):
+    """Base for the detectors. allocate() is called with the gray crop shape before the first frame
+    and whenever the crop changes, detect() then returns the motion mask for each frame.
+    The mask is a buffer owned by the detector, only valid until the next detect().
+    The tracker calls blobs(), which finds the connected blobs in the mask unless the detector has a cheaper way.
+    A windowed detector can also be run on just part of the crop, a rect (x, y, w, h), the rest of its buffers
+    are left as they were."""
+    name = None
+    cost = None  # the work done per frame, for the log
+    windowed = False  # True if it only compares consecutive frames, so it can be run on part of the crop
+
+    def __init__(self):
+        self.view = None  # image to show in the threshold window
+        self._labels = None  # label image written by the blob search
+
+    def allocate(self, shape):
+        raise NotImplementedError
+
+    def detect(self, gray, previous, rect=None):
+        """Return the binary motion mask for gray, previous is the gray crop of the frame before.
+        With a rect (windowed detectors only) the mask is just of that part of the crop"""
+        raise NotImplementedError
+
+    def blobs(self, gray, previous, rect=None):
+        """Return the Blobs of 8-connected moving pixels in the mask, in gray crop coordinates even with a rect"""
+        if rect is not None and not self.windowed:
+            raise ValueError("The %s detector needs the whole crop, it can't be windowed" % self.name)
+        if self._labels is None or self._labels.shape != gray.shape:
+            # 16 bit labels are about twice as quick, 8-connected blobs can't number more than a quarter of the pixels
+            self._labels = np.empty(gray.shape, dtype=np.uint16 if gray.size // 4 < 65535 else np.int32)
+        mask = self.detect(gray, previous, rect)
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(
+            mask, labels=window(self._labels, rect), connectivity=8,
+            ltype=cv2.CV_16U if self._labels.dtype == np.uint16 else cv2.CV_32S)
+        stats = stats[1:]  # label 0 is the background
+        (x, y) = (stats[:, cv2.CC_STAT_LEFT], stats[:, cv2.CC_STAT_TOP])
+        if rect is not None:
+            (x, y) = (x + rect[0], y + rect[1])
+        return Blobs(x, y, stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_HEIGHT], stats[:, cv2.CC_STAT_AREA])
+
+
+class CannyDetector(MotionDetector):
+    """Canny edges of the difference between consecutive frames, with an adaptive threshold"""
+    name = 'canny'
+    cost = 'absdiff, Canny, adaptive threshold'
+    windowed = True
+
+    def __init__(self, low=100, high=200):
+        MotionDetector.__init__(self)
+        self.low = low
+        self.high = high
+
+    def allocate(self, shape):
+        self.diff = np.zeros(shape, dtype=np.uint8)
+        self.edges = np.empty(shape, dtype=np.uint8)
+        self.mask = np.empty(shape, dtype=np.uint8)
+        self.view = self.diff
+
+    def detect(self, gray, previous, rect=None):
+        (diff, edges, mask) = (window(image, rect) for image in (self.diff, self.edges, self.mask))
+        cv2.absdiff(window(previous, rect), window(gray, rect), dst=diff)
+        cv2.Canny(diff, self.low, self.high, edges=edges)
+        # use THRESH_BINARY_INV to use a black background, stops picking up border as contour
+        cv2.adaptiveThreshold(edges, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 11, 2,
+                              dst=mask)
+        return mask
+
+
+class RunningAverageDetector(MotionDetector):
+    """Difference with a running average of past frames, thresholded and dilated to join up the blobs.
+    alpha is how quickly the average follows the scene, too slow and it lags lighting changes.
+    A passing vehicle is blended into the average, so for about 1/alpha frames it leaves a fading ghost where
+    it was. Nothing here suppresses the ghosts, the tracker ignores those trailing a confirmed vehicle."""
+    name = 'running_average'
+    cost = 'absdiff, accumulateWeighted, threshold, dilate'
+
+    def __init__(self, alpha=0.02, threshold=25, dilate=2):
+        MotionDetector.__init__(self)
+        self.alpha = alpha
+        self.threshold = threshold
+        self.dilate = dilate
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+
+    def allocate(self, shape):
+        self.average = np.empty(shape, dtype=np.float32)
+        self.background = np.empty(shape, dtype=np.uint8)
+        self.diff = np.zeros(shape, dtype=np.uint8)
+        self.mask = np.empty(shape, dtype=np.uint8)
+        self.primed = False
+        self.view = self.diff
+
+    def detect(self, gray, previous, rect=None):
+        if not self.primed:# start the average from the frame before
+            np.copyto(self.average, previous)
+            self.primed = True
+        cv2.convertScaleAbs(self.average, dst=self.background)
+        cv2.absdiff(gray, self.background, dst=self.diff)
+        cv2.accumulateWeighted(gray, self.average, self.alpha)
+        cv2.threshold(self.diff, self.threshold, 255, cv2.THRESH_BINARY, dst=self.mask)
+        if self.dilate:
+            cv2.dilate(self.mask, self.kernel, dst=self.mask, iterations=self.dilate)
+        return self.mask
+
+
+class MOG2Detector(MotionDetector):
+    """OpenCV's MOG2 background subtractor, with shadow detection off so the mask is only 0 or 255.
+    A morphological open removes speckle before the blobs are dilated.
+    learning_rate -1 lets MOG2 choose it from the history."""
+    name = 'mog2'
+    cost = 'MOG2 apply, open, dilate'
+
+    def __init__(self, history=300, var_threshold=16, learning_rate=-1, dilate=2):
+        MotionDetector.__init__(self)
+        self.history = history
+        self.var_threshold = var_threshold
+        self.learning_rate = learning_rate
+        self.dilate = dilate
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+
+    def allocate(self, shape):
+        self.subtractor = cv2.createBackgroundSubtractorMOG2(self.history, self.var_threshold, detectShadows=False)
+        self.mask = np.zeros(shape, dtype=np.uint8)
+        self.view = self.mask
+
+    def detect(self, gray, previous, rect=None):
+        self.subtractor.apply(gray, self.mask, self.learning_rate)
+        cv2.morphologyEx(self.mask, cv2.MORPH_OPEN, self.kernel, dst=self.mask)
+        if self.dilate:
+            cv2.dilate(self.mask, self.kernel, dst=self.mask, iterations=self.dilate)
+        return self.mask
+
+
+class ColumnProjectionDetector(MotionDetector):
+    """For vehicles moving horizontally through a thin band, the thresholded frame difference is summed
+    down each column and the columns with at least min_pixels changed pixels are the motion profile.
+    Runs of moving columns less than max_gap apart are joined (a plain coloured body only changes at
+    its ends), each joined run from its leading to its trailing edge is a vehicle if it is at least
+    min_width wide. Its rows are the rows with any change within the run.
+    Vehicles in different lanes that overlap in x make one run, so when the rows with change in a run are
+    in bands max_gap or more rows apart, each band is projected again on its own. Lanes closer than that
+    are still taken for one vehicle.
+    The blobs give the tracker the same x positions as a blob search of the mask would, without the
+    2-D work after the difference, everything else is per column."""
+    name = 'projection'
+    cost = 'absdiff, threshold, column sums'
+    windowed = True
+
+    def __init__(self, threshold=20, min_pixels=3, max_gap=20, min_width=10):
+        MotionDetector.__init__(self)
+        self.threshold = threshold
+        self.min_pixels = min_pixels
+        self.max_gap = max_gap
+        self.min_width = min_width
+
+    def allocate(self, shape):
+        self.diff = np.zeros(shape, dtype=np.uint8)
+        self.mask = np.empty(shape, dtype=np.uint8)  # 0 or 1 so the column sums are counts
+        self.profile = np.empty((1, shape[1]), dtype=np.int32)
+        self.moving = np.zeros(shape[1] + 2, dtype=np.int8)  # padded so every run has a start and an end
+        self.view = self.diff
+
+    def detect(self, gray, previous, rect=None):
+        (diff, mask) = (window(image, rect) for image in (self.diff, self.mask))
+        cv2.absdiff(window(previous, rect), window(gray, rect), dst=diff)
+        cv2.threshold(diff, self.threshold, 1, cv2.THRESH_BINARY, dst=mask)
+        return mask
+
+    def blobs(self, gray, previous, rect=None):
+        mask = self.detect(gray, previous, rect)
+        width = mask.shape[1]
+        profile = self.profile[:, :width]
+        moving = self.moving[:width + 2]
+        moving[-1] = 0  # may be left over from a wider run
+        cv2.reduce(mask, 0, cv2.REDUCE_SUM, dst=profile, dtype=cv2.CV_32S)
+        np.greater_equal(profile[0], self.min_pixels, out=moving[1:-1])
+        found = []# (x, y, w, h)
+        for (start, end) in zip(*(edge.tolist() for edge in padded_runs(moving, self.max_gap, self.min_width))):
+            bands = self._bands(mask[:, start:end])# only a few runs
+            if len(bands) == 1:
+                found.append((start, bands[0][0], end - start, bands[0][1] - bands[0][0]))
+                continue
+            for (top, bottom) in bands:# a lane each, vehicles in them may overlap in x
+                band = mask[top:bottom, start:end]
+                band_moving = np.zeros(end - start + 2, dtype=np.int8)
+                np.greater_equal(band.sum(axis=0), self.min_pixels, out=band_moving[1:-1])
+                for (band_start, band_end) in zip(*padded_runs(band_moving, self.max_gap, self.min_width)):
+                    rows = np.flatnonzero(band[:, band_start:band_end].any(axis=1))
+                    found.append((start + band_start, top + rows[0], band_end - band_start, rows[-1] + 1 - rows[0]))
+        (x, y, w, h) = np.array(found, dtype=np.intp).reshape(-1, 4).T
+        if rect is not None:
+            (x, y) = (x + rect[0], y + rect[1])
+        return Blobs(x, y, w, h, w * h)
+
+    def _bands(self, block):
+        """ (top, bottom) of the bands of rows with any change in block, bottom one past the last row"""
+        rows = np.zeros(block.shape[0] + 2, dtype=np.int8)
+        rows[1:-1] = block.any(axis=1)
+        return list(zip(*(edge.tolist() for edge in padded_runs(rows, self.max_gap, 1))))
+
+
+DETECTORS = dict((detector.name, detector) for detector in (CannyDetector, RunningAverageDetector, MOG2Detector,
+                                                            ColumnProjectionDetector))
+
+
+def create_detector(cfg):
+    """Return the detector named by cfg.detector, set up from its config settings"""
+    if cfg.detector == CannyDetector.name:
+        return CannyDetector(cfg.canny_low, cfg.canny_high)
+    if cfg.detector == RunningAverageDetector.name:
+        return RunningAverageDetector(cfg.running_average_alpha, cfg.running_average_threshold, cfg.detector_dilate)
+    if cfg.detector == MOG2Detector.name:
+        return MOG2Detector(cfg.mog2_history, cfg.mog2_var_threshold, cfg.mog2_learning_rate, cfg.detector_dilate)
+    if cfg.detector == ColumnProjectionDetector.name:
+        return ColumnProjectionDetector(cfg.projection_threshold, cfg.projection_min_pixels, cfg.projection_max_gap,
+                                        cfg.projection_min_width)
+    raise ValueError("Unknown motion detector %s, use one of %s" % (cfg.detector, ', '.join(sorted(DETECTORS))))
+
+
+class PhaseCorrelator(object):
+    """Sub-pixel shift of a region between two gray frames by phase correlation.
+    The region should be the bounding rectangle of the motion, so the moving vehicle rather than the
+    still background dominates the correlation. A Hanning window stops the edges of the region
+    swamping the result. The response is the height of the correlation peak (near 1 for a clean
+    shift), a shift with a response under min_response is not trusted."""
+
+    def __init__(self, min_response=0.3):
+        self.min_response = min_response
+        self._window = None
+        self.measured = 0
+        self.rejected = 0
+
+    def shift(self, previous, current, rect):
+        """Return the (dx, dy) shift of the x, y, w, h rect from previous to current, None if unreliable"""
+        x, y, w, h = rect
+        if w < 4 or h < 4:
+            self.rejected += 1
+            return None
+        if self._window is None or self._window.shape != (h, w):
+            self._window = cv2.createHanningWindow((w, h), cv2.CV_32F)
+        (dx, dy), response = cv2.phaseCorrelate(np.float32(previous[y:y + h, x:x + w]),
+                                                np.float32(current[y:y + h, x:x + w]), self._window)
+        if response < self.min_response:
+            self.rejected += 1
+            return None
+        self.measured += 1
+        return dx, dy
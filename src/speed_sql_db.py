@@ -4,23 +4,22 @@ from config import *
 
 
 class SpeedDB(object):
-	def __init__(self, dbpath):
+	def __init__(self, dbpath, cfg):
 		self.dbpath=dbpath
-		self._dbinit
-		self.cfg=Config()
+		self.cfg=cfg
+		self._dbinit()
 		
 	def _dbinit(self):
 		db_conn = self.db_check(self.dbpath)
 		# check and open sqlite3 db
-		if db_conn is not None:
-			db_conn = self.db_open(self.dbpath)
-			if db_conn is None:
-				logging.error("Failed: Connect to sqlite3 DB %s", self.dbpath)
-				db_is_open = False
-			else:
-				logging.info("sqlite3 DB is Open %s", self.dbpath)
-				db_cur = db_conn.cursor()  # Set cursor position
-				db_is_open = True
+		if db_conn is None:
+			return
+		db_conn.close()
+		db_conn = self.db_open(self.dbpath)
+		if db_conn is None:
+			logging.error("Failed: Connect to sqlite3 DB %s", self.dbpath)
+			return
+		logging.info("sqlite3 DB is Open %s", self.dbpath)
 
 		# insert status column into speed table.  Can be used for
 		# alpr (automatic license plate reader) processing to indicate
@@ -119,16 +118,18 @@ class SpeedDB(object):
 	def db_add_record(self,sql_cmd):
 		""" Insert speed_data into sqlite3 database table"""
 		#Note cam_location and status may not be in proper order unless speed table is recreated.
+		db_conn = self.db_check(self.dbpath)
+		if db_conn is None:
+			return
 		try:
-			self.speed_db.db_add_record(sql_cmd)
-			db_conn = self.db_check(self.dbpath)
 			db_conn.execute(sql_cmd)
 			db_conn.commit()
-			db_conn.close()
 		except sqlite3.Error as e:
 				logging.error("sqlite3 DB %s", self.dbpath)
 				logging.error("Failed: To INSERT Speed Data into TABLE %s", self.cfg.DB_TABLE)
 				logging.error("Err Msg: %s", e)
 		else:
 				logging.info(" SQL - Inserted Data Row into %s", self.dbpath)
+		finally:
+			db_conn.close()
 
@@ -0,0 +1,354 @@
+"""
+Matching the moving blobs found in each frame to the vehicles being tracked.
+
+A cost matrix is built with a row per vehicle and a column per blob, the cost being the
+distance between the vehicle's last centroid and the blob's. Pairs that can't be the same
+vehicle are ruled out with an infinite cost: moved too far in x, shifted too much in y, or
+moving against the vehicle's direction of travel. The matrix is then solved either greedily
+(cheapest pair first) or with the Hungarian method, which minimises the total cost, if scipy
+is installed. Blobs left over are new vehicles.
+
+With the kalman predictor each vehicle has a constant velocity Kalman filter of its centroid.
+The cost is then the distance from where the vehicle is expected to be and the x, y gates are
+a few standard deviations of that prediction, much tighter than the fixed limits once the
+vehicle's velocity is known.
+
+Each vehicle's track is held in a TrackBuffer, a preallocated structured array with a row per
+frame the vehicle was matched, so a whole track can be worked on as arrays, and its speed
+samples are summarised as they arrive by a RunningStats. fit_track fits the tracked edge position
+against time over the whole track instead, so the speed isn't thrown by the jitter of a single
+frame's timestamp.
+"""
+import math
+from collections import namedtuple
+
+import numpy as np
+
+try:# only needed for hungarian assignment, may not be installed on a Pi
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+ASSIGNMENT_METHODS = ('greedy', 'hungarian')
+PREDICTORS = ('last', 'kalman')  # where a vehicle is expected, the last centroid or a Kalman prediction
+
+L2R = 1
+R2L = -1
+UNKNOWN = 0  # a vehicle seen only once has no direction yet
+# the life of a tracked vehicle. A new vehicle is tentative until it has been matched a few times,
+# it is dropped (lost) as soon as it is missed. Confirmed vehicles are lost once unseen for a while.
+# A finished vehicle has been measured, it is kept while it is in view so it isn't tracked again
+TENTATIVE = 'tentative'
+CONFIRMED = 'confirmed'
+FINISHED = 'finished'
+LOST = 'lost'
+
+DIRECTIONS = {"L2R": L2R, "R2L": R2L}
+DIRECTION_NAMES = {L2R: "L2R", R2L: "R2L", UNKNOWN: None}
+
+# x = intercept + slope * (t - first t). slope in px/sec, its standard error and 95% margin of error,
+# residual the (weighted) standard deviation of the positions from the line in px
+TrackFit = namedtuple('TrackFit', 'slope intercept residual slope_se moe points')
+# two sided 95% Student t for 1 to 10 degrees of freedom, a short track can't use the normal 1.96
+T_95 = (12.71, 4.30, 3.18, 2.78, 2.57, 2.45, 2.36, 2.31, 2.26, 2.23)
+HUBER_K = 1.345  # residuals beyond this many scales are down weighted
+PIXEL_SIGMA = 1 / math.sqrt(12)  # error of a position rounded to a whole pixel, the least that can be assumed
+
+# one row of a track. x is the tracked edge, the right hand one for L2R. cx, cy is the blob centroid
+TRACK_DTYPE = np.dtype([('x', np.int32), ('y', np.int32), ('w', np.int32), ('h', np.int32),
+                        ('cx', np.int32), ('cy', np.int32), ('area', np.int32),
+                        ('t', np.float64), ('dir', np.int8)])
+
+
+class TrackBuffer(object):
+    """The rows of one vehicle's track in a preallocated structured array, grown by doubling when full.
+    Indexing by field name gives a view of that column for the rows filled so far, eg buffer['t']"""
+
+    def __init__(self, capacity=16):
+        self.rows = np.zeros(max(2, int(capacity)), dtype=TRACK_DTYPE)
+        self.length = 0
+
+    def append(self, x, y, w, h, cx, cy, area, t, direction):
+        if self.length == len(self.rows):
+            rows = np.zeros(2 * len(self.rows), dtype=TRACK_DTYPE)
+            rows[:self.length] = self.rows
+            self.rows = rows
+        self.rows[self.length] = (x, y, w, h, cx, cy, area, t, direction)
+        self.length += 1
+
+    def clear(self):
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, field):
+        return self.rows[field][:self.length]
+
+    @property
+    def records(self):
+        """the filled rows"""
+        return self.rows[:self.length]
+
+    def px_per_sec(self):
+        """the speed in px/sec of the tracked edge between each pair of rows"""
+        x = self['x']
+        t = self['t']
+        dt = np.diff(t)
+        return np.abs(np.diff(x))[dt > 0] / dt[dt > 0]
+
+
+class RunningStats(object):
+    """Running mean and (population) variance of a vehicle's speed samples by Welford's method,
+    so the average, StdDev and MoE are there after every sample without keeping the samples.
+    Once min_samples have been accepted, a sample further from the mean than outlier_sigma
+    standard deviations (and at least outlier_min) is rejected, 0 turns that off."""
+
+    def __init__(self, outlier_sigma=0.0, outlier_min=0.0, min_samples=3):
+        self.outlier_sigma = outlier_sigma
+        self.outlier_min = outlier_min
+        self.min_samples = max(2, int(min_samples))
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0  # sum of the squared differences from the mean
+        self.first = None  # the first sample accepted, so it can be discarded later
+        self.rejected = 0
+
+    def is_outlier(self, value):
+        if not self.outlier_sigma or self.count < self.min_samples:
+            return False
+        return abs(value - self.mean) > max(self.outlier_sigma * self.stddev, self.outlier_min)
+
+    def add(self, value):
+        """Add a sample, returns False if it was rejected as an outlier"""
+        value = float(value)
+        if self.is_outlier(value):
+            self.rejected += 1
+            return False
+        if self.count == 0:
+            self.first = value
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        return True
+
+    def discard(self, value):
+        """Take back a sample that was added, the reverse of add()"""
+        value = float(value)
+        if self.count <= 1:
+            first, rejected = self.first, self.rejected
+            self.reset()
+            self.first, self.rejected = first, rejected
+            return
+        delta = value - self.mean
+        self.mean -= delta / (self.count - 1)
+        self._m2 = max(0.0, self._m2 - delta * (value - self.mean))
+        self.count -= 1
+
+    def discard_first(self):
+        if self.count and self.first is not None:
+            self.discard(self.first)
+            self.first = None
+
+    @property
+    def variance(self):
+        return self._m2 / self.count if self.count else 0.0
+
+    @property
+    def stddev(self):
+        return math.sqrt(self.variance)
+
+    @property
+    def moe(self):
+        """95% margin of error of the mean"""
+        return self.stddev / math.sqrt(self.count) * 1.96 if self.count else 0.0
+
+
+def fit_track(t, x, robust=True, iterations=5):
+    """Least squares fit of the positions x (px) against the times t (sec) of a track.
+    With robust the fit is repeated with Huber weights (iteratively reweighted least squares) so a
+    few bad positions eg a blob that merged with another for a frame, hardly count.
+    Returns a TrackFit or None if there are fewer than 3 points or they all have the same time."""
+    points = len(t)
+    if points < 3:
+        return None
+    t = np.asarray(t, dtype=np.float64)
+    t = t - t[0]
+    x = np.asarray(x, dtype=np.float64)
+    design = np.column_stack((t, np.ones(points)))
+    weights = np.ones(points)
+    for _ in range(iterations if robust else 1):
+        root_w = np.sqrt(weights)
+        (slope, intercept), _, rank, _ = np.linalg.lstsq(design * root_w[:, np.newaxis], x * root_w, rcond=None)
+        if rank < 2:
+            return None
+        resid = x - (slope * t + intercept)
+        if not robust:
+            break
+        scale = max(1.4826 * np.median(np.abs(resid)), PIXEL_SIGMA)  # MAD, as a standard deviation
+        new_weights = np.minimum(1.0, HUBER_K * scale / np.maximum(np.abs(resid), 1E-12))
+        if np.allclose(new_weights, weights, atol=1E-3):
+            break
+        weights = new_weights
+    sigma = max(math.sqrt(np.sum(weights * resid ** 2) / (points - 2)), PIXEL_SIGMA)
+    t_mean = np.sum(weights * t) / np.sum(weights)
+    slope_se = sigma / math.sqrt(np.sum(weights * (t - t_mean) ** 2))
+    t_95 = T_95[points - 3] if points - 2 <= len(T_95) else 1.96
+    return TrackFit(float(slope), float(intercept), sigma, slope_se, t_95 * slope_se, points)
+
+
+class _AxisFilter(object):
+    """Kalman filter of position and velocity along one axis, the 2x2 matrices written out"""
+
+    def __init__(self, position, position_var, velocity_var):
+        self.p = float(position)
+        self.v = 0.0
+        self.pp = position_var  # covariance [[pp, pv], [pv, vv]]
+        self.pv = 0.0
+        self.vv = velocity_var
+
+    def predicted(self, dt, q):
+        """(position, position variance) dt seconds on, the state is not changed"""
+        return (self.p + self.v * dt,
+                self.pp + 2 * dt * self.pv + dt * dt * self.vv + q * dt ** 3 / 3)
+
+    def step(self, dt, q, z, r):
+        """predict dt seconds on then correct with the measured position z of variance r"""
+        self.p += self.v * dt
+        self.pp += 2 * dt * self.pv + dt * dt * self.vv + q * dt ** 3 / 3
+        self.pv += dt * self.vv + q * dt * dt / 2
+        self.vv += q * dt
+        s = self.pp + r
+        k_p = self.pp / s
+        k_v = self.pv / s
+        innovation = z - self.p
+        self.p += k_p * innovation
+        self.v += k_v * innovation
+        self.vv -= k_v * self.pv
+        self.pv *= 1 - k_p
+        self.pp *= 1 - k_p
+
+
+class KalmanPredictor(object):
+    """Constant velocity Kalman filter of a vehicle's centroid, x and y filtered separately.
+    measurement_sigma (px) is how much a blob centroid wanders from the vehicle eg as it enters the view,
+    accel_sigma (px/sec^2) how much the velocity can change, speed_sigma (px/sec) the uncertainty of
+    the velocity before the second sighting"""
+
+    def __init__(self, t, x, y, measurement_sigma=3.0, accel_sigma=300.0, speed_sigma=500.0):
+        self.t = t
+        self.r = measurement_sigma ** 2
+        self.q = accel_sigma ** 2
+        self.x = _AxisFilter(x, self.r, speed_sigma ** 2)
+        self.y = _AxisFilter(y, self.r, speed_sigma ** 2)
+        self.updates = 0
+
+    def predict(self, t):
+        """(x, y, x sigma, y sigma) expected for the centroid at time t, the sigmas include the measurement noise"""
+        dt = max(0.0, t - self.t)
+        x, x_var = self.x.predicted(dt, self.q)
+        y, y_var = self.y.predicted(dt, self.q)
+        return x, y, math.sqrt(x_var + self.r), math.sqrt(y_var + self.r)
+
+    def update(self, t, x, y):
+        dt = max(0.0, t - self.t)
+        self.x.step(dt, self.q, x, self.r)
+        self.y.step(dt, self.q, y, self.r)
+        self.t = t
+        self.updates += 1
+
+    @property
+    def velocity(self):
+        """(x, y) in px/sec"""
+        return self.x.v, self.y.v
+
+
+def kalman_gate(sigma, half_size, gate_sigma, min_gate, max_gate):
+    """Return the gate (px) around a predicted centroid from the sigma of the prediction, one value or an array.
+    It is never less than half_size, half the size of the blob or of the vehicle's last blob: when a blob
+    splits or merges with another its centroid moves by up to that much, however well the velocity is known"""
+    return np.clip(np.maximum(gate_sigma * np.asarray(sigma), half_size), min_gate, max_gate)
+
+
+def confirmed_state(state, matches, track_confirm):
+    """Return the state of a vehicle whose track has matches rows, a tentative one is confirmed at track_confirm"""
+    if state == TENTATIVE and matches >= track_confirm:
+        return CONFIRMED
+    return state
+
+
+def aged_state(state, unseen, event_timeout, track_timeout):
+    """Return the state of a vehicle last seen unseen seconds ago, or None if it is finished and can be forgotten.
+    A tentative vehicle is lost as soon as it is missed, a confirmed one once unseen for over event_timeout"""
+    if (state == TENTATIVE and unseen > 0) or (state == CONFIRMED and unseen > event_timeout):
+        return LOST
+    if state == FINISHED and unseen > track_timeout:
+        return None
+    return state
+
+
+def cost_matrix(track_x, track_y, track_dir, blob_x, blob_y, max_dx, max_dy, last_x=None):
+    """Return the (vehicles, blobs) cost matrix from where each vehicle's centroid is expected and the blob centroids.
+    track_dir is L2R, R2L or UNKNOWN for each vehicle. max_dx, max_dy are the gates, one for all,
+    one per vehicle or a (vehicles, blobs) array. The direction is checked from last_x, where each vehicle was last seen, if it
+    isn't where it is expected."""
+    dx = blob_x[np.newaxis, :] - track_x[:, np.newaxis]
+    dy = blob_y[np.newaxis, :] - track_y[:, np.newaxis]
+    cost = np.hypot(dx, dy)
+    moved = dx if last_x is None else blob_x[np.newaxis, :] - last_x[:, np.newaxis]
+    (max_dx, max_dy) = (gate if np.ndim(gate) == 2 else np.reshape(gate, (-1, 1)) for gate in (max_dx, max_dy))
+    ruled_out = ((np.abs(dx) > max_dx) | (np.abs(dy) > max_dy)
+                 | (track_dir[:, np.newaxis] * moved < 0))
+    cost[ruled_out] = np.inf
+    return cost
+
+
+def assign(cost, method='greedy'):
+    """Return (rows, cols) index arrays of the matched vehicle, blob pairs.
+    Ruled out pairs are never matched, so some rows and columns may be left over."""
+    if not np.isfinite(cost).any():
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    if method == 'hungarian' and linear_sum_assignment is not None:
+        finite = np.isfinite(cost)
+        # a large finite cost for the ruled out pairs, so there is always a solution to drop them from
+        rows, cols = linear_sum_assignment(np.where(finite, cost, cost[finite].sum() + 1.0))
+        keep = finite[rows, cols]
+        return rows[keep], cols[keep]
+    # greedy, the cheapest pairs first. Ties keep vehicle then blob order so the result is repeatable
+    order = np.argsort(cost, axis=None, kind='stable')
+    order = order[np.isfinite(cost.ravel()[order])]
+    used_rows = np.zeros(cost.shape[0], dtype=bool)
+    used_cols = np.zeros(cost.shape[1], dtype=bool)
+    rows = []
+    cols = []
+    for row, col in zip(*np.unravel_index(order, cost.shape)):
+        if used_rows[row] or used_cols[col]:
+            continue
+        used_rows[row] = used_cols[col] = True
+        rows.append(row)
+        cols.append(col)
+        if len(rows) == min(cost.shape):
+            break
+    return np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)
+
+
+def overlaps(blob_x, blob_y, blob_w, blob_h, box_x, box_y, box_w, box_h):
+    """Return the (blobs, boxes) bool matrix of which blob bounding boxes overlap which boxes"""
+    return ((blob_x[:, np.newaxis] < box_x + box_w) & (blob_x[:, np.newaxis] + blob_w[:, np.newaxis] > box_x)
+            & (blob_y[:, np.newaxis] < box_y + box_h) & (blob_y[:, np.newaxis] + blob_h[:, np.newaxis] > box_y))
+
+
+def trail_box(box, direction, length):
+    """Return box (x, y, w, h) stretched back against the direction of travel to length px from its leading edge,
+    where more of the same vehicle can follow its blob, eg canny finds a plain vehicle's front and rear as
+    separate blobs. length is about that of a vehicle. The box is unchanged if the direction isn't known"""
+    (x, y, w, h) = box
+    if direction == L2R:
+        return (min(x, x + w - length), y, max(w, length), h)
+    if direction == R2L:
+        return (x, y, max(w, length), h)
+    return box
@@ -0,0 +1,46 @@
+from speed_batch import SpeedRecord, merge_chunk_records, plan_chunks
+
+
+def record(timestamp, speed, direction='L2R'):
+    return SpeedRecord(timestamp, direction, speed, None, None, None)
+
+
+def test_merge_drops_a_vehicle_tracked_by_both_chunks():
+    chunks = plan_chunks(20.0, 2, 2.0)# owned ranges split at 10 s
+    kept, dropped = merge_chunk_records(chunks, [[record(9.9, 30.0)], [record(10.1, 30.5)]], 0.0, 1.0)
+    assert kept == [record(9.9, 30.0)]
+    assert dropped == [record(10.1, 30.5)]
+
+
+def test_merge_keeps_a_close_follower():
+    chunks = plan_chunks(20.0, 2, 2.0)
+    follower = record(10.4, 33.0)
+    kept, dropped = merge_chunk_records(chunks, [[record(9.9, 30.0)], [follower]], 0.0, 1.0)
+    assert kept == [record(9.9, 30.0), follower] and not dropped
+    # nor is a vehicle the other way
+    oncoming = record(10.1, 30.0, 'R2L')
+    kept, dropped = merge_chunk_records(chunks, [[record(9.9, 30.0)], [oncoming]], 0.0, 1.0)
+    assert oncoming in kept and not dropped
+
+
+def test_merge_drops_records_another_chunk_owns():
+    chunks = plan_chunks(20.0, 2, 2.0)
+    # the first chunk runs on past 10 s to finish its vehicles, the second starts before to pick them up
+    kept, dropped = merge_chunk_records(chunks, [[record(5.0, 30.0), record(11.0, 40.0)],
+                                                 [record(9.0, 50.0), record(15.0, 30.0)]], 0.0, 1.0)
+    assert [rec.timestamp for rec in kept] == [5.0, 15.0]
+    assert sorted(rec.timestamp for rec in dropped) == [9.0, 11.0]
+
+
+def test_plan_chunks_cover_the_file_with_overlaps():
+    chunks = plan_chunks(60.0, 3, 5.0)
+    assert len(chunks) == 3
+    assert chunks[0].start == float('-inf') and chunks[-1].end == float('inf')
+    assert [chunk.end for chunk in chunks[:-1]] == [chunk.start for chunk in chunks[1:]] == [20.0, 40.0]
+    assert [chunk.run_start for chunk in chunks] == [0.0, 15.0, 35.0]
+    assert [chunk.run_end for chunk in chunks] == [25.0, 45.0, None]# the last runs to the end of the file
+
+
+def test_plan_chunks_are_at_least_twice_the_overlap():
+    assert len(plan_chunks(60.0, 8, 5.0)) == 6
+    assert len(plan_chunks(8.0, 4, 5.0)) == 1
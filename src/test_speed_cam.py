@@ -0,0 +1,191 @@
+import importlib.util
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from speed_batch import SpeedRecord, load_checkpoint
+from speed_motion import Blobs
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+WIDTH, HEIGHT = 400, 100# of the tracking area
+FPS = 25.0
+
+
+@pytest.fixture(scope='module')
+def speed_cam(tmp_path_factory):
+    """speed-cam.py imported from a copy of the tree, so its logs and data directories are made there"""
+    root = tmp_path_factory.mktemp('speed_cam')
+    shutil.copytree(os.path.join(SRC_DIR, '..', 'overlays'), str(root / 'overlays'))
+    (root / 'src').mkdir()
+    for name in ('speed-cam.py', 'logging.conf'):
+        shutil.copy(os.path.join(SRC_DIR, name), str(root / 'src'))
+    cwd = os.getcwd()
+    os.chdir(str(root))
+    try:
+        spec = importlib.util.spec_from_file_location('speed_cam', str(root / 'src' / 'speed-cam.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+    return module
+
+
+@pytest.fixture
+def tracker(speed_cam, monkeypatch):
+    """a SpeedTrack that doesn't read a stream, blobs are given to it with track_blobs"""
+    monkeypatch.setattr(speed_cam.SpeedTrack, 'speed_tracker', lambda self: None)
+    for name, size in (('image_width', WIDTH), ('image_height', HEIGHT)):# set by the main program
+        monkeypatch.setattr(speed_cam, name, size, raising=False)
+    monkeypatch.setattr(speed_cam, 'rc', speed_cam.SpeedCam(), raising=False)# speed units
+    monkeypatch.setattr(speed_cam.cfg, 'gui_window_on', False)
+    monkeypatch.setattr(speed_cam.cfg, 'concurrent_tracking', True)
+    monkeypatch.setattr(speed_cam.cfg, 'track_counter', 50)# so no track completes
+
+    def make(predictor):
+        monkeypatch.setattr(speed_cam.cfg, 'predictor', predictor)
+        return speed_cam.SpeedTrack(True, (0, WIDTH, 0, HEIGHT), 'media/images', record_sink=[])
+    return make
+
+
+def track(tracker, frame_no, *boxes):
+    """give the tracker the blobs (x, y, w, h) found in a frame"""
+    blobs = Blobs(*(np.array(field, dtype=np.intp) for field in zip(*boxes)),
+                  np.array([w * h for (x, y, w, h) in boxes], dtype=np.intp))
+    image = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+    tracker.track_blobs(blobs, len(boxes), (image, frame_no / FPS), image)
+
+
+@pytest.mark.parametrize('predictor', ['last', 'kalman'])
+def test_a_vehicle_whose_blob_splits_is_still_one_vehicle(tracker, predictor):
+    speed_track = tracker(predictor)
+    for frame_no in range(6):# 10 px a frame, long enough for the kalman gate to narrow
+        track(speed_track, frame_no, (20 + 10 * frame_no, 20, 60, 40))
+    # the middle of the vehicle is missed, each piece is about half the vehicle away from its centroid
+    track(speed_track, 6, (80, 20, 25, 40), (115, 20, 25, 40))
+    assert len(speed_track.vehicles[0].track) == 7
+    assert speed_track.track_counts['pieces'] == 1
+    # and whole again
+    track(speed_track, 7, (90, 20, 60, 40))
+    assert len(speed_track.vehicles) == 1
+    assert speed_track.track_counts['created'] == 1
+
+
+def test_the_rear_of_a_vehicle_found_behind_it_is_not_a_new_vehicle(tracker):
+    speed_track = tracker('last')
+    for frame_no in range(4):# confirmed
+        track(speed_track, frame_no, (100 + 10 * frame_no, 20, 40, 40))
+    # its rear a separate blob just behind it, and a vehicle far behind in the same lane
+    track(speed_track, 4, (140, 20, 40, 40), (105, 20, 25, 40), (0, 20, 40, 40))
+    assert speed_track.track_counts['trailing'] == 1
+    assert speed_track.track_counts['created'] == 2
+
+
+class FakeStream(object):
+    """stands in for the WebcamVideoStream reading a range of a recording"""
+    def __init__(self, CAM_SRC, start_time=0, end_time=None, **kwargs):
+        (self.src, self.start_time, self.stopped) = (CAM_SRC, start_time, False)
+
+    def start(self):
+        return self
+
+    def stop(self):
+        self.stopped = True
+
+
+class InlinePool(object):
+    """a multiprocessing.Pool that runs the tasks in this process"""
+    def __init__(self, processes=None, initializer=None):
+        pass
+
+    def starmap(self, func, iterable):
+        return [func(*args) for args in iterable]
+
+    def imap_unordered(self, func, iterable):
+        return (func(arg) for arg in iterable)
+
+    def close(self):
+        pass
+
+    terminate = join = close
+
+
+def speed_record(timestamp, image_file=None):
+    return SpeedRecord(timestamp, 'L2R', 30.0, image_file, None, None)
+
+
+@pytest.fixture
+def workers(speed_cam, monkeypatch, tmp_path):
+    """process_file_range and the batch run in this process on the FakeStream of empty files.
+    The SpeedTrack of each range finds the records in found, it is interrupted if its (src, start_time)
+    is in interrupted. The records written go to the returned list"""
+    for name in ('vs', 'rc', 'sfu', 'image_width', 'image_height', 'image_path', 'y_upper'):# set by the workers
+        monkeypatch.setattr(speed_cam, name, getattr(speed_cam, name, None), raising=False)
+    for name in ('headless', 'gui_window_on', 'file_replay_fast', 'file_loop'):
+        monkeypatch.setattr(speed_cam.cfg, name, getattr(speed_cam.cfg, name))
+    monkeypatch.setattr(speed_cam.cfg, 'log_data_to_DB', False)
+    monkeypatch.setattr(speed_cam, 'image_path', str(tmp_path))
+    monkeypatch.setattr(speed_cam, 'WebcamVideoStream', FakeStream)
+    monkeypatch.setattr(speed_cam.multiprocessing, 'Pool', InlinePool)
+    monkeypatch.setattr(speed_cam, 'init_settings', lambda: None)
+    monkeypatch.setattr(speed_cam, 'get_file_info', lambda src: (320, 240, 20.0))
+    written = []
+    monkeypatch.setattr(speed_cam, 'output_speed_record', lambda record, speed_db=None: written.append(record))
+    found, interrupted = {}, set()
+
+    def speed_track(isFile, rect, image_path, record_sink):
+        key = (speed_cam.vs.src, speed_cam.vs.start_time)
+        record_sink.extend(found.get(key, []))
+        if key in interrupted:
+            raise KeyboardInterrupt()
+    monkeypatch.setattr(speed_cam, 'SpeedTrack', speed_track)
+    return found, interrupted, written
+
+
+def video_file(tmp_path, name):
+    src = tmp_path / name
+    src.write_bytes(b'')
+    return str(src)
+
+
+def test_a_range_interrupted_is_not_complete(speed_cam, workers, tmp_path):
+    (found, interrupted, _) = workers
+    src = video_file(tmp_path, 'a.avi')
+    found[(src, 0)] = [speed_record(1.0)]
+    assert speed_cam.process_file_range(src, 0, None, (0, 320, 0, 240), (320, 240), '.') == ([speed_record(1.0)], True)
+    interrupted.add((src, 0))
+    assert speed_cam.process_file_range(src, 0, None, (0, 320, 0, 240), (320, 240), '.') == ([speed_record(1.0)], False)
+    assert speed_cam.vs.stopped
+
+
+def test_a_batch_checkpoints_only_the_files_processed_to_the_end(speed_cam, workers, tmp_path):
+    (found, interrupted, written) = workers
+    (done, cut_short) = (video_file(tmp_path, 'a.avi'), video_file(tmp_path, 'b.avi'))
+    image = tmp_path / 'b.jpg'
+    image.write_bytes(b'')
+    found[(done, 0)] = [speed_record(1.0)]
+    found[(cut_short, 0)] = [speed_record(2.0, str(image))]
+    interrupted.add((cut_short, 0))
+    checkpoint = str(tmp_path / 'batch.json')
+    speed_cam.process_batch(str(tmp_path), 1, checkpoint)
+    assert list(load_checkpoint(checkpoint)) == [done]
+    assert written == [speed_record(1.0)]
+    assert not image.exists()# made again when the file is rerun
+    # the rerun does the rest
+    interrupted.clear()
+    speed_cam.process_batch(str(tmp_path), 1, checkpoint)
+    assert sorted(load_checkpoint(checkpoint)) == [done, cut_short]
+    assert written == [speed_record(1.0), speed_record(2.0, str(image))]
+
+
+def test_the_chunks_of_an_interrupted_file_are_not_merged(speed_cam, workers, tmp_path):
+    (found, interrupted, written) = workers
+    src = video_file(tmp_path, 'a.avi')
+    base_time = os.path.getctime(src)
+    found[(src, 0)] = [speed_record(base_time + 1.0)]# the first of two 10 s chunks
+    found[(src, 8.0)] = [speed_record(base_time + 15.0)]
+    assert speed_cam.process_file_chunks(src, 2, 2.0) == written == found[(src, 0)] + found[(src, 8.0)]
+    del written[:]
+    interrupted.add((src, 8.0))
+    assert speed_cam.process_file_chunks(src, 2, 2.0) == written == []
@@ -0,0 +1,129 @@
+import threading
+
+import numpy as np
+import pytest
+
+from speed_frame_buffer import FrameRingBuffer, TimestampedFrameStore
+
+
+def capture(ring, store, timestamp):
+    """what the capture thread does with a frame when only the gray crop is queued"""
+    idx, slot = ring.get_write_slot()
+    if idx is None:
+        return
+    full_idx, full_slot = store.get_write_slot(ring.held_timestamps())
+    store.store(full_idx, np.full((4, 6, 3), timestamp, dtype=np.uint8))
+    ring.store(idx, np.full((2, 3), timestamp, dtype=np.uint8))
+    store.commit(full_idx, timestamp)
+    ring.commit(idx, timestamp)
+
+
+def test_store_keeps_the_full_frame_of_a_borrowed_slot_through_a_stall():
+    ring, store = FrameRingBuffer(4, 'drop_oldest'), TimestampedFrameStore(6)
+    capture(ring, store, 1)
+    (frame, timestamp) = ring.borrow()
+    for later in range(2, 40):# the tracker stalls on the frame it borrowed
+        capture(ring, store, later)
+    image, found = store.find(timestamp)
+    assert found == timestamp and (image == 1).all()
+    assert store.stats()['kept'] > 0
+    # so are the frames still queued
+    for (gray, queued) in iter(ring.borrow, None):
+        assert store.find(queued)[1] == queued
+
+
+def test_store_overwrites_the_oldest_when_nothing_is_held():
+    store = TimestampedFrameStore(3)
+    for timestamp in range(1, 5):
+        idx, slot = store.get_write_slot()
+        store.store(idx, np.zeros((2, 2, 3), dtype=np.uint8))
+        store.commit(idx, timestamp)
+    assert store.find(1, tolerance=0.5) == (None, None)
+    assert store.find(4)[1] == 4
+    assert store.stats()['misses'] == 1 and store.stats()['lookups'] == 2
+
+
+def fill(ring, *timestamps):
+    for timestamp in timestamps:
+        idx, slot = ring.get_write_slot()
+        if idx is not None:
+            ring.store(idx, np.full((2, 3), timestamp, dtype=np.uint8))
+            ring.commit(idx, timestamp)
+
+
+def read_all(ring):
+    return [float(timestamp) for (frame, timestamp) in iter(ring.borrow, None)]
+
+
+def test_unknown_policy_is_refused():
+    with pytest.raises(ValueError):
+        FrameRingBuffer(4, 'fastest')
+
+
+def test_borrowed_frame_is_the_slot_and_oldest_first():
+    ring = FrameRingBuffer(4, 'block')
+    fill(ring, 1, 2)
+    (frame, timestamp) = ring.borrow()
+    assert timestamp == 1 and (frame == 1).all() and frame.base is ring.frames
+    assert read_all(ring) == [2]
+
+
+def test_drop_oldest_overwrites_the_oldest_queued_frame():
+    ring = FrameRingBuffer(4, 'drop_oldest')
+    fill(ring, *range(1, 7))
+    assert read_all(ring) == [3, 4, 5, 6]
+    stats = ring.stats()
+    assert stats['overwrites'] == stats['dropped'] == 2 and stats['written'] == 6
+
+
+def test_drop_newest_discards_the_new_frame():
+    ring = FrameRingBuffer(4, 'drop_newest')
+    fill(ring, *range(1, 7))
+    assert read_all(ring) == [1, 2, 3, 4]
+    assert ring.stats()['dropped'] == 2 and ring.stats()['overwrites'] == 0
+
+
+def test_latest_keeps_only_the_newest_frame():
+    ring = FrameRingBuffer(4, 'latest')
+    fill(ring, 1, 2, 3)
+    assert read_all(ring) == [3]
+    assert ring.stats()['dropped'] == 2
+
+
+def test_block_waits_for_the_tracker():
+    ring = FrameRingBuffer(3, 'block')
+    fill(ring, 1, 2)
+    ring.borrow()# the third slot is still being written into when the ring is full
+    idx, slot = ring.get_write_slot()
+    ring.commit(idx, 3)
+    got = []
+    writer = threading.Thread(target=lambda: got.append(ring.get_write_slot()[0]))
+    writer.start()
+    writer.join(0.2)
+    assert writer.is_alive()# no free slot
+    ring.borrow()# releases the slot borrowed before
+    writer.join(1.0)
+    assert got and got[0] is not None and ring.stats()['dropped'] == 0
+
+
+def test_close_wakes_a_blocked_writer_and_reader():
+    ring = FrameRingBuffer(3, 'block')
+    assert ring.borrow(timeout=0.05) is None
+    fill(ring, 1, 2, 3)
+    got = []
+    writer = threading.Thread(target=lambda: got.append(ring.get_write_slot()))
+    writer.start()
+    ring.close()
+    writer.join(1.0)
+    assert got == [(None, None)]
+
+
+def test_skip_frames_by_count_and_by_time():
+    ring = FrameRingBuffer(8, 'block')
+    ring.request_skip(frames=2)
+    assert [ring.skip_frame(t) for t in (1, 2, 3)] == [True, True, False]
+    fill(ring, 3, 4, 5)
+    ring.request_skip(until=5)# frames already queued before then are discarded unread
+    assert ring.skip_frame(4.5) and not ring.skip_frame(5)
+    assert read_all(ring) == [5]
+    assert ring.stats()['skipped'] == 5
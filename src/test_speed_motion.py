@@ -0,0 +1,72 @@
+import numpy as np
+
+from speed_motion import ColumnProjectionDetector, MotionGate
+
+
+def road(seed=0):
+    return np.random.default_rng(seed).integers(80, 120, (60, 160), dtype=np.uint8)
+
+
+def with_vehicle(gray, x):
+    frame = gray.copy()
+    frame[20:40, x:x + 30] = 220
+    return frame
+
+
+def test_gate_passes_the_first_frame_and_a_moving_vehicle():
+    gate = MotionGate()
+    background = road()
+    assert gate.check(background)# nothing to compare with yet
+    assert not gate.check(background)
+    assert gate.check(with_vehicle(background, 40))
+    assert gate.stats()['passed'] == 1 and gate.stats()['gated'] == 1
+
+
+def test_gate_is_forced_while_tracking_but_still_keeps_the_frame():
+    gate = MotionGate()
+    background = road()
+    gate.check(background)
+    assert gate.check(with_vehicle(background, 40), force=True)
+    assert gate.stats()['bypassed'] == 2
+    # compared with the forced frame, not the one before it
+    assert not gate.check(with_vehicle(background, 40))
+
+
+def test_noise_floor_is_learnt_from_what_turns_out_to_be_noise():
+    gate = MotionGate(min_pixels=1, learn_rate=0.5)
+    gate.check(road(0))
+    noisy = [road(seed) for seed in range(1, 9)]
+    for frame in noisy:
+        if gate.check(frame):
+            gate.no_motion()# no vehicle was found in it
+    assert gate.noise_floor > 0 and gate.limit() == gate.noise_floor * gate.noise_factor
+
+
+def with_textured_vehicles(gray, *boxes, seed=1):
+    """a vehicle with a textured body at each (x, y, w, h), every pixel of it changes as it moves"""
+    frame = gray.copy()
+    rng = np.random.default_rng(seed)
+    for (x, y, w, h) in boxes:
+        frame[y:y + h, x:x + w] = rng.integers(0, 256, (h, w), dtype=np.uint8)
+    return frame
+
+
+def projection_blobs(previous, gray):
+    detector = ColumnProjectionDetector()
+    detector.allocate(gray.shape)
+    blobs = detector.blobs(gray, previous)
+    return sorted(zip(*(field.tolist() for field in blobs[:4])))
+
+
+def test_projection_finds_a_vehicle_from_its_leading_to_trailing_edge():
+    background = road()
+    # a plain body only changes at its ends, less than max_gap apart
+    assert projection_blobs(with_vehicle(background, 40), with_vehicle(background, 55)) == [(40, 20, 45, 20)]
+
+
+def test_projection_separates_vehicles_in_lanes_that_overlap_in_x():
+    background = np.random.default_rng(0).integers(80, 120, (100, 200), dtype=np.uint8)
+    # L2R in the top lane, R2L in the bottom lane, passing each other
+    previous = with_textured_vehicles(background, (40, 10, 60, 20), (120, 60, 60, 25))
+    gray = with_textured_vehicles(background, (50, 10, 60, 20), (100, 60, 60, 25), seed=2)
+    assert projection_blobs(previous, gray) == [(40, 10, 70, 20), (100, 60, 80, 25)]
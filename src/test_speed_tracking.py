@@ -0,0 +1,203 @@
+import numpy as np
+import pytest
+
+from speed_tracking import CONFIRMED, FINISHED, LOST, TENTATIVE, L2R, R2L, UNKNOWN
+from speed_tracking import KalmanPredictor, RunningStats, TrackBuffer
+from speed_tracking import aged_state, assign, confirmed_state, cost_matrix, fit_track, kalman_gate, overlaps, trail_box
+
+INF = np.inf
+
+
+def blob_hits(blobs, boxes):
+    (x, y, w, h) = np.array(blobs).T
+    return overlaps(x, y, w, h, *np.array(boxes).T)
+
+
+def test_trail_box_reaches_back_a_vehicle_length():
+    # front of an L2R vehicle found by canny, its rear found as a separate blob behind it
+    front = (63, 0, 50, 47)
+    assert trail_box(front, L2R, 100) == (13, 0, 100, 47)
+    assert trail_box((100, 0, 50, 47), R2L, 100) == (100, 0, 100, 47)
+    assert trail_box(front, UNKNOWN, 100) == front
+    # a blob longer than the length isn't shrunk
+    assert trail_box(front, L2R, 20) == front
+
+
+def test_trail_box_covers_the_rear_not_the_next_vehicle():
+    rear, follower = (0, 0, 45, 48), (-150, 0, 84, 38)
+    hits = blob_hits([rear, follower], [trail_box((63, 0, 50, 47), L2R, 100)])
+    assert hits[:, 0].tolist() == [True, False]
+    # nor a vehicle ahead of it
+    assert not blob_hits([(120, 0, 40, 40)], [trail_box((63, 0, 50, 47), L2R, 100)]).any()
+
+
+def test_cost_matrix_gates_and_direction():
+    # an L2R vehicle at x 50, a vehicle not yet moving at x 100
+    cost = cost_matrix(np.array([50, 100]), np.array([20, 20]), np.array([L2R, UNKNOWN]),
+                       np.array([60, 40, 200, 103]), np.array([24, 20, 20, 60]), 80, 10)
+    assert cost[0, 0] == pytest.approx(np.hypot(10, 4))
+    assert cost[0, 1] == INF# backwards
+    assert cost[0, 2] == INF and cost[1, 3] == INF# too far in x, in y
+    assert cost[1, 1] == 60# either way while the direction isn't known
+
+
+def test_cost_matrix_gates_per_vehicle():
+    cost = cost_matrix(np.array([50, 50]), np.array([20, 20]), np.array([L2R, L2R]),
+                       np.array([70]), np.array([20]), np.array([10, 30]), np.array([5, 5]))
+    assert cost[:, 0].tolist() == [INF, 20]
+
+
+def test_cost_matrix_gates_per_pair():
+    cost = cost_matrix(np.array([50]), np.array([20]), np.array([L2R]),
+                       np.array([70, 70]), np.array([20, 20]), np.array([[10, 30]]), 5)
+    assert cost[0].tolist() == [INF, 20]
+
+
+def test_greedy_takes_the_cheapest_pair_first():
+    rows, cols = assign(np.array([[1.0, 2.0], [3.0, INF]]), 'greedy')
+    assert rows.tolist() == [0] and cols.tolist() == [0]# the second vehicle and blob are left over
+
+
+def test_hungarian_minimises_the_total_cost():
+    pytest.importorskip('scipy')
+    rows, cols = assign(np.array([[1.0, 2.0], [3.0, INF]]), 'hungarian')
+    assert sorted(zip(rows.tolist(), cols.tolist())) == [(0, 1), (1, 0)]
+
+
+@pytest.mark.parametrize('method', ['greedy', 'hungarian'])
+def test_unmatched_blobs_are_left_over(method):
+    if method == 'hungarian':
+        pytest.importorskip('scipy')
+    cost = np.array([[5.0, INF, 1.0], [INF, INF, INF]])
+    rows, cols = assign(cost, method)
+    assert rows.tolist() == [0] and cols.tolist() == [2]
+    rows, cols = assign(np.full((2, 3), INF), method)
+    assert len(rows) == len(cols) == 0
+
+
+def test_track_buffer_grows_and_keeps_its_rows():
+    track = TrackBuffer(capacity=2)
+    for i in range(5):
+        track.append(10 * i, 5, 30, 20, 10 * i + 15, 15, 600, 0.1 * i, L2R)
+    assert len(track) == 5 and len(track.rows) == 8
+    assert track['x'].tolist() == [0, 10, 20, 30, 40]
+    assert track.records['dir'].tolist() == [L2R] * 5
+    assert track.px_per_sec() == pytest.approx([100.0] * 4)
+    track.clear()
+    assert len(track) == 0 and len(track['t']) == 0
+
+
+def test_track_buffer_speed_ignores_repeated_times():
+    track = TrackBuffer()
+    for (x, t) in ((0, 0.0), (10, 0.1), (12, 0.1), (30, 0.2)):
+        track.append(x, 0, 1, 1, x, 0, 1, t, L2R)
+    assert track.px_per_sec() == pytest.approx([100.0, 180.0])
+
+
+def test_running_stats_match_numpy():
+    samples = [31.0, 29.5, 30.2, 33.1, 28.7, 30.0]
+    stats = RunningStats()
+    for sample in samples:
+        assert stats.add(sample)
+    assert stats.count == len(samples)
+    assert stats.mean == pytest.approx(np.mean(samples))
+    assert stats.stddev == pytest.approx(np.std(samples))
+    assert stats.moe == pytest.approx(1.96 * np.std(samples) / np.sqrt(len(samples)))
+
+
+def test_running_stats_reject_outliers_once_there_are_enough_samples():
+    stats = RunningStats(outlier_sigma=3.0, outlier_min=1.0, min_samples=3)
+    assert stats.add(100.0) and stats.add(30.0)# too few samples to tell yet
+    stats = RunningStats(outlier_sigma=3.0, outlier_min=1.0, min_samples=3)
+    for sample in (30.0, 30.4, 29.8, 30.2):
+        assert stats.add(sample)
+    assert not stats.add(45.0)
+    assert stats.add(30.9)# within outlier_min, though over 3 sigma
+    assert stats.rejected == 1 and stats.count == 5
+    assert stats.mean == pytest.approx(np.mean([30.0, 30.4, 29.8, 30.2, 30.9]))
+
+
+def test_running_stats_discard_the_first_sample():
+    stats = RunningStats()
+    for sample in (12.0, 30.0, 31.0, 29.0):
+        stats.add(sample)
+    stats.discard_first()
+    assert stats.count == 3
+    assert stats.mean == pytest.approx(30.0)
+    assert stats.stddev == pytest.approx(np.std([30.0, 31.0, 29.0]))
+
+
+def constant_speed_track(px_per_sec=250.0, frames=12, fps=25.0):
+    t = 1000.0 + np.arange(frames) / fps
+    x = 40.0 + px_per_sec * (t - t[0])
+    return t, np.round(x)
+
+
+def test_fit_track_finds_a_constant_speed():
+    t, x = constant_speed_track()
+    fit = fit_track(t, x)
+    assert fit.slope == pytest.approx(250.0, rel=0.01)
+    assert fit.intercept == pytest.approx(40.0, abs=1.0)
+    assert fit.points == 12 and fit.moe < 5.0
+
+
+def test_fit_track_shrugs_off_an_outlier():
+    t, x = constant_speed_track()
+    x[7] += 40# a blob merged with another for a frame
+    robust = fit_track(t, x)
+    plain = fit_track(t, x, robust=False)
+    assert robust.slope == pytest.approx(250.0, rel=0.01)
+    assert abs(plain.slope - 250.0) > abs(robust.slope - 250.0)
+    assert plain.residual > robust.residual
+
+
+def test_fit_track_needs_three_points_at_different_times():
+    assert fit_track([1.0, 1.04], [10, 20]) is None
+    assert fit_track([1.0, 1.0, 1.0], [10, 20, 30]) is None
+
+
+def test_kalman_learns_the_velocity_and_narrows_its_gate():
+    predictor = KalmanPredictor(0.0, 20.0, 50.0)
+    (_, _, first_sigma_x, _) = predictor.predict(0.04)
+    for frame in range(1, 10):
+        t = frame * 0.04
+        predictor.update(t, 20.0 + 300.0 * t, 50.0)
+    assert predictor.updates == 9
+    assert predictor.velocity == pytest.approx((300.0, 0.0), abs=15.0)
+    (x, y, sigma_x, sigma_y) = predictor.predict(0.40)
+    assert x == pytest.approx(140.0, abs=2.0) and y == pytest.approx(50.0, abs=1.0)
+    assert sigma_x < first_sigma_x
+
+
+def test_kalman_gate_is_never_less_than_half_the_blob():
+    # converged, 3 sigma is 6 px, but a 60 px blob split in two moves its centroid 15 px
+    assert kalman_gate(2.0, 30.0, 3.0, 8.0, 40.0) == 30.0
+    assert kalman_gate(np.array([2.0, 5.0]), np.array([3.0, 3.0]), 3.0, 8.0, 40.0).tolist() == [8.0, 15.0]
+    assert kalman_gate(2.0, 100.0, 3.0, 8.0, 40.0) == 40.0
+
+
+def test_kalman_prediction_leaves_the_state_alone():
+    predictor = KalmanPredictor(0.0, 20.0, 50.0)
+    predictor.update(0.04, 32.0, 50.0)
+    before = predictor.predict(0.08)
+    predictor.predict(1.0)
+    assert predictor.predict(0.08) == before
+    # the gate widens the longer the vehicle goes unseen
+    assert predictor.predict(0.2)[2] > before[2]
+
+
+def test_a_new_vehicle_is_confirmed_after_track_confirm_matches():
+    assert confirmed_state(TENTATIVE, 2, 3) == TENTATIVE
+    assert confirmed_state(TENTATIVE, 3, 3) == CONFIRMED
+    # once measured it stays finished however long its track
+    assert confirmed_state(FINISHED, 9, 3) == FINISHED
+
+
+def test_a_vehicle_unseen_is_lost_or_forgotten_by_its_state():
+    (event_timeout, track_timeout) = (0.3, 1.0)
+    assert aged_state(TENTATIVE, 0.0, event_timeout, track_timeout) == TENTATIVE
+    assert aged_state(TENTATIVE, 0.04, event_timeout, track_timeout) == LOST# missed once
+    assert aged_state(CONFIRMED, 0.3, event_timeout, track_timeout) == CONFIRMED
+    assert aged_state(CONFIRMED, 0.31, event_timeout, track_timeout) == LOST
+    assert aged_state(FINISHED, 0.5, event_timeout, track_timeout) == FINISHED# still followed
+    assert aged_state(FINISHED, 1.1, event_timeout, track_timeout) is None